@@ -1,26 +1,69 @@
 import sys
 import os
 import pickle
+import glob
+import json
+import csv
+import sqlite3
+import re
 import time
 import threading
-import tkinter as tk
-from tkinter import ttk, messagebox, filedialog
-from PIL import Image, ImageTk, ImageDraw
-import MetaTrader5 as mt5
-import pandas as pd
+import queue
+import argparse
+import difflib
+import urllib.parse
+import http.client
+import smtplib
+import socket
+from email.message import EmailMessage
+import numpy as np
+from types import SimpleNamespace, MappingProxyType
+from contextlib import contextmanager, closing
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from bisect import bisect_right
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor, Future, as_completed
 from datetime import datetime, timedelta
 import pytz
 
 # Configuración global
-CONFIG_FILE = "trading_alarm_config.pkl"
+CONFIG_FILE = "trading_alarm_config.json"
+# Formato anterior (pickle): se migra a JSON en el primer arranque
+LEGACY_CONFIG_FILE = "trading_alarm_config.pkl"
+# Estado del motor para el arranque en caliente, junto a la configuración
+SNAPSHOT_FILE = os.path.join(os.path.dirname(CONFIG_FILE), "trading_alarm_state.json")
+# Historial de alertas (SQLite)
+JOURNAL_FILE = os.path.join(os.path.dirname(CONFIG_FILE), "trading_alarm_alerts.db")
 SOUND_AVAILABLE = False
+GUI_AVAILABLE = False
+
+MT5_AVAILABLE = False
+
+try:
+    import MetaTrader5 as mt5
+    MT5_AVAILABLE = True
+except ImportError:
+    mt5 = None
+    print("Advertencia: MetaTrader5 no está instalado. Solo se podrán reproducir datos grabados.", file=sys.stderr)
 
 try:
     import pygame
     pygame.mixer.init()
     SOUND_AVAILABLE = True
 except ImportError:
-    print("Advertencia: pygame no está instalado. Las alarmas no tendrán sonido.")
+    print("Advertencia: pygame no está instalado. Las alarmas no tendrán sonido.", file=sys.stderr)
+except Exception as e:
+    # Servidores sin dispositivo de audio
+    print(f"Advertencia: no se pudo iniciar el audio ({e}). Las alarmas no tendrán sonido.", file=sys.stderr)
+
+# La interfaz es opcional: el modo --headless funciona sin Tk ni PIL
+try:
+    import tkinter as tk
+    from tkinter import ttk, messagebox, filedialog
+    from PIL import Image, ImageTk, ImageDraw
+    GUI_AVAILABLE = True
+except ImportError:
+    tk = None
 
 # Pares de Forex principales
 FOREX_PAIRS = [
@@ -31,12 +74,1486 @@ FOREX_PAIRS = [
 # Timeframes disponibles
 TIMEFRAMES = {
     "1 minuto": 1,
-    "5 minutos": 5
+    "5 minutos": 5,
+    "15 minutos": 15,
+    "1 hora": 60
+}
+
+# Modos de detección: por velas cerradas/en formación o por ticks en tiempo real
+DETECTION_MODES = {
+    "Velas": "bars",
+    "Ticks (tiempo real)": "ticks"
+}
+
+# Periodos del historial de alertas (días hacia atrás; None = todo)
+HISTORY_PERIODS = {
+    "24 horas": 1,
+    "7 días": 7,
+    "30 días": 30,
+    "Todo": None
+}
+HISTORY_PAGE_SIZE = 100
+
+# Constantes de timeframe (mismos valores que el paquete MetaTrader5)
+TIMEFRAME_M1 = 1
+TIMEFRAME_M5 = 5
+TIMEFRAME_M15 = 15
+TIMEFRAME_M30 = 30
+TIMEFRAME_H1 = 16385
+TIMEFRAME_H4 = 16388
+TIMEFRAME_D1 = 16408
+
+# Nombre y duración en segundos de cada timeframe
+TIMEFRAME_NAMES = {
+    TIMEFRAME_M1: "M1", TIMEFRAME_M5: "M5", TIMEFRAME_M15: "M15", TIMEFRAME_M30: "M30",
+    TIMEFRAME_H1: "H1", TIMEFRAME_H4: "H4", TIMEFRAME_D1: "D1"
 }
+# Minutos de la interfaz -> constante de timeframe
+MINUTE_TIMEFRAMES = {
+    1: TIMEFRAME_M1, 5: TIMEFRAME_M5, 15: TIMEFRAME_M15, 30: TIMEFRAME_M30, 60: TIMEFRAME_H1
+}
+TIMEFRAME_SECONDS = {
+    TIMEFRAME_M1: 60, TIMEFRAME_M5: 300, TIMEFRAME_M15: 900, TIMEFRAME_M30: 1800,
+    TIMEFRAME_H1: 3600, TIMEFRAME_H4: 14400, TIMEFRAME_D1: 86400
+}
+
+# Flags de copy_ticks_from
+COPY_TICKS_ALL = -1
+COPY_TICKS_INFO = 1
+COPY_TICKS_TRADE = 2
+
+# Configuración de sesiones en orden cronológico (horario UTC)
+MARKET_SESSIONS = [
+    {"name": "Sydney", "open": (21, 0), "close": (0, 0)},   # 21:00-06:00 UTC
+    {"name": "Tokyo", "open": (0, 0), "close": (8, 0)},     # 00:00-08:00 UTC
+    {"name": "London", "open": (8, 0), "close": (13, 0)},   # 08:00-17:00 UTC
+    {"name": "New York", "open": (13, 0), "close": (21, 0)} # 13:00-22:00 UTC
+]
+
+# Alternativa en hora local de cada plaza: sigue los cambios de horario de verano
+MARKET_SESSIONS_LOCAL = [
+    {"name": "Sydney", "open": (7, 0), "close": (16, 0), "tz": "Australia/Sydney"},
+    {"name": "Tokyo", "open": (9, 0), "close": (18, 0), "tz": "Asia/Tokyo"},
+    {"name": "London", "open": (8, 0), "close": (17, 0), "tz": "Europe/London"},
+    {"name": "New York", "open": (8, 0), "close": (17, 0), "tz": "America/New_York"}
+]
+
+# Niveles evaluados, en el orden de las columnas del evaluador por lotes
+LEVEL_KINDS = ("PDH", "PDL", "PSH", "PSL")
+
+# Ruptura detectada: nivel roto, precio de referencia y hora (epoch) de la vela o tick
+Breakout = namedtuple("Breakout", ["symbol", "kind", "level", "price", "candle_time"])
+
+# Texto de cada señal según el nivel roto
+SIGNAL_LABELS = {
+    "PDH": "RUPTURA PDH (Previous Day High)",
+    "PDL": "RUPTURA PDL (Previous Day Low)",
+    "PSH": "RUPTURA PSH (Previous Session High)",
+    "PSL": "RUPTURA PSL (Previous Session Low)"
+}
+
+# Estructura de las velas devueltas por copy_rates_*
+RATES_DTYPE = np.dtype([
+    ('time', '<i8'), ('open', '<f8'), ('high', '<f8'), ('low', '<f8'),
+    ('close', '<f8'), ('tick_volume', '<u8'), ('spread', '<i4'), ('real_volume', '<u8')
+])
+
+# Estructura de los ticks devueltos por copy_ticks_*
+TICKS_DTYPE = np.dtype([
+    ('time', '<i8'), ('bid', '<f8'), ('ask', '<f8'), ('last', '<f8'), ('volume', '<u8'),
+    ('time_msc', '<i8'), ('flags', '<u4'), ('volume_real', '<f8')
+])
+
+class BarArray:
+    """Acceso ligero a las velas de copy_rates_* sin pasar por pandas"""
+    __slots__ = ("rates",)
+
+    def __init__(self, rates):
+        self.rates = rates
+
+    def __len__(self):
+        return len(self.rates)
+
+    def high(self):
+        """Máximo de todas las velas"""
+        return float(self.rates['high'].max())
+
+    def low(self):
+        """Mínimo de todas las velas"""
+        return float(self.rates['low'].min())
+
+    def open(self):
+        """Apertura de la primera vela"""
+        return float(self.rates['open'][0])
+
+    def close(self):
+        """Cierre de la última vela"""
+        return float(self.rates['close'][-1])
+
+    def candle(self, index):
+        """Vela individual como diccionario de floats (time en segundos epoch)"""
+        row = self.rates[index]
+        return {
+            "time": int(row['time']),
+            "open": float(row['open']),
+            "high": float(row['high']),
+            "low": float(row['low']),
+            "close": float(row['close'])
+        }
+
+def breakout_mask(highs, lows, levels):
+    """Condiciones de ruptura por vela en una sola pasada NumPy.
+
+    highs y lows tienen forma (C, N) -C velas de N símbolos- y levels (4, N)
+    en el orden de LEVEL_KINDS. Devuelve un array booleano (C, 4, N).
+    Los símbolos van en el último eje para operar sobre memoria contigua.
+    """
+    highs = highs[:, None, :]
+    lows = lows[:, None, :]
+    # PDH/PSH: la vela alcanza el nivel desde abajo; PDL/PSL: lo alcanza desde arriba
+    mask = (highs >= levels) & (lows < levels)
+    lower = (highs > levels) & (lows <= levels)
+    mask[:, 1::2] = lower[:, 1::2]
+    return mask
+
+def candle_breaks(candle, level, upper):
+    """Misma regla que breakout_mask para una sola vela, sin crear arrays.
+
+    upper indica un nivel alto (PDH/PSH); si no, es un nivel bajo (PDL/PSL).
+    """
+    if upper:
+        return candle['high'] >= level and candle['low'] < level
+    return candle['high'] > level and candle['low'] <= level
+
+class BatchLevelEvaluator:
+    """Evalúa las rupturas PDH/PDL/PSH/PSL de todos los símbolos a la vez.
+
+    Cada símbolo ocupa una columna de arrays densos; evaluate() devuelve una
+    máscara compacta de un byte por símbolo (bit i = LEVEL_KINDS[i]).
+    Las columnas sin datos (NaN) nunca generan señal.
+    """
+    BITS = np.array([1 << i for i in range(len(LEVEL_KINDS))], dtype=np.uint8)[:, None]
+
+    def __init__(self, symbols=(), candles=2):
+        self.set_symbols(symbols, candles)
+
+    def set_symbols(self, symbols, candles=2):
+        self.symbols = list(symbols)
+        self.index = {symbol: column for column, symbol in enumerate(self.symbols)}
+        count = len(self.symbols)
+        self.highs = np.full((candles, count), np.nan)
+        self.lows = np.full((candles, count), np.nan)
+        self.levels = np.full((len(LEVEL_KINDS), count), np.nan)
+
+    def reset(self):
+        self.highs.fill(np.nan)
+        self.lows.fill(np.nan)
+        self.levels.fill(np.nan)
+
+    def set_column(self, column, highs, lows, levels):
+        self.highs[:, column] = highs
+        self.lows[:, column] = lows
+        self.levels[:, column] = [levels[kind] for kind in LEVEL_KINDS]
+
+    def evaluate(self):
+        """Máscara de señales (N,) uint8 de todos los símbolos"""
+        hits = np.logical_or.reduce(breakout_mask(self.highs, self.lows, self.levels), axis=0)
+        return np.bitwise_or.reduce(hits * self.BITS, axis=0)
+
+    @staticmethod
+    def kinds(bits):
+        """Niveles activos en el byte de máscara de un símbolo"""
+        return [kind for i, kind in enumerate(LEVEL_KINDS) if bits >> i & 1]
+
+class RollingHistogram:
+    """Últimas maxlen muestras de una duración (segundos) con cuantiles bajo demanda"""
+    def __init__(self, maxlen=1024):
+        self.samples = deque(maxlen=maxlen)
+        self.count = 0
+
+    def observe(self, value):
+        self.samples.append(value)
+        self.count += 1
+
+    def snapshot(self):
+        values = np.fromiter(self.samples, dtype=float, count=len(self.samples))
+        if len(values) == 0:
+            return None
+        p50, p90, p99 = np.percentile(values, (50, 90, 99))
+        return {
+            "count": self.count, "window": len(values), "mean": float(values.mean()),
+            "p50": float(p50), "p90": float(p90), "p99": float(p99), "max": float(values.max())
+        }
+
+class Metrics:
+    """Tiempos del camino crítico por (métrica, símbolo) en histogramas móviles"""
+    def __init__(self, maxlen=1024):
+        self.maxlen = maxlen
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def observe(self, name, seconds, symbol=""):
+        with self.lock:
+            histogram = self.histograms.get((name, symbol))
+            if histogram is None:
+                histogram = self.histograms[(name, symbol)] = RollingHistogram(self.maxlen)
+            histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, name, symbol=""):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, symbol)
+
+    def snapshot(self):
+        """Lista de {name, symbol, count, window, mean, p50, p90, p99, max} ordenada"""
+        with self.lock:
+            items = sorted(self.histograms.items())
+        rows = []
+        for (name, symbol), histogram in items:
+            summary = histogram.snapshot()
+            if summary is not None:
+                rows.append({"name": name, "symbol": symbol, **summary})
+        return rows
+
+    def prometheus(self):
+        """Formato de texto de Prometheus (summary con cuantiles de la ventana móvil)"""
+        lines = []
+        for row in self.snapshot():
+            metric = f"alarma_{re.sub(r'[^a-zA-Z0-9_]', '_', row['name'])}_seconds"
+            symbol = f'symbol="{row["symbol"]}"' if row['symbol'] else ""
+            for quantile in ("p50", "p90", "p99"):
+                labels = ",".join(filter(None, (symbol, f'quantile="0.{quantile[1:]}"')))
+                lines.append(f"{metric}{{{labels}}} {row[quantile]:.6f}")
+            suffix = f"{{{symbol}}}" if symbol else ""
+            lines.append(f"{metric}_max{suffix} {row['max']:.6f}")
+            lines.append(f"{metric}_count{suffix} {row['count']}")
+        return "\n".join(lines) + "\n"
+
+# Instrumentación global del proceso
+METRICS = Metrics()
+
+class MetricsServer:
+    """Endpoint HTTP local opcional: /metrics (texto Prometheus) y /metrics.json"""
+    def __init__(self, metrics, port, host="127.0.0.1"):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == "/metrics":
+                    body = metrics.prometheus().encode('utf-8')
+                    content_type = "text/plain; version=0.0.4"
+                elif self.path == "/metrics.json":
+                    body = json.dumps(metrics.snapshot()).encode('utf-8')
+                    content_type = "application/json"
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name="metricas", daemon=True)
+        self.thread.start()
+        print(f"📊 Métricas en http://{host}:{self.server.server_port}/metrics")
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+class LevelCache:
+    """Caché de niveles PDH/PDL y PSH/PSL válidos hasta su próximo límite"""
+    def __init__(self):
+        # (símbolo, tipo, límite) -> (niveles, expiración)
+        self.entries = {}
+        # (símbolo, tipo) -> límite vigente, para descartar entradas obsoletas
+        self.current = {}
+        self.lock = threading.Lock()
+
+    def get(self, symbol, kind, boundary, now):
+        """Devuelve los niveles en caché o None si no existen o han expirado"""
+        entry = self.entries.get((symbol, kind, boundary))
+        if entry is None:
+            return None
+        levels, expires = entry
+        if now >= expires:
+            self.entries.pop((symbol, kind, boundary), None)
+            return None
+        return levels
+
+    def put(self, symbol, kind, boundary, expires, levels):
+        """Guarda niveles válidos desde boundary hasta expires"""
+        with self.lock:
+            previous = self.current.get((symbol, kind))
+            if previous is not None and previous != boundary:
+                self.entries.pop((symbol, kind, previous), None)
+            self.current[(symbol, kind)] = boundary
+            self.entries[(symbol, kind, boundary)] = (levels, expires)
+
+    def export(self):
+        """Entradas en formato JSON (límites y expiraciones en segundos epoch)"""
+        with self.lock:
+            return [
+                {"symbol": symbol, "kind": kind, "boundary": boundary.timestamp(),
+                 "expires": expires.timestamp(), "levels": levels}
+                for (symbol, kind, boundary), (levels, expires) in self.entries.items()
+            ]
+
+    def restore(self, entries, now):
+        """Carga las entradas exportadas que sigan vigentes en now"""
+        for entry in entries:
+            expires = datetime.fromtimestamp(entry['expires'], pytz.utc)
+            if now < expires:
+                boundary = datetime.fromtimestamp(entry['boundary'], pytz.utc)
+                self.put(entry['symbol'], entry['kind'], boundary, expires, entry['levels'])
+
+class SessionCalendar:
+    """Tabla precalculada de aperturas y cierres de sesión (epoch UTC).
+
+    Cada sesión se define con "open"/"close" (hora, minuto) y, opcionalmente,
+    "tz": sin zona horaria las horas son UTC; con ella son hora local y la
+    tabla sigue los cambios de horario de verano. Las consultas son búsquedas
+    binarias sobre la tabla, que se amplía sola al preguntar fuera del
+    horizonte calculado.
+
+    zone es el desfase (segundos) del reloj de los instantes consultados
+    respecto a UTC, p. ej. la hora del servidor del broker: la consulta se
+    hace en UTC y los instantes devueltos vuelven a ese reloj.
+    """
+    def __init__(self, sessions=None, horizon_days=14):
+        self.sessions = list(sessions) if sessions is not None else MARKET_SESSIONS
+        self.horizon_days = horizon_days
+        self.first_day = None
+        self.last_day = None
+        # Sesiones ordenadas por apertura y, aparte, por cierre
+        self.opens = []
+        self.closes = []
+        self.names = []
+        self.close_order = []
+        self.sorted_closes = []
+        self.boundaries = []
+        self.lock = threading.Lock()
+
+    def _instants(self, session, day):
+        """Apertura y cierre (epoch) de la sesión que abre en la fecha local indicada"""
+        zone = pytz.timezone(session["tz"]) if session.get("tz") else pytz.utc
+        date = datetime(1970, 1, 1) + timedelta(days=day)
+        opened = date.replace(hour=session["open"][0], minute=session["open"][1])
+        closed = date.replace(hour=session["close"][0], minute=session["close"][1])
+        # Sesiones que cruzan la medianoche local
+        if closed <= opened:
+            closed += timedelta(days=1)
+        return int(zone.localize(opened).timestamp()), int(zone.localize(closed).timestamp())
+
+    def _build(self, first_day, last_day):
+        rows = sorted(
+            self._instants(session, day) + (session["name"],)
+            for day in range(first_day - 1, last_day + 2)
+            for session in self.sessions
+        )
+        self.opens = [row[0] for row in rows]
+        self.closes = [row[1] for row in rows]
+        self.names = [row[2] for row in rows]
+        self.close_order = sorted(range(len(rows)), key=lambda index: self.closes[index])
+        self.sorted_closes = [self.closes[index] for index in self.close_order]
+        self.boundaries = sorted(set(self.opens) | set(self.closes))
+        self.first_day = first_day
+        self.last_day = last_day
+
+    def ensure(self, start, end=None):
+        """Garantiza que la tabla cubre [start, end] (epoch) con margen"""
+        first = int(start) // 86400
+        last = int(end if end is not None else start) // 86400
+        with self.lock:
+            if self.first_day is not None and self.first_day + 1 <= first and last <= self.last_day - 1:
+                return
+            if self.first_day is not None:
+                first = min(first, self.first_day)
+                last = max(last, self.last_day)
+            self._build(first - self.horizon_days, last + self.horizon_days)
+
+    def _window(self, index, zone=0):
+        return self.names[index], self.opens[index] + zone, self.closes[index] + zone
+
+    def current(self, epoch, zone=0):
+        """(nombre, apertura, cierre) de la sesión abierta en epoch, o None.
+
+        Si hay sesiones solapadas se devuelve la que abrió más tarde.
+        """
+        epoch -= zone
+        self.ensure(epoch)
+        index = bisect_right(self.opens, epoch) - 1
+        for candidate in range(index, max(index - len(self.sessions), -1), -1):
+            if epoch < self.closes[candidate]:
+                return self._window(candidate, zone)
+        return None
+
+    def previous(self, epoch, zone=0):
+        """(nombre, apertura, cierre) de la última sesión ya cerrada en epoch"""
+        epoch -= zone
+        self.ensure(epoch)
+        position = bisect_right(self.sorted_closes, epoch) - 1
+        if position < 0:
+            return None
+        return self._window(self.close_order[position], zone)
+
+    def next_boundary(self, epoch, zone=0):
+        """Próxima apertura o cierre estrictamente posterior a epoch"""
+        epoch -= zone
+        self.ensure(epoch)
+        return self.boundaries[bisect_right(self.boundaries, epoch)] + zone
+
+    def next_close(self, epoch, zone=0):
+        """Próximo cierre de sesión: a partir de él cambia la sesión anterior"""
+        epoch -= zone
+        self.ensure(epoch)
+        return self.sorted_closes[bisect_right(self.sorted_closes, epoch)] + zone
+
+    def session_starts(self, times, zone=0):
+        """Apertura (epoch) de la sesión de cada instante de times; -1 fuera de sesión"""
+        times = np.asarray(times, dtype=np.int64) - zone
+        if len(times) == 0:
+            return np.zeros(0, dtype=np.int64)
+        self.ensure(int(times.min()), int(times.max()))
+        opens = np.asarray(self.opens, dtype=np.int64)
+        closes = np.asarray(self.closes, dtype=np.int64)
+        index = np.searchsorted(opens, times, side='right') - 1
+        starts = np.full(len(times), -1, dtype=np.int64)
+        pending = np.ones(len(times), dtype=bool)
+        # Con sesiones solapadas se retrocede hasta la última que sigue abierta
+        for _ in range(len(self.sessions)):
+            inside = pending & (index >= 0) & (times < closes[np.maximum(index, 0)])
+            starts[inside] = opens[index[inside]] + zone
+            pending &= ~inside
+            index -= 1
+        return starts
+
+class RunningLevelAggregator:
+    """Apertura, máximo, mínimo y cierre en curso del día UTC y de la sesión
+
+    Cada ciclo pliega las velas cerradas que ya trae la consulta de velas
+    actuales; al cruzar un límite los valores quedan congelados como
+    "anteriores", así que el cambio de sesión o de día no cuesta ninguna
+    llamada adicional al terminal.
+    """
+    def __init__(self, session_bounds):
+        # epoch -> (nombre, inicio, fin) de la sesión que contiene ese instante
+        self.session_bounds = session_bounds
+        self.period = None
+        self.seeded_from = None
+        self.last_time = None
+        self.day = None
+        self.session = None
+        self.days = deque(maxlen=3)
+        self.sessions = deque(maxlen=8)
+
+    def seed(self, rates, seeded_from, period, now):
+        """Reinicia el estado a partir de una descarga en bloque"""
+        self.period = period
+        self.seeded_from = seeded_from
+        self.last_time = None
+        self.day = None
+        self.session = None
+        self.days.clear()
+        self.sessions.clear()
+        for bar in rates[rates['time'] + period <= now]:
+            self._fold(bar)
+
+    def fold(self, rates, period, now):
+        """Pliega las velas cerradas nuevas; False si hace falta volver a sembrar"""
+        if self.seeded_from is None or period != self.period:
+            return False
+        if self.last_time is not None and int(rates['time'][0]) > self.last_time + period:
+            # Sin solapamiento con lo ya visto: pudieron perderse velas
+            return False
+        closed = rates[rates['time'] + period <= now]
+        if self.last_time is not None:
+            closed = closed[closed['time'] > self.last_time]
+        for bar in closed:
+            self._fold(bar)
+        return True
+
+    def _fold(self, bar):
+        time_ = int(bar['time'])
+        day = time_ // 86400
+        if self.day is None or self.day['key'] != day:
+            if self.day is not None:
+                self.days.append(self.day)
+            self.day = self._record(day, None, day * 86400, (day + 1) * 86400, bar)
+        else:
+            self._update(self.day, bar)
+
+        if self.session is None or not self.session['start'] <= time_ < self.session['end']:
+            if self.session is not None:
+                self.sessions.append(self.session)
+            bounds = self.session_bounds(time_)
+            # Fuera de cualquier sesión no se acumula nada
+            self.session = self._record(bounds[1], *bounds, bar) if bounds is not None else None
+        else:
+            self._update(self.session, bar)
+        self.last_time = time_
+
+    def state(self):
+        """Estado serializable (JSON) para el arranque en caliente"""
+        return {
+            "period": self.period,
+            "seeded_from": self.seeded_from,
+            "last_time": self.last_time,
+            "day": dict(self.day) if self.day is not None else None,
+            "session": dict(self.session) if self.session is not None else None,
+            "days": [dict(record) for record in self.days],
+            "sessions": [dict(record) for record in self.sessions]
+        }
+
+    def restore(self, state):
+        """Recupera un estado guardado con state()"""
+        self.period = state['period']
+        self.seeded_from = state['seeded_from']
+        self.last_time = state['last_time']
+        self.day = state['day']
+        self.session = state['session']
+        self.days = deque(state['days'], maxlen=self.days.maxlen)
+        self.sessions = deque(state['sessions'], maxlen=self.sessions.maxlen)
+
+    @staticmethod
+    def _record(key, name, start, end, bar):
+        return {
+            "key": key, "name": name, "start": start, "end": end,
+            "open": float(bar['open']), "high": float(bar['high']),
+            "low": float(bar['low']), "close": float(bar['close']), "bars": 1,
+            "first": int(bar['time'])
+        }
+
+    @staticmethod
+    def _update(record, bar):
+        record['high'] = max(record['high'], float(bar['high']))
+        record['low'] = min(record['low'], float(bar['low']))
+        record['close'] = float(bar['close'])
+        record['bars'] += 1
+
+    def _complete(self, record):
+        """Un tramo es fiable si se vio desde su primera vela hasta la última"""
+        return (record['start'] >= self.seeded_from and
+                record['first'] < record['start'] + self.period and
+                self.last_time + self.period >= record['end'])
+
+    def completed_day(self, day):
+        """Valores del día UTC indicado (días desde epoch) o None"""
+        if self.last_time is None:
+            return None
+        for record in (self.day, *reversed(self.days)):
+            if record is not None and record['key'] == day:
+                return record if self._complete(record) else None
+        return None
+
+    def completed_session(self, start, end):
+        """Valores de la sesión [start, end) (epoch) o None"""
+        if self.last_time is None:
+            return None
+        for record in (self.session, *reversed(self.sessions)):
+            if record is not None and record['start'] == start and record['end'] == end:
+                return record if self._complete(record) else None
+        return None
+
+class ServerClock:
+    """Hora del servidor del broker estimada a partir de los ticks.
+
+    Las velas y los ticks llevan la hora del servidor (p. ej. UTC+2), no la
+    del reloj de la fuente; el desfase entre ambos se estima con la hora de
+    los ticks recientes y se suma al reloj de la fuente.
+    """
+    def __init__(self, source=None):
+        # Reloj de la fuente de datos (None = reloj local)
+        self.source = source
+        # Desfase servidor - reloj de la fuente en segundos
+        self.offset = 0.0
+        self.samples = deque(maxlen=20)
+
+    @property
+    def synced(self):
+        return bool(self.samples)
+
+    def local(self):
+        return self.source.time() if self.source is not None else time.time()
+
+    def speed(self):
+        return self.source.speed if self.source is not None else 1.0
+
+    def sync(self, server_time):
+        """Actualiza el desfase con la hora de un tick del servidor"""
+        if server_time is None:
+            return
+        self.samples.append(server_time - self.local())
+        # Un tick nunca va por delante del reloj del servidor: el mayor
+        # desfase reciente es el que menos retraso de tick incluye
+        self.offset = max(self.samples)
+
+    def reset(self):
+        self.samples.clear()
+        self.offset = 0.0
+
+    def zone(self):
+        """Huso horario del servidor respecto a UTC (segundos, redondeado al cuarto de hora).
+
+        El desfase estimado incluye el retraso de los ticks; el redondeo lo
+        elimina para convertir límites de sesión sin partir velas.
+        """
+        return int(round(self.offset / 900.0)) * 900
+
+    def time(self):
+        """Segundos epoch en hora del servidor"""
+        return self.local() + self.offset
+
+    def now(self):
+        return datetime.fromtimestamp(self.time(), pytz.utc)
+
+class CandleScheduler:
+    """Programa cada ciclo unos segundos después del cierre de vela (hora del servidor)"""
+    def __init__(self, timeframe_min=5, delay_seconds=2, clock=None):
+        self.period = timeframe_min * 60
+        self.delay = delay_seconds
+        self.clock = clock if clock is not None else ServerClock()
+        self.last_bar = None
+        self.skipped = 0
+        # Calendario de sesiones opcional: los cambios de sesión también despiertan
+        self.calendar = None
+
+    def configure(self, timeframe_min, delay_seconds):
+        """Aplica cambios de timeframe o retardo sin reiniciar el monitoreo"""
+        period = timeframe_min * 60
+        if period != self.period:
+            self.period = period
+            self.last_bar = None
+        self.delay = delay_seconds
+
+    def use_clock(self, clock):
+        """Sigue el reloj del servidor de la conexión (tiempo real o reproducción acelerada)"""
+        if clock is not self.clock:
+            self.clock = clock
+            self.last_bar = None
+
+    def use_calendar(self, calendar):
+        """Despierta también en cada apertura o cierre de sesión (niveles PSH/PSL nuevos)"""
+        self.calendar = calendar
+
+    def server_now(self):
+        return self.clock.time()
+
+    def wait_next(self, stop_event, wake_event=None):
+        """Espera al próximo cierre de vela + retardo.
+
+        Si el ciclo anterior se ha excedido, los cierres perdidos se agrupan
+        en una única ejecución. wake_event adelanta el ciclo (p. ej. tras un
+        cambio de configuración). Devuelve False si se solicitó la parada.
+        """
+        now = self.server_now()
+        bar = int((now - self.delay) // self.period) + 1
+        if self.last_bar is not None and bar > self.last_bar + 1:
+            missed = bar - self.last_bar - 1
+            self.skipped += missed
+            print(f"⚠️ Ciclo excedido: se agrupan {missed} cierre(s) de vela")
+        self.last_bar = bar
+        
+        wake_at = bar * self.period + self.delay
+        if self.calendar is not None:
+            # Con timeframes largos un cambio de sesión puede caer entre dos cierres
+            wake_at = min(wake_at, self.calendar.next_boundary(now - self.delay, self.clock.zone()) + self.delay)
+        while True:
+            remaining = wake_at - self.server_now()
+            if remaining <= 0:
+                return not stop_event.is_set()
+            timeout = remaining / self.clock.speed()
+            if wake_event is not None:
+                if wake_event.is_set():
+                    return not stop_event.is_set()
+                timeout = min(timeout, 0.5)
+            if stop_event.wait(timeout):
+                return False
+
+def to_epoch(value):
+    """Convierte un datetime (naive = UTC) o un número a segundos epoch"""
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=pytz.utc)
+        return value.timestamp()
+    return float(value)
+
+class MarketDataSource:
+    """Interfaz de datos de mercado: las mismas llamadas que usa el código del módulo MetaTrader5"""
+    # Velocidad del reloj de la fuente respecto al tiempo real
+    speed = 1.0
+
+    def initialize(self, **kwargs):
+        raise NotImplementedError
+
+    def shutdown(self):
+        raise NotImplementedError
+
+    def last_error(self):
+        raise NotImplementedError
+
+    def terminal_info(self):
+        raise NotImplementedError
+
+    def symbol_info(self, symbol):
+        raise NotImplementedError
+
+    def symbol_select(self, symbol, enable=True):
+        raise NotImplementedError
+
+    def symbols_get(self):
+        raise NotImplementedError
+
+    def symbol_info_tick(self, symbol):
+        raise NotImplementedError
+
+    def copy_rates_range(self, symbol, timeframe, date_from, date_to):
+        raise NotImplementedError
+
+    def copy_rates_from_pos(self, symbol, timeframe, start_pos, count):
+        raise NotImplementedError
+
+    def copy_ticks_from(self, symbol, date_from, count, flags=COPY_TICKS_ALL):
+        raise NotImplementedError
+
+    def time(self):
+        """Segundos epoch según el reloj de la fuente"""
+        return time.time()
+
+    def now(self):
+        """Fecha y hora UTC según el reloj de la fuente"""
+        return datetime.fromtimestamp(self.time(), pytz.utc)
+
+class MT5DataSource(MarketDataSource):
+    """Fuente en vivo sobre el terminal MetaTrader 5"""
+    def __init__(self):
+        if not MT5_AVAILABLE:
+            raise Exception("MetaTrader5 no está instalado")
+
+    def initialize(self, **kwargs):
+        return mt5.initialize(**kwargs)
+
+    def shutdown(self):
+        return mt5.shutdown()
+
+    def last_error(self):
+        return mt5.last_error()
+
+    def terminal_info(self):
+        return mt5.terminal_info()
+
+    def symbol_info(self, symbol):
+        return mt5.symbol_info(symbol)
+
+    def symbol_select(self, symbol, enable=True):
+        return mt5.symbol_select(symbol, enable)
+
+    def symbols_get(self):
+        return mt5.symbols_get()
+
+    def symbol_info_tick(self, symbol):
+        return mt5.symbol_info_tick(symbol)
+
+    def copy_rates_range(self, symbol, timeframe, date_from, date_to):
+        return mt5.copy_rates_range(symbol, timeframe, date_from, date_to)
+
+    def copy_rates_from_pos(self, symbol, timeframe, start_pos, count):
+        return mt5.copy_rates_from_pos(symbol, timeframe, start_pos, count)
+
+    def copy_ticks_from(self, symbol, date_from, count, flags=COPY_TICKS_ALL):
+        return mt5.copy_ticks_from(symbol, date_from, count, flags)
+
+class TerminalGateway(MarketDataSource):
+    """Hilo único dueño del terminal: todas las llamadas pasan por su cola.
+
+    Cada llamada se encola como petición (método, argumentos) y devuelve un
+    Future; la interfaz síncrona de MarketDataSource espera su resultado.
+    Las lecturas idénticas que siguen en vuelo se fusionan en una sola
+    llamada al terminal y comparten el resultado, que no debe modificarse.
+    Un shutdown se ejecuta en orden de cola, nunca a mitad de otra lectura;
+    close() detiene el hilo cuando termina lo ya encolado.
+    """
+    # Llamadas que cambian el estado del terminal: nunca se fusionan
+    EXCLUSIVE = {"initialize", "shutdown", "last_error", "symbol_select"}
+
+    def __init__(self, source, name="terminal"):
+        self.source = source
+        self.speed = source.speed
+        self.requests = queue.Queue()
+        # clave de la petición -> Future compartido mientras no termine
+        self.in_flight = {}
+        self.lock = threading.Lock()
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self.thread.start()
+
+    def submit(self, method, *args, **kwargs):
+        """Encola una petición y devuelve su Future (o el de una idéntica en vuelo)"""
+        key = None
+        if method not in self.EXCLUSIVE:
+            key = (method, args, tuple(sorted(kwargs.items())))
+        with self.lock:
+            if self.closed:
+                raise Exception(f"Pasarela {self.thread.name} cerrada")
+            if key is not None:
+                future = self.in_flight.get(key)
+                if future is not None:
+                    return future
+            future = Future()
+            if key is not None:
+                self.in_flight[key] = future
+            self.requests.put((future, key, method, args, kwargs))
+        return future
+
+    def call(self, method, *args, **kwargs):
+        if threading.current_thread() is self.thread:
+            return getattr(self.source, method)(*args, **kwargs)
+        return self.submit(method, *args, **kwargs).result()
+
+    def _run(self):
+        while True:
+            request = self.requests.get()
+            if request is None:
+                return
+            future, key, method, args, kwargs = request
+            error = None
+            result = None
+            try:
+                result = getattr(self.source, method)(*args, **kwargs)
+            except BaseException as e:
+                error = e
+            # Las peticiones que lleguen a partir de aquí harán una llamada nueva
+            with self.lock:
+                if key is not None:
+                    self.in_flight.pop(key, None)
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    def close(self, timeout=5.0):
+        """Detiene el hilo después de atender las peticiones ya encoladas"""
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            # Con el lock tomado ninguna petición puede quedar detrás de la marca de fin
+            self.requests.put(None)
+        if threading.current_thread() is not self.thread:
+            self.thread.join(timeout)
+
+    def initialize(self, **kwargs):
+        return self.call("initialize", **kwargs)
+
+    def shutdown(self):
+        return self.call("shutdown")
+
+    def last_error(self):
+        return self.call("last_error")
+
+    def terminal_info(self):
+        return self.call("terminal_info")
+
+    def symbol_info(self, symbol):
+        return self.call("symbol_info", symbol)
+
+    def symbol_select(self, symbol, enable=True):
+        return self.call("symbol_select", symbol, enable)
+
+    def symbols_get(self):
+        return self.call("symbols_get")
+
+    def symbol_info_tick(self, symbol):
+        return self.call("symbol_info_tick", symbol)
+
+    def copy_rates_range(self, symbol, timeframe, date_from, date_to):
+        return self.call("copy_rates_range", symbol, timeframe, date_from, date_to)
+
+    def copy_rates_from_pos(self, symbol, timeframe, start_pos, count):
+        return self.call("copy_rates_from_pos", symbol, timeframe, start_pos, count)
+
+    def copy_ticks_from(self, symbol, date_from, count, flags=COPY_TICKS_ALL):
+        return self.call("copy_ticks_from", symbol, date_from, count, flags)
+
+    def time(self):
+        return self.source.time()
+
+_MT5_GATEWAY = None
+_MT5_GATEWAY_LOCK = threading.Lock()
+
+def mt5_gateway():
+    """Pasarela única del proceso: el módulo MetaTrader5 es global"""
+    global _MT5_GATEWAY
+    with _MT5_GATEWAY_LOCK:
+        if _MT5_GATEWAY is None:
+            _MT5_GATEWAY = TerminalGateway(MT5DataSource(), name="terminal-mt5")
+        return _MT5_GATEWAY
+
+class ReplayDataSource(MarketDataSource):
+    """Reproduce velas y ticks grabados en disco a velocidad configurable.
+
+    El directorio contiene un fichero .npy por símbolo y timeframe
+    ({SÍMBOLO}_{M1|M5|...|D1}.npy, con RATES_DTYPE) y opcionalmente
+    {SÍMBOLO}_ticks.npy (TICKS_DTYPE), tal como los escribe record_feed().
+    El reloj simulado arranca en start (epoch) y avanza speed veces más
+    rápido que el tiempo real; solo se entregan datos anteriores al reloj.
+    """
+    def __init__(self, directory, speed=60.0, start=None):
+        self.directory = directory
+        self.speed = float(speed)
+        self.bars = {}
+        self.ticks = {}
+        self.meta = {}
+        meta_file = os.path.join(directory, "symbols.json")
+        if os.path.exists(meta_file):
+            with open(meta_file, 'r', encoding='utf-8') as f:
+                self.meta = json.load(f)
+        
+        self.symbols = sorted({
+            os.path.basename(path).rsplit("_", 1)[0]
+            for path in glob.glob(os.path.join(directory, "*_*.npy"))
+        })
+        if not self.symbols:
+            raise Exception(f"No hay datos grabados en {directory}")
+        if start is None:
+            # Por defecto se empieza dos días después del primer dato para tener día anterior
+            first = min(
+                int(self._load_bars(symbol, timeframe)['time'][0])
+                for symbol in self.symbols
+                for timeframe in TIMEFRAME_NAMES
+                if len(self._load_bars(symbol, timeframe))
+            )
+            start = first + 2 * 86400
+        self.start = float(start)
+        self.started = time.monotonic()
+
+    def _load_bars(self, symbol, timeframe):
+        key = (symbol, timeframe)
+        if key not in self.bars:
+            path = os.path.join(self.directory, f"{symbol}_{TIMEFRAME_NAMES[timeframe]}.npy")
+            self.bars[key] = (np.load(path, mmap_mode='r') if os.path.exists(path)
+                              else np.zeros(0, dtype=RATES_DTYPE))
+        return self.bars[key]
+
+    def _load_ticks(self, symbol):
+        if symbol not in self.ticks:
+            path = os.path.join(self.directory, f"{symbol}_ticks.npy")
+            self.ticks[symbol] = (np.load(path, mmap_mode='r') if os.path.exists(path)
+                                  else np.zeros(0, dtype=TICKS_DTYPE))
+        return self.ticks[symbol]
+
+    def time(self):
+        return self.start + (time.monotonic() - self.started) * self.speed
+
+    def initialize(self, **kwargs):
+        return True
+
+    def shutdown(self):
+        return True
+
+    def last_error(self):
+        return (1, "Success")
+
+    def terminal_info(self):
+        return SimpleNamespace(connected=True, name="Replay", path=self.directory)
+
+    def symbol_info(self, symbol):
+        if symbol not in self.symbols:
+            return None
+        digits = self.meta.get(symbol, {}).get("digits", 3 if "JPY" in symbol else 5)
+        return SimpleNamespace(name=symbol, visible=True, digits=digits, point=10.0 ** -digits)
+
+    def symbol_select(self, symbol, enable=True):
+        return symbol in self.symbols
+
+    def symbols_get(self):
+        return tuple(self.symbol_info(symbol) for symbol in self.symbols)
+
+    def symbol_info_tick(self, symbol):
+        now_msc = int(self.time() * 1000)
+        ticks = self._load_ticks(symbol)
+        if len(ticks):
+            end = np.searchsorted(ticks['time_msc'], now_msc, side='right')
+            if end == 0:
+                return None
+            tick = ticks[end - 1]
+            return SimpleNamespace(time=int(tick['time']), time_msc=int(tick['time_msc']),
+                                   bid=float(tick['bid']), ask=float(tick['ask']),
+                                   last=float(tick['last']), volume=int(tick['volume']))
+        # Sin ticks grabados se usa el cierre de la última vela M1 como cotización,
+        # con la hora del reloj simulado (la apertura de la vela retrasaría el desfase)
+        bars = self.copy_rates_from_pos(symbol, TIMEFRAME_M1, 0, 1)
+        if bars is None or len(bars) == 0:
+            return None
+        bar = bars[-1]
+        close = float(bar['close'])
+        spread = int(bar['spread']) * self.symbol_info(symbol).point
+        return SimpleNamespace(time=now_msc // 1000, time_msc=now_msc,
+                               bid=close, ask=close + spread, last=0.0, volume=0)
+
+    def copy_rates_range(self, symbol, timeframe, date_from, date_to):
+        bars = self._load_bars(symbol, timeframe)
+        times = bars['time']
+        start = np.searchsorted(times, to_epoch(date_from), side='left')
+        end = np.searchsorted(times, min(to_epoch(date_to), self.time()), side='right')
+        return np.array(bars[start:max(start, end)])
+
+    def copy_rates_from_pos(self, symbol, timeframe, start_pos, count):
+        bars = self._load_bars(symbol, timeframe)
+        # La última vela disponible es la que está en formación según el reloj simulado
+        end = np.searchsorted(bars['time'], self.time(), side='right') - start_pos
+        if end <= 0:
+            return None
+        return np.array(bars[max(0, end - count):end])
+
+    def copy_ticks_from(self, symbol, date_from, count, flags=COPY_TICKS_ALL):
+        ticks = self._load_ticks(symbol)
+        times = ticks['time_msc']
+        start = np.searchsorted(times, to_epoch(date_from) * 1000, side='left')
+        end = np.searchsorted(times, self.time() * 1000, side='right')
+        return np.array(ticks[start:min(end, start + count)])
+
+def record_feed(source, directory, symbols, timeframes, date_from, date_to, ticks=False):
+    """Graba velas (y opcionalmente ticks) de una fuente para reproducirlas con ReplayDataSource"""
+    os.makedirs(directory, exist_ok=True)
+    meta = {}
+    for symbol in symbols:
+        info = source.symbol_info(symbol)
+        if info is not None:
+            meta[symbol] = {"digits": info.digits}
+        for timeframe in timeframes:
+            rates = source.copy_rates_range(symbol, timeframe, date_from, date_to)
+            if rates is None:
+                rates = np.zeros(0, dtype=RATES_DTYPE)
+            path = os.path.join(directory, f"{symbol}_{TIMEFRAME_NAMES[timeframe]}.npy")
+            np.save(path, np.asarray(rates, dtype=RATES_DTYPE))
+            print(f"💾 {symbol} {TIMEFRAME_NAMES[timeframe]}: {len(rates)} velas -> {path}")
+        if ticks:
+            data = source.copy_ticks_from(symbol, date_from, 100_000_000, COPY_TICKS_ALL)
+            if data is None:
+                data = np.zeros(0, dtype=TICKS_DTYPE)
+            data = data[data['time_msc'] <= to_epoch(date_to) * 1000]
+            path = os.path.join(directory, f"{symbol}_ticks.npy")
+            np.save(path, np.asarray(data, dtype=TICKS_DTYPE))
+            print(f"💾 {symbol} ticks: {len(data)} -> {path}")
+    with open(os.path.join(directory, "symbols.json"), 'w', encoding='utf-8') as f:
+        json.dump(meta, f, indent=2)
+
+class BarStore:
+    """Almacén local de velas cerradas por símbolo y timeframe.
+
+    Cada campo de RATES_DTYPE se guarda en su propio fichero binario
+    ({directorio}/{SÍMBOLO}/{TF}/{campo}.bin) que se abre con memory-map;
+    las velas nuevas se añaden al final sin reescribir lo existente.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.RLock()
+        self.columns = {}
+
+    def _path(self, symbol, timeframe, field):
+        return os.path.join(self.directory, symbol, TIMEFRAME_NAMES[timeframe], f"{field}.bin")
+
+    def _open(self, symbol, timeframe):
+        """Columnas memory-mapped; si una escritura quedó a medias se usa la longitud común"""
+        key = (symbol, timeframe)
+        with self.lock:
+            if key not in self.columns:
+                counts = []
+                for field in RATES_DTYPE.names:
+                    path = self._path(symbol, timeframe, field)
+                    size = os.path.getsize(path) if os.path.exists(path) else 0
+                    counts.append(size // RATES_DTYPE[field].itemsize)
+                count = min(counts)
+                self.columns[key] = {
+                    field: (np.memmap(self._path(symbol, timeframe, field), dtype=RATES_DTYPE[field],
+                                      mode='r', shape=(count,))
+                            if count else np.zeros(0, dtype=RATES_DTYPE[field]))
+                    for field in RATES_DTYPE.names
+                }
+            return self.columns[key]
+
+    def column(self, symbol, timeframe, field):
+        """Columna completa (memory-mapped) de un campo"""
+        return self._open(symbol, timeframe)[field]
+
+    def count(self, symbol, timeframe):
+        return len(self.column(symbol, timeframe, 'time'))
+
+    def first_time(self, symbol, timeframe):
+        times = self.column(symbol, timeframe, 'time')
+        return int(times[0]) if len(times) else None
+
+    def last_time(self, symbol, timeframe):
+        times = self.column(symbol, timeframe, 'time')
+        return int(times[-1]) if len(times) else None
+
+    def read(self, symbol, timeframe, start=None, end=None):
+        """Velas con start <= time <= end como array estructurado RATES_DTYPE"""
+        columns = self._open(symbol, timeframe)
+        times = columns['time']
+        first = 0 if start is None else np.searchsorted(times, start, side='left')
+        last = len(times) if end is None else np.searchsorted(times, end, side='right')
+        rates = np.empty(max(0, last - first), dtype=RATES_DTYPE)
+        for field in RATES_DTYPE.names:
+            rates[field] = columns[field][first:last]
+        return rates
+
+    def append(self, symbol, timeframe, rates):
+        """Añade velas (más recientes que las almacenadas) al final de cada columna"""
+        if len(rates) == 0:
+            return
+        key = (symbol, timeframe)
+        with self.lock:
+            count = self.count(symbol, timeframe)
+            # Se liberan los memory-maps antes de escribir en los ficheros
+            self.columns.pop(key, None)
+            os.makedirs(os.path.dirname(self._path(symbol, timeframe, 'time')), exist_ok=True)
+            for field in RATES_DTYPE.names:
+                path = self._path(symbol, timeframe, field)
+                with open(path, 'ab') as f:
+                    # Descarta restos de una escritura interrumpida
+                    f.truncate(count * RATES_DTYPE[field].itemsize)
+                    f.write(np.ascontiguousarray(rates[field], dtype=RATES_DTYPE[field]).tobytes())
+
+class StoredDataSource(MarketDataSource):
+    """Sirve las velas cerradas desde el almacén local y solo pide al terminal las nuevas.
+
+    Un rango [inicio, fin] se parte en [inicio, última almacenada], que se
+    lee del almacén, y (última, fin], que se pide al terminal en una sola
+    llamada; las velas recibidas que ya están cerradas se añaden al almacén.
+    Así el coste de un arranque depende del hueco, no del rango pedido.
+    """
+    def __init__(self, source, store):
+        self.source = source
+        self.store = store
+        self.speed = source.speed
+
+    def copy_rates_range(self, symbol, timeframe, date_from, date_to):
+        start = to_epoch(date_from)
+        end = to_epoch(date_to)
+        period = TIMEFRAME_SECONDS[timeframe]
+        first = self.store.first_time(symbol, timeframe)
+        last = self.store.last_time(symbol, timeframe)
+        
+        if first is None or first - start >= period:
+            # El almacén no cubre el inicio (la primera vela guardada puede
+            # abrir hasta un periodo después de un inicio no alineado): el
+            # rango entero va al terminal
+            rates = self.source.copy_rates_range(symbol, timeframe, date_from, date_to)
+            self._keep_closed(symbol, timeframe, rates)
+            return rates
+        
+        stored = self.store.read(symbol, timeframe, start, end)
+        if end < last + period:
+            return stored
+        fresh = self.source.copy_rates_range(
+            symbol, timeframe, datetime.fromtimestamp(last + period, pytz.utc), date_to)
+        if fresh is None:
+            return None
+        fresh = np.asarray(fresh, dtype=RATES_DTYPE)
+        fresh = fresh[fresh['time'] > last]
+        # El hueco desde la última almacenada se guarda entero, pero solo se
+        # devuelve lo que cae dentro del rango pedido
+        self._keep_closed(symbol, timeframe, fresh)
+        return np.concatenate((stored, fresh[fresh['time'] >= start]))
+
+    def _keep_closed(self, symbol, timeframe, rates):
+        """Añade al almacén las velas posteriores a la última guardada salvo la final.
+
+        La vela final puede estar en formación; una vela con otra posterior
+        ya está cerrada, sin depender del reloj (hora del servidor o local).
+        """
+        if rates is None or len(rates) < 2:
+            return
+        rates = np.asarray(rates, dtype=RATES_DTYPE)[:-1]
+        with self.store.lock:
+            # Otra consulta pudo guardar las mismas velas mientras se descargaban
+            last = self.store.last_time(symbol, timeframe)
+            if last is not None:
+                rates = rates[rates['time'] > last]
+            if len(rates) == 0:
+                return
+            self.store.append(symbol, timeframe, rates)
+        print(f"💾 {symbol} {TIMEFRAME_NAMES[timeframe]}: {len(rates)} velas nuevas en el almacén local")
+
+    def initialize(self, **kwargs):
+        return self.source.initialize(**kwargs)
+
+    def shutdown(self):
+        return self.source.shutdown()
+
+    def last_error(self):
+        return self.source.last_error()
+
+    def terminal_info(self):
+        return self.source.terminal_info()
+
+    def symbol_info(self, symbol):
+        return self.source.symbol_info(symbol)
+
+    def symbol_select(self, symbol, enable=True):
+        return self.source.symbol_select(symbol, enable)
+
+    def symbols_get(self):
+        return self.source.symbols_get()
+
+    def symbol_info_tick(self, symbol):
+        return self.source.symbol_info_tick(symbol)
+
+    def copy_rates_from_pos(self, symbol, timeframe, start_pos, count):
+        return self.source.copy_rates_from_pos(symbol, timeframe, start_pos, count)
+
+    def copy_ticks_from(self, symbol, date_from, count, flags=COPY_TICKS_ALL):
+        return self.source.copy_ticks_from(symbol, date_from, count, flags)
+
+    def time(self):
+        return self.source.time()
+
+class SymbolIndex:
+    """Índice de los símbolos del broker construido con una sola llamada a symbols_get.
+
+    Resuelve en O(1) el nombre pedido al nombre real del broker aunque este
+    lleve sufijos (EURUSD.m, EURUSDpro, EURUSD#). Solo se reconstruye tras
+    invalidate(), es decir, al reconectar o al cambiar de servidor.
+    """
+    def __init__(self, source):
+        self.source = source
+        self.lock = threading.Lock()
+        self.infos = None
+        self.aliases = {}
+        # Símbolos ya activados en el Market Watch y pedidos inexistentes ya avisados
+        self.selected = set()
+        self.reported = set()
+
+    @staticmethod
+    def normalize(name):
+        """Clave de alias: mayúsculas sin separadores"""
+        return re.sub(r'[^A-Z0-9]', '', name.upper())
+
+    @classmethod
+    def alias_keys(cls, name):
+        """Claves por las que se puede pedir un símbolo del broker"""
+        keys = [cls.normalize(name)]
+        # EURUSD.m, EURUSD#, EURUSD_i -> EURUSD
+        base = re.split(r'[.#_\-+!]', name, maxsplit=1)[0]
+        if base:
+            keys.append(cls.normalize(base))
+        # EURUSDpro, EURUSDm -> EURUSD
+        pair = re.match(r'[A-Z]{6}', name)
+        if pair:
+            keys.append(pair.group(0))
+        return keys
+
+    def invalidate(self):
+        with self.lock:
+            self.infos = None
+            self.aliases = {}
+            self.selected = set()
+            self.reported = set()
+
+    def _ensure(self):
+        """Construye el índice si hace falta (con el lock tomado)"""
+        if self.infos is not None:
+            return self.infos
+        with METRICS.timer("symbols_get"):
+            symbols = self.source.symbols_get()
+        if symbols is None:
+            raise Exception(f"No se pudo obtener la lista de símbolos: {self.source.last_error()}")
+        aliases = {}
+        # Si varios símbolos comparten alias gana el visible y de nombre más corto
+        for info in sorted(symbols, key=lambda info: (not info.visible, len(info.name))):
+            for key in self.alias_keys(info.name):
+                aliases.setdefault(key, info.name)
+        self.infos = {info.name: info for info in symbols}
+        self.aliases = aliases
+        print(f"📇 Índice de símbolos: {len(self.infos)} símbolos del broker")
+        return self.infos
+
+    def _lookup(self, symbol):
+        infos = self._ensure()
+        name = symbol if symbol in infos else self.aliases.get(self.normalize(symbol))
+        return None if name is None else infos[name]
+
+    def info(self, symbol):
+        """Información del símbolo (con el nombre del broker) o None si no existe"""
+        with self.lock:
+            return self._lookup(symbol)
+
+    def resolve(self, symbol):
+        """Nombre del broker para el símbolo pedido o None"""
+        info = self.info(symbol)
+        return None if info is None else info.name
+
+    def suggestions(self, symbol, count=10):
+        """Símbolos parecidos al pedido, para los mensajes de error"""
+        with self.lock:
+            names = list(self._ensure())
+        by_key = {self.normalize(name): name for name in names}
+        close = difflib.get_close_matches(self.normalize(symbol), list(by_key), n=count, cutoff=0.5)
+        return [by_key[key] for key in close] or names[:count]
+
+    def select(self, symbols):
+        """Activa de una vez los símbolos vigilados que no estén en el Market Watch.
+
+        Devuelve {símbolo pedido: nombre del broker} con los que quedaron listos.
+        Los símbolos ya activados no vuelven a consultarse al terminal.
+        """
+        ready = {}
+        with self.lock:
+            for symbol in symbols:
+                info = self._lookup(symbol)
+                if info is None:
+                    if symbol not in self.reported:
+                        self.reported.add(symbol)
+                        print(f"⚠️ Símbolo {symbol} no disponible en este broker")
+                    continue
+                if info.name not in self.selected and not info.visible:
+                    print(f"Activando símbolo {info.name}...")
+                    if not self.source.symbol_select(info.name, True):
+                        print(f"⚠️ No se pudo activar {info.name}")
+                        continue
+                self.selected.add(info.name)
+                ready[symbol] = info.name
+        return ready
+
+class MT5ConnectionManager:
+    """Sesión MT5 persistente compartida por todos los símbolos y ciclos"""
+    def __init__(self, server="MetaQuotes-Demo", login=94099863, password="", source=None,
+                 sessions=None):
+        try:
+            self.login = int(login)
+        except ValueError:
+            raise ValueError("El login de MT5 debe ser un número entero")
+
+        self.server = server
+        self.password = password
+        self.source = source if source is not None else mt5_gateway()
+        self.connected = False
+        # Un analizador reutilizable por (símbolo, timeframe)
+        self.analyzers = {}
+        # Los niveles no dependen de la conexión y sobreviven a las reconexiones
+        self.level_cache = LevelCache()
+        self.calendar = SessionCalendar(sessions)
+        self.symbol_index = SymbolIndex(self.source)
+        # Hora del servidor compartida por el programador y los analizadores
+        self.clock = ServerClock(self.source)
+        # (símbolo, timeframe) -> estado de agregador pendiente de aplicar a su analizador
+        self.aggregator_states = {}
+        self.analyzers_lock = threading.Lock()
+
+    def connect(self):
+        """Inicia sesión en MT5 una única vez"""
+        print(f"🔌 Conectando a MT5 - Servidor: {self.server}, Login: {self.login}")
+        with METRICS.timer("connect"):
+            if not self.source.initialize(server=self.server, login=self.login, password=self.password):
+                error = self.source.last_error()
+                print(f"❌ Error de conexión MT5: {error}")
+                raise Exception(f"Error al conectar a MT5: {error}")
+        self.connected = True
+        # Tras una reconexión los símbolos y el desfase del servidor se revisan de nuevo
+        self.symbol_index.invalidate()
+        self.clock.reset()
+        with self.analyzers_lock:
+            # Los agregadores se conservan: el analizador nuevo solo pide las velas que faltan
+            self._stash_aggregators()
+            self.analyzers.clear()
+        print(f"✅ Conexión exitosa a {self.server}")
+
+    def is_healthy(self):
+        """Comprobación barata del estado de la conexión (sin handshake)"""
+        if not self.connected:
+            return False
+        with METRICS.timer("health_check"):
+            info = self.source.terminal_info()
+        return info is not None and info.connected
+
+    def ensure_connected(self):
+        """Reconecta solo si la sesión actual ha fallado. Devuelve True si hubo (re)conexión"""
+        if self.is_healthy():
+            return False
+        if self.connected:
+            print("⚠️ Conexión MT5 perdida, reconectando...")
+            self.source.shutdown()
+            self.connected = False
+        self.connect()
+        return True
+
+    def server_time(self, symbol):
+        """Hora del servidor (segundos epoch) según el último tick del símbolo; sincroniza clock"""
+        symbol = self.symbol_index.resolve(symbol) or symbol
+        with METRICS.timer("symbol_info_tick", symbol):
+            tick = self.source.symbol_info_tick(symbol)
+        if tick is None:
+            return None
+        self.clock.sync(tick.time_msc / 1000.0)
+        return tick.time_msc / 1000.0
+
+    def get_analyzer(self, symbol, timeframe_min):
+        """Devuelve el analizador reutilizable del símbolo"""
+        key = (symbol, timeframe_min)
+        analyzer = self.analyzers.get(key)
+        if analyzer is None:
+            analyzer = TradingSignalController(
+                symbol=symbol,
+                timeframe_min=timeframe_min,
+                server=self.server,
+                login=self.login,
+                password=self.password,
+                connection=self
+            )
+            with self.analyzers_lock:
+                if key not in self.analyzers:
+                    state = self.aggregator_states.pop(key, None)
+                    if state is not None:
+                        analyzer.aggregator.restore(state)
+                    self.analyzers[key] = analyzer
+                analyzer = self.analyzers[key]
+        return analyzer
+
+    def _stash_aggregators(self):
+        """Guarda el estado de los agregadores vivos (con analyzers_lock tomado)"""
+        for key, analyzer in self.analyzers.items():
+            if analyzer.aggregator.last_time is not None:
+                self.aggregator_states[key] = analyzer.aggregator.state()
+
+    def export_aggregators(self):
+        """Agregadores vivos y pendientes en formato JSON"""
+        with self.analyzers_lock:
+            self._stash_aggregators()
+            return [
+                {"symbol": symbol, "timeframe": timeframe, "state": state}
+                for (symbol, timeframe), state in self.aggregator_states.items()
+            ]
+
+    def restore_aggregators(self, entries):
+        """Deja los agregadores guardados listos para los analizadores que se creen"""
+        with self.analyzers_lock:
+            for entry in entries:
+                key = (entry['symbol'], entry['timeframe'])
+                # Un analizador ya en marcha tiene un estado más reciente
+                if key not in self.analyzers:
+                    self.aggregator_states[key] = entry['state']
+
+    def shutdown(self):
+        """Cierra la sesión MT5"""
+        if self.connected:
+            self.source.shutdown()
+            self.connected = False
+        with self.analyzers_lock:
+            self.analyzers.clear()
 
 class TradingSignalController:
     def __init__(self, symbol="EURUSD", timeframe_min=5, lookback_days=1, 
-                 server="MetaQuotes-Demo", login=94099863, password=""):
+                 server="MetaQuotes-Demo", login=94099863, password="",
+                 connection=None):
         self.symbol = symbol
         self.timeframe_min = timeframe_min
         self.timeframe = self._get_mt5_timeframe()
@@ -51,205 +1568,288 @@ class TradingSignalController:
             
         self.server = server
         self.password = password
+        self.connection = connection
+        self.source = connection.source if connection is not None else mt5_gateway()
+        self.level_cache = connection.level_cache if connection is not None else LevelCache()
+        # Las velas llevan la hora del servidor: los límites se calculan con ese reloj
+        self.clock = connection.clock if connection is not None else ServerClock(self.source)
+        self.point = 0.0
+        # Niveles y último cierre del análisis más reciente
+        self.levels = {}
+        self.price = None
         
-        # Configuración de sesiones en orden cronológico (horario UTC)
-        self.market_sessions = [
-            {"name": "Sydney", "open": (21, 0), "close": (0, 0)},   # 21:00-06:00 UTC
-            {"name": "Tokyo", "open": (0, 0), "close": (8, 0)},     # 00:00-08:00 UTC
-            {"name": "London", "open": (8, 0), "close": (13, 0)},   # 08:00-17:00 UTC
-            {"name": "New York", "open": (13, 0), "close": (21, 0)} # 13:00-22:00 UTC
-        ]
+        self.calendar = connection.calendar if connection is not None else SessionCalendar()
+        self.market_sessions = self.calendar.sessions
+        self.aggregator = RunningLevelAggregator(self._session_bounds)
         
-        self._connect_to_mt5()
+        # Con una sesión compartida no se repite el handshake con el terminal
+        if self.connection is None:
+            self._connect_to_mt5()
         self._verify_symbol()
 
     def _connect_to_mt5(self):
         """Conexión con MT5 con manejo de errores mejorado"""
         print(f"🔌 Conectando a MT5 - Servidor: {self.server}, Login: {self.login}")
-        if not mt5.initialize(server=self.server, login=self.login, password=self.password):
-            error = mt5.last_error()
-            print(f"❌ Error de conexión MT5: {error}")
-            raise Exception(f"Error al conectar a MT5: {error}")
+        with METRICS.timer("connect"):
+            if not self.source.initialize(server=self.server, login=self.login, password=self.password):
+                error = self.source.last_error()
+                print(f"❌ Error de conexión MT5: {error}")
+                raise Exception(f"Error al conectar a MT5: {error}")
         print(f"✅ Conexión exitosa a {self.server}")
 
     def _verify_symbol(self):
-        """Verificación robusta del símbolo"""
-        symbol_info = mt5.symbol_info(self.symbol)
-        if symbol_info is None:
-            available = mt5.symbols_get()
-            print(f"Símbolos disponibles: {[s.name for s in available[:10]]}")
-            raise Exception(f"Símbolo {self.symbol} no disponible")
-        
-        if not symbol_info.visible:
-            print(f"Activando símbolo {self.symbol}...")
-            if not mt5.symbol_select(self.symbol, True):
+        """Verificación robusta del símbolo contra el índice de la sesión"""
+        index = self.connection.symbol_index if self.connection is not None else SymbolIndex(self.source)
+        with METRICS.timer("verify_symbol", self.symbol):
+            symbol_info = index.info(self.symbol)
+            if symbol_info is None:
+                print(f"Símbolos disponibles: {index.suggestions(self.symbol)}")
+                raise Exception(f"Símbolo {self.symbol} no disponible")
+            
+            if symbol_info.name != self.symbol:
+                # Las consultas al terminal usan el nombre con el sufijo del broker
+                print(f"🔁 {self.symbol} -> {symbol_info.name}")
+                self.symbol = symbol_info.name
+            if not index.select([self.symbol]):
                 raise Exception(f"No se pudo activar {self.symbol}")
+        self.point = symbol_info.point
         print(f"✅ Símbolo {self.symbol} listo para operar")
 
+    def _server_now(self):
+        """Hora del servidor; sin desfase estimado aún se sincroniza con un tick del símbolo"""
+        if not self.clock.synced:
+            with METRICS.timer("symbol_info_tick", self.symbol):
+                tick = self.source.symbol_info_tick(self.symbol)
+            if tick is not None:
+                self.clock.sync(tick.time_msc / 1000.0)
+        return self.clock.time()
+
     def _get_mt5_timeframe(self):
         """Mapeo de timeframe a constantes MT5"""
-        return {
-            1: mt5.TIMEFRAME_M1,
-            5: mt5.TIMEFRAME_M5,
-            15: mt5.TIMEFRAME_M15,
-            30: mt5.TIMEFRAME_M30,
-            60: mt5.TIMEFRAME_H1
-        }.get(self.timeframe_min, mt5.TIMEFRAME_M5)
+        return MINUTE_TIMEFRAMES.get(self.timeframe_min, TIMEFRAME_M5)
 
     def _get_previous_day_data(self):
-        """Obtiene datos del día anterior"""
-        now = datetime.now(pytz.utc)
+        """Obtiene datos del día anterior (en caché hasta el cambio de día del servidor)"""
+        now = datetime.fromtimestamp(self._server_now(), pytz.utc)
+        today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        cached = self.level_cache.get(self.symbol, "day", today, now)
+        if cached is not None:
+            return cached
+        
         previous_day = now - timedelta(days=self.lookback_days)
         
         start = previous_day.replace(hour=0, minute=0, second=0, microsecond=0)
         end = previous_day.replace(hour=23, minute=59, second=59, microsecond=999)
         
+        # Día ya agregado vela a vela: no hace falta consultar D1
+        record = self.aggregator.completed_day(int(start.timestamp()) // 86400)
+        if record is not None:
+            data = {
+                "date": start.strftime("%Y-%m-%d"),
+                "high": record['high'],
+                "low": record['low'],
+                "open": record['open'],
+                "close": record['close']
+            }
+            self.level_cache.put(self.symbol, "day", today, today + timedelta(days=1), data)
+            return data
+        
         print(f"\n📅 Obteniendo datos del día anterior {start} a {end}")
         
-        rates = mt5.copy_rates_range(
-            self.symbol,
-            mt5.TIMEFRAME_D1,
-            start,
-            end
-        )
+        with METRICS.timer("copy_rates_range", self.symbol):
+            rates = self.source.copy_rates_range(
+                self.symbol,
+                TIMEFRAME_D1,
+                start,
+                end
+            )
         
         if rates is None or len(rates) == 0:
             raise Exception("No se pudieron obtener datos del día anterior")
         
-        df = pd.DataFrame(rates)
-        df['time'] = pd.to_datetime(df['time'], unit='s')
+        day = BarArray(rates).candle(0)
         
-        return {
+        data = {
             "date": start.strftime("%Y-%m-%d"),
-            "high": df['high'].iloc[0],
-            "low": df['low'].iloc[0],
-            "open": df['open'].iloc[0],
-            "close": df['close'].iloc[0]
+            "high": day['high'],
+            "low": day['low'],
+            "open": day['open'],
+            "close": day['close']
         }
+        self.level_cache.put(self.symbol, "day", today, today + timedelta(days=1), data)
+        return data
+
+    def _session_bounds(self, epoch):
+        """Sesión que contiene el instante epoch, como (nombre, inicio, fin) en hora del servidor"""
+        return self.calendar.current(epoch, self.clock.zone())
 
     def _get_previous_session_data(self):
-        """Obtiene datos de la sesión anterior"""
-        now = datetime.now(pytz.utc)
-        current_time = now.hour * 60 + now.minute
-        
-        # Determinar sesión actual
-        current_session = None
-        for session in self.market_sessions:
-            open_time = session["open"][0] * 60 + session["open"][1]
-            close_time = session["close"][0] * 60 + session["close"][1]
-            
-            if open_time < close_time:
-                if open_time <= current_time < close_time:
-                    current_session = session
-                    break
-            else:
-                if current_time >= open_time or current_time < close_time:
-                    current_session = session
-                    break
-        
-        if current_session is None:
-            raise Exception("No se pudo determinar la sesión actual")
-        
-        print(f"\n🏛️ Sesión actual: {current_session['name']}")
+        """Obtiene datos de la sesión anterior (en caché hasta el próximo cierre de sesión)"""
+        now = datetime.fromtimestamp(self._server_now(), pytz.utc)
+        epoch = int(now.timestamp())
+        # Las sesiones se definen en UTC u hora local; las velas van en hora del servidor
+        zone = self.clock.zone()
         
-        # Encontrar sesión anterior
-        current_idx = next(i for i, s in enumerate(self.market_sessions) if s["name"] == current_session["name"])
-        previous_idx = (current_idx - 1) % len(self.market_sessions)
-        previous_session = self.market_sessions[previous_idx]
+        # Sesión anterior: la última ya cerrada según el calendario
+        previous = self.calendar.previous(epoch, zone)
+        if previous is None:
+            raise Exception("No se pudo determinar la sesión anterior")
+        name, start, end = previous
+        session_start = datetime.fromtimestamp(start, pytz.utc)
+        session_end = datetime.fromtimestamp(end, pytz.utc)
+        cached = self.level_cache.get(self.symbol, "session", session_start, now)
+        if cached is not None:
+            return cached
+        expires = datetime.fromtimestamp(self.calendar.next_close(epoch, zone), pytz.utc)
         
-        print(f"🔍 Sesión anterior detectada: {previous_session['name']}")
+        current = self.calendar.current(epoch, zone)
+        if current is not None:
+            print(f"\n🏛️ Sesión actual: {current[0]}")
         
-        # Calcular rango de tiempo
-        today = now.replace(hour=0, minute=0, second=0, microsecond=0)
-        session_start = today.replace(
-            hour=previous_session["open"][0],
-            minute=previous_session["open"][1],
-            second=0,
-            microsecond=0
-        )
-        session_end = today.replace(
-            hour=previous_session["close"][0],
-            minute=previous_session["close"][1],
-            second=0,
-            microsecond=0
-        )
-        
-        # Ajustes por cambios de día
-        if session_start > now:
-            session_start -= timedelta(days=1)
-        if session_end > now:
-            session_end -= timedelta(days=1)
-        
-        if previous_session["open"][0] > previous_session["close"][0]:
-            session_start -= timedelta(days=1)
+        # Sesión ya agregada vela a vela: el cambio de sesión no consulta al terminal
+        record = self.aggregator.completed_session(start, end)
+        if record is not None:
+            print(f"🔍 Sesión anterior agregada: {name}")
+            data = {
+                "name": name,
+                "high": record['high'],
+                "low": record['low'],
+                "open": record['open'],
+                "close": record['close'],
+                "start": session_start.strftime("%Y-%m-%d %H:%M:%S"),
+                "end": session_end.strftime("%Y-%m-%d %H:%M:%S"),
+                "data_points": record['bars'],
+                "timeframe": self.timeframe
+            }
+            self.level_cache.put(self.symbol, "session", session_start, expires, data)
+            return data
         
+        print(f"🔍 Sesión anterior detectada: {name}")
         print(f"⏳ Rango de sesión: {session_start} a {session_end}")
         
-        # Obtener datos con diferentes timeframes
-        for tf in [self.timeframe, mt5.TIMEFRAME_H1, mt5.TIMEFRAME_D1]:
+        # Obtener datos con diferentes timeframes (la vela que abre al cierre ya es de la sesión siguiente)
+        for tf in [self.timeframe, TIMEFRAME_H1, TIMEFRAME_D1]:
             try:
-                rates = mt5.copy_rates_range(
-                    self.symbol,
-                    tf,
-                    session_start,
-                    session_end
-                )
+                with METRICS.timer("copy_rates_range", self.symbol):
+                    rates = self.source.copy_rates_range(
+                        self.symbol,
+                        tf,
+                        session_start,
+                        session_end - timedelta(seconds=1)
+                    )
                 
                 if rates is not None and len(rates) > 0:
-                    df = pd.DataFrame(rates)
-                    df['time'] = pd.to_datetime(df['time'], unit='s')
+                    bars = BarArray(rates)
                     
                     if tf != self.timeframe:
                         print(f"⚠️ Usando timeframe alternativo ({tf})")
                     
-                    return {
-                        "name": previous_session["name"],
-                        "high": df['high'].max(),
-                        "low": df['low'].min(),
-                        "open": df['open'].iloc[0],
-                        "close": df['close'].iloc[-1],
+                    data = {
+                        "name": name,
+                        "high": bars.high(),
+                        "low": bars.low(),
+                        "open": bars.open(),
+                        "close": bars.close(),
                         "start": session_start.strftime("%Y-%m-%d %H:%M:%S"),
                         "end": session_end.strftime("%Y-%m-%d %H:%M:%S"),
-                        "data_points": len(df),
+                        "data_points": len(bars),
                         "timeframe": tf
                     }
+                    self.level_cache.put(self.symbol, "session", session_start, expires, data)
+                    return data
             except Exception as e:
                 print(f"⚠️ Error con timeframe {tf}: {str(e)}")
                 continue
         
-        raise Exception(f"No se pudieron obtener datos para la sesión {previous_session['name']}")
+        raise Exception(f"No se pudieron obtener datos para la sesión {name}")
 
-    def _get_current_candles(self):
-        """Obtiene las velas actuales"""
+    def _get_current_candles(self, count=3):
+        """Obtiene las velas actuales (las count más recientes, incluida la que está en formación)"""
         print("\n🕯️ Obteniendo velas actuales...")
         
-        rates = mt5.copy_rates_from_pos(
-            self.symbol,
-            self.timeframe,
-            0,  # Posición más reciente
-            3   # Obtener 3 velas
-        )
+        with METRICS.timer("copy_rates_from_pos", self.symbol):
+            rates = self.source.copy_rates_from_pos(
+                self.symbol,
+                self.timeframe,
+                0,  # Posición más reciente
+                count
+            )
         
         if rates is None or len(rates) < 2:
             raise Exception("No se pudieron obtener velas actuales")
         
-        df = pd.DataFrame(rates)
-        df['time'] = pd.to_datetime(df['time'], unit='s')
+        self._update_aggregator(rates)
+        bars = BarArray(rates)
+        
+        print(f"✅ Velas obtenidas: {len(bars)} registros")
+        
+        return {
+            "penultimate": bars.candle(-2),
+            "last": bars.candle(-1),
+            "rates": rates
+        }
+
+    def _update_aggregator(self, rates):
+        """Pliega las velas cerradas; siembra con una única descarga si hace falta"""
+        period = TIMEFRAME_SECONDS[self.timeframe]
+        now = self._server_now()
+        if self.aggregator.fold(rates, period, now):
+            return
         
-        print(f"✅ Velas obtenidas: {len(df)} registros")
+        # Arranque o hueco en los datos: desde el inicio del día anterior al buscado
+        start = (int(now) // 86400 - self.lookback_days - 1) * 86400
+        last_time = self.aggregator.last_time
+        if self.aggregator.period == period and last_time is not None and start <= last_time <= now:
+            # Estado restaurado o hueco corto: solo se piden las velas desde la última procesada
+            print(f"\n📥 Poniendo al día el agregador desde {datetime.fromtimestamp(last_time, pytz.utc)}")
+            with METRICS.timer("copy_rates_range", self.symbol):
+                history = self.source.copy_rates_range(
+                    self.symbol,
+                    self.timeframe,
+                    datetime.fromtimestamp(last_time, pytz.utc),
+                    datetime.fromtimestamp(now, pytz.utc)
+                )
+            if history is not None and len(history) > 0 and self.aggregator.fold(history, period, now):
+                return
         
+        print(f"\n📥 Sembrando agregador de niveles desde {datetime.fromtimestamp(start, pytz.utc)}")
+        with METRICS.timer("copy_rates_range", self.symbol):
+            history = self.source.copy_rates_range(
+                self.symbol,
+                self.timeframe,
+                datetime.fromtimestamp(start, pytz.utc),
+                datetime.fromtimestamp(now, pytz.utc)
+            )
+        if history is None or len(history) == 0:
+            return
+        self.aggregator.seed(history, start, period, now)
+
+    def get_levels(self):
+        """Niveles PDH/PDL/PSH/PSL vigentes (servidos desde la caché)"""
+        previous_day = self._get_previous_day_data()
+        previous_session = self._get_previous_session_data()
         return {
-            "penultimate": df.iloc[-2],
-            "last": df.iloc[-1]
+            "PDH": previous_day['high'],
+            "PDL": previous_day['low'],
+            "PSH": previous_session['high'],
+            "PSL": previous_session['low']
         }
 
     def analyze_signals(self):
+        """Textos de las señales detectadas en las velas actuales"""
+        return [SIGNAL_LABELS[breakout.kind] for breakout in self.detect_breakouts()]
+
+    def detect_breakouts(self):
         """Análisis completo con manejo de errores mejorado"""
         try:
             print("\n🔎 Iniciando análisis de señales...")
             
+            # Las velas se piden primero para que el agregador esté al día
+            candles = self._get_current_candles()
+            
             # 1. Obtener datos del día anterior
-            previous_day = self._get_previous_day_data()
+            with METRICS.timer("day_levels", self.symbol):
+                previous_day = self._get_previous_day_data()
             print(f"\n📅 DÍA ANTERIOR ({previous_day['date']}):")
             print(f"• Open: {previous_day['open']}")
             print(f"• High: {previous_day['high']}")
@@ -257,7 +1857,8 @@ class TradingSignalController:
             print(f"• Close: {previous_day['close']}")
             
             # 2. Obtener datos de la sesión anterior
-            previous_session = self._get_previous_session_data()
+            with METRICS.timer("session_levels", self.symbol):
+                previous_session = self._get_previous_session_data()
             print(f"\n🏛️ SESIÓN ANTERIOR ({previous_session['name']}):")
             print(f"• Horario: {previous_session['start']} a {previous_session['end']}")
             print(f"• Velas analizadas: {previous_session['data_points']}")
@@ -268,8 +1869,7 @@ class TradingSignalController:
             print(f"• Low: {previous_session['low']}")
             print(f"• Close: {previous_session['close']}")
             
-            # 3. Obtener velas actuales
-            candles = self._get_current_candles()
+            # 3. Velas actuales
             print(f"\n🕯️ VELAS ACTUALES ({self.timeframe_min} min):")
             print("Penúltima vela:")
             print(f"• Open: {candles['penultimate']['open']}")
@@ -283,36 +1883,26 @@ class TradingSignalController:
             print(f"• Close: {candles['last']['close']}")
             
             # 4. Generar señales
+            self.levels = {
+                "PDH": previous_day['high'],
+                "PDL": previous_day['low'],
+                "PSH": previous_session['high'],
+                "PSL": previous_session['low']
+            }
+            self.price = candles['last']['close']
+            # Un solo símbolo: comprobación escalar (crear arrays NumPy costaría más que evaluar)
             signals = []
-            # Señales basadas en día anterior
-            if ((candles['penultimate']['high'] >= previous_day['high'] and 
-                candles['penultimate']['low'] < previous_day['high']) or 
-                (candles['last']['high'] >= previous_day['high'] and 
-                candles['last']['low'] < previous_day['high'])):
-                signals.append("RUPTURA PDH (Previous Day High)")
-                print("🚨 Señal detectada: RUPTURA PDH")
-
-            if ((candles['penultimate']['high'] > previous_day['low'] and 
-                candles['penultimate']['low'] <= previous_day['low']) or 
-                (candles['last']['high'] > previous_day['low'] and 
-                candles['last']['low'] <= previous_day['low'])):
-                signals.append("RUPTURA PDL (Previous Day Low)")
-                print("🚨 Señal detectada: RUPTURA PDL")
-
-            # Señales basadas en sesión anterior
-            if ((candles['penultimate']['high'] >= previous_session['high'] and 
-                candles['penultimate']['low'] < previous_session['high']) or 
-                (candles['last']['high'] >= previous_session['high'] and 
-                candles['last']['low'] < previous_session['high'])):
-                signals.append("RUPTURA PSH (Previous Session High)")
-                print("🚨 Señal detectada: RUPTURA PSH")
-
-            if ((candles['penultimate']['high'] > previous_session['low'] and 
-                candles['penultimate']['low'] <= previous_session['low']) or 
-                (candles['last']['high'] > previous_session['low'] and 
-                candles['last']['low'] <= previous_session['low'])):
-                signals.append("RUPTURA PSL (Previous Session Low)")
-                print("🚨 Señal detectada: RUPTURA PSL")
+            with METRICS.timer("evaluate", self.symbol):
+                for kind in LEVEL_KINDS:
+                    level = self.levels[kind]
+                    upper = kind.endswith("H")
+                    # Se asocia la ruptura a la vela más reciente que la contiene
+                    for candle in (candles['last'], candles['penultimate']):
+                        if candle_breaks(candle, level, upper):
+                            signals.append(Breakout(self.symbol, kind, level, self.price, candle['time']))
+                            break
+            for breakout in signals:
+                print(f"🚨 Señal detectada: RUPTURA {breakout.kind}")
             if not signals:
                 print("🔍 No se detectaron señales de ruptura")
             
@@ -322,100 +1912,1713 @@ class TradingSignalController:
             print(f"❌ Error en análisis: {str(e)}")
             return []
 
+    def detect_timeframe_breakouts(self, timeframes_min):
+        """Rupturas en varios timeframes con una única descarga de velas del timeframe base.
+
+        Las velas de cada timeframe se obtienen re-muestreando las del
+        analizador (normalmente M1) y se evalúan todas a la vez con
+        breakout_mask, una columna por timeframe. Devuelve {minutos: [Breakout]}.
+        """
+        try:
+            print(f"\n🔎 Iniciando análisis multi-timeframe {list(timeframes_min)}...")
+            base = TIMEFRAME_SECONDS[self.timeframe]
+            periods = [minutes * 60 for minutes in timeframes_min]
+            if any(period % base for period in periods):
+                raise Exception("Los timeframes deben ser múltiplos del timeframe base")
+            
+            # Dos velas completas del timeframe mayor más la vela en formación
+            candles = self._get_current_candles(2 * max(periods) // base + 1)
+            with METRICS.timer("levels", self.symbol):
+                self.levels = self.get_levels()
+            self.price = candles['last']['close']
+            
+            highs = np.empty((2, len(periods)))
+            lows = np.empty((2, len(periods)))
+            times = np.empty((2, len(periods)), dtype=np.int64)
+            for column, period in enumerate(periods):
+                bars = candles['rates'] if period == base else resample_rates(candles['rates'], period)
+                if len(bars) < 2:
+                    raise Exception(f"Velas insuficientes para el timeframe de {period // 60} min")
+                highs[:, column] = bars['high'][-2:]
+                lows[:, column] = bars['low'][-2:]
+                times[:, column] = bars['time'][-2:]
+            
+            levels = np.repeat(np.array([[self.levels[kind]] for kind in LEVEL_KINDS]), len(periods), axis=1)
+            with METRICS.timer("evaluate", self.symbol):
+                mask = breakout_mask(highs, lows, levels)
+            
+            results = {}
+            for column, minutes in enumerate(timeframes_min):
+                signals = []
+                for i, kind in enumerate(LEVEL_KINDS):
+                    if not mask[:, i, column].any():
+                        continue
+                    row = 1 if mask[1, i, column] else 0
+                    signals.append(Breakout(self.symbol, kind, self.levels[kind], self.price, int(times[row, column])))
+                    print(f"🚨 Señal detectada: RUPTURA {kind} ({minutes} min)")
+                results[minutes] = signals
+            if not any(results.values()):
+                print("🔍 No se detectaron señales de ruptura")
+            return results
+            
+        except Exception as e:
+            print(f"❌ Error en análisis: {str(e)}")
+            return {}
+
+class LevelState:
+    """Estado de alerta de un nivel concreto de un símbolo"""
+    __slots__ = ("level", "armed", "last_time")
+
+    def __init__(self, level):
+        self.level = level
+        self.armed = True
+        self.last_time = 0
+
+class SignalStateMachine:
+    """Dispara una sola vez por cruce de cada (símbolo, nivel).
+
+    Un nivel se rearma cuando el precio se aleja al menos la distancia
+    configurada o cuando el propio nivel cambia (cambio de día o de sesión).
+    """
+    def __init__(self):
+        self.states = {}
+
+    def process(self, symbol, levels, price, breakouts, distance):
+        """Filtra las rupturas y devuelve solo las que deben alertarse"""
+        hits = {breakout.kind: breakout for breakout in breakouts}
+        fired = []
+        for kind, level in levels.items():
+            state = self.states.get((symbol, kind))
+            if state is None or state.level != level:
+                state = LevelState(level)
+                self.states[(symbol, kind)] = state
+            
+            breakout = hits.get(kind)
+            if breakout is not None and breakout.candle_time <= state.last_time:
+                # Una vela o tick ya visto no vuelve a disparar tras el rearme
+                breakout = None
+            
+            if state.armed:
+                if breakout is not None:
+                    state.armed = False
+                    fired.append(breakout)
+            elif price is not None and abs(price - level) >= distance:
+                state.armed = True
+            
+            if breakout is not None:
+                state.last_time = breakout.candle_time
+        return fired
+
+    def export(self):
+        """Estados en formato JSON: [símbolo, nivel, valor, armado, última vela]"""
+        return [
+            [symbol, kind, float(state.level), state.armed, float(state.last_time)]
+            for (symbol, kind), state in list(self.states.items())
+        ]
+
+    def restore(self, states):
+        for symbol, kind, level, armed, last_time in states:
+            state = LevelState(level)
+            state.armed = armed
+            state.last_time = last_time
+            self.states[(symbol, kind)] = state
+
+# Señal del backtest: vela que rompe, hora de detección (cierre de la vela) y nivel
+BACKTEST_DTYPE = np.dtype([
+    ('time', '<i8'), ('detected', '<i8'), ('kind', 'U3'), ('level', '<f8'),
+    ('high', '<f8'), ('low', '<f8'), ('close', '<f8')
+])
+
+def group_starts(keys):
+    """Índice de inicio de cada tramo consecutivo de claves iguales"""
+    return np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+
+def group_extremes(keys, highs, lows):
+    """Tramo de cada vela y máximo/mínimo de cada tramo"""
+    starts = group_starts(keys)
+    group = np.repeat(np.arange(len(starts)), np.diff(np.append(starts, len(keys))))
+    return group, np.maximum.reduceat(highs, starts), np.minimum.reduceat(lows, starts)
+
+def previous_group_levels(keys, highs, lows):
+    """Máximo y mínimo del tramo anterior para cada vela (NaN en el primer tramo)"""
+    group, group_high, group_low = group_extremes(keys, highs, lows)
+    return (np.concatenate(([np.nan], group_high))[group],
+            np.concatenate(([np.nan], group_low))[group])
+
+def resample_rates(rates, period_seconds):
+    """Agrupa velas en cubos de period_seconds alineados a epoch (p. ej. M1 -> M5/M15/H1)"""
+    rates = np.asarray(rates)
+    if len(rates) == 0:
+        return np.zeros(0, dtype=RATES_DTYPE)
+    buckets = rates['time'].astype(np.int64) // period_seconds
+    starts = group_starts(buckets)
+    ends = np.append(starts[1:], len(rates)) - 1
+    result = np.zeros(len(starts), dtype=RATES_DTYPE)
+    result['time'] = buckets[starts] * period_seconds
+    result['open'] = rates['open'][starts]
+    result['high'] = np.maximum.reduceat(rates['high'], starts)
+    result['low'] = np.minimum.reduceat(rates['low'], starts)
+    result['close'] = rates['close'][ends]
+    result['tick_volume'] = np.add.reduceat(rates['tick_volume'], starts)
+    result['spread'] = rates['spread'][ends]
+    result['real_volume'] = np.add.reduceat(rates['real_volume'], starts)
+    return result
+
+class BreakoutBacktester:
+    """Backtest vectorizado de las rupturas PDH/PDL/PSH/PSL sobre un histórico M1/M5.
+
+    Calcula los máximos y mínimos del día UTC y de la sesión anterior con
+    reducciones agrupadas y aplica breakout_mask -las mismas reglas que el
+    análisis en vivo- a todas las velas en una sola pasada. Como en vivo,
+    cada vela se evalúa contra los niveles vigentes en su apertura; se toma
+    como día o sesión anterior el último tramo con datos (fines de semana).
+    zone es el huso del servidor (segundos respecto a UTC) en que van las velas.
+    """
+    def __init__(self, market_sessions=None, edge_only=True, zone=0):
+        self.calendar = SessionCalendar(market_sessions)
+        self.market_sessions = self.calendar.sessions
+        self.zone = zone
+        # Solo la primera vela de cada racha que toca el mismo nivel genera señal
+        self.edge_only = edge_only
+
+    def _session_starts(self, times):
+        """Inicio (epoch) de la sesión a la que pertenece cada vela; -1 si no hay sesión"""
+        return self.calendar.session_starts(times, self.zone)
+
+    def levels(self, rates):
+        """Niveles vigentes para cada vela como array (4, N) en el orden de LEVEL_KINDS"""
+        times = rates['time'].astype(np.int64)
+        highs = rates['high']
+        lows = rates['low']
+        levels = np.empty((len(LEVEL_KINDS), len(rates)))
+        levels[0], levels[1] = previous_group_levels(times // 86400, highs, lows)
+        
+        # Las velas fuera de sesión no forman tramo propio: como SessionCalendar.previous
+        # en vivo, la sesión anterior es siempre la última sesión real cerrada
+        sessions = self._session_starts(times)
+        levels[2:] = np.nan
+        inside = np.flatnonzero(sessions >= 0)
+        if len(inside) == 0:
+            return levels
+        group, group_high, group_low = group_extremes(sessions[inside], highs[inside], lows[inside])
+        levels[2, inside] = np.concatenate(([np.nan], group_high))[group]
+        levels[3, inside] = np.concatenate(([np.nan], group_low))[group]
+        # Fuera de sesión rige la sesión de la última vela en sesión anterior a la vela
+        outside = np.flatnonzero(sessions < 0)
+        last = np.searchsorted(inside, outside) - 1
+        outside, last = outside[last >= 0], last[last >= 0]
+        levels[2, outside] = group_high[group[last]]
+        levels[3, outside] = group_low[group[last]]
+        return levels
+
+    def run(self, rates, timeframe_seconds=60):
+        """Señales de un símbolo como array estructurado BACKTEST_DTYPE en orden cronológico"""
+        rates = np.asarray(rates)
+        if len(rates) == 0:
+            return np.zeros(0, dtype=BACKTEST_DTYPE)
+        levels = self.levels(rates)
+        hits = breakout_mask(rates['high'][None, :], rates['low'][None, :], levels)[0]
+        if self.edge_only:
+            # Una racha de velas sobre el mismo nivel cuenta como un solo cruce
+            repeated = np.zeros_like(hits)
+            repeated[:, 1:] = hits[:, :-1] & (levels[:, 1:] == levels[:, :-1])
+            hits &= ~repeated
+        
+        bars, kinds = np.nonzero(hits.T)
+        report = np.zeros(len(bars), dtype=BACKTEST_DTYPE)
+        report['time'] = rates['time'][bars]
+        report['detected'] = report['time'] + timeframe_seconds
+        report['kind'] = np.asarray(LEVEL_KINDS)[kinds]
+        report['level'] = levels[kinds, bars]
+        report['high'] = rates['high'][bars]
+        report['low'] = rates['low'][bars]
+        report['close'] = rates['close'][bars]
+        return report
+
+    def run_many(self, history, timeframe_seconds=60):
+        """Ejecuta el backtest para {símbolo: velas}"""
+        return {symbol: self.run(rates, timeframe_seconds) for symbol, rates in history.items()}
+
+    def run_store(self, store, symbols, timeframe=TIMEFRAME_M1):
+        """Ejecuta el backtest sobre el histórico del almacén local"""
+        return {
+            symbol: self.run(store.read(symbol, timeframe), TIMEFRAME_SECONDS[timeframe])
+            for symbol in symbols
+        }
+
+    @staticmethod
+    def summary(reports):
+        """Número de señales por símbolo y nivel"""
+        return {
+            symbol: {kind: int(np.count_nonzero(report['kind'] == kind)) for kind in LEVEL_KINDS}
+            for symbol, report in reports.items()
+        }
+
+    @staticmethod
+    def to_csv(reports, path):
+        """Exporta el informe señal a señal"""
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write("symbol,kind,level,candle_time,detected_time,high,low,close\n")
+            for symbol, report in reports.items():
+                for row in report:
+                    candle = datetime.fromtimestamp(int(row['time']), pytz.utc).strftime("%Y-%m-%d %H:%M:%S")
+                    detected = datetime.fromtimestamp(int(row['detected']), pytz.utc).strftime("%Y-%m-%d %H:%M:%S")
+                    f.write(f"{symbol},{row['kind']},{row['level']},{candle},{detected},"
+                            f"{row['high']},{row['low']},{row['close']}\n")
+
+class TickBreakoutWatcher:
+    """Detección de rupturas en tiempo real comparando cada tick con los niveles en caché"""
+    def __init__(self, connection, timeframe_min, on_signal, poll_interval=0.25,
+                 signal_state=None, rearm_points=100, journal=None, tick_batch=10000):
+        self.connection = connection
+        self.timeframe_min = timeframe_min
+        self.on_signal = on_signal
+        self.poll_interval = poll_interval
+        self.signal_state = signal_state if signal_state is not None else SignalStateMachine()
+        self.rearm_points = rearm_points
+        self.journal = journal
+        self.tick_batch = tick_batch
+        self.last_bid = {}
+        self.last_tick_msc = {}
+        self.evaluator = BatchLevelEvaluator()
+
+    def _read_symbol(self, column, symbol):
+        """Carga en el evaluador el recorrido del bid desde el tick anterior"""
+        name = self.connection.symbol_index.resolve(symbol) or symbol
+        with METRICS.timer("symbol_info_tick", symbol):
+            tick = self.connection.source.symbol_info_tick(name)
+        last_msc = self.last_tick_msc.get(symbol)
+        if tick is None or tick.time_msc == last_msc:
+            return None
+        self.last_tick_msc[symbol] = tick.time_msc
+        self.connection.clock.sync(tick.time_msc / 1000.0)
+        
+        # Las velas de MT5 se construyen con el bid: se compara el mismo precio
+        previous = self.last_bid.get(symbol)
+        self.last_bid[symbol] = tick.bid
+        if previous is None:
+            return None
+        
+        # Entre dos sondeos pueden llegar varios ticks: un cruce que vuelve
+        # antes del siguiente sondeo también cuenta
+        high, low = max(previous, tick.bid), min(previous, tick.bid)
+        with METRICS.timer("copy_ticks_from", symbol):
+            ticks = self.connection.source.copy_ticks_from(
+                name, datetime.fromtimestamp(last_msc / 1000.0, pytz.utc), self.tick_batch, COPY_TICKS_ALL)
+        if ticks is not None and len(ticks):
+            bids = ticks['bid'][(ticks['time_msc'] > last_msc) & (ticks['time_msc'] <= tick.time_msc)
+                                & (ticks['bid'] > 0)]
+            if len(bids):
+                high, low = max(high, float(bids.max())), min(low, float(bids.min()))
+        
+        analyzer = self.connection.get_analyzer(symbol, self.timeframe_min)
+        levels = analyzer.get_levels()
+        # El recorrido desde el sondeo anterior se evalúa como una vela con las mismas reglas
+        self.evaluator.set_column(column, (high,), (low,), levels)
+        return analyzer, levels, tick
+
+    def poll(self, symbols):
+        """Revisa el último tick de cada símbolo y evalúa todos en una sola pasada"""
+        if self.evaluator.symbols != symbols:
+            self.evaluator.set_symbols(symbols, candles=1)
+        self.evaluator.reset()
+        
+        updates = {}
+        for column, symbol in enumerate(symbols):
+            try:
+                update = self._read_symbol(column, symbol)
+            except Exception as e:
+                print(f"⚠️ Error procesando ticks de {symbol}: {str(e)}")
+                continue
+            if update is not None:
+                updates[column] = update
+        if not updates:
+            return
+        
+        mask = self.evaluator.evaluate()
+        for column, (analyzer, levels, tick) in updates.items():
+            symbol = symbols[column]
+            breakouts = [
+                Breakout(symbol, kind, levels[kind], tick.bid, tick.time_msc / 1000.0)
+                for kind in self.evaluator.kinds(mask[column])
+            ]
+            distance = self.rearm_points * analyzer.point
+            for breakout in self.signal_state.process(symbol, levels, tick.bid, breakouts, distance):
+                now = self.connection.source.time()
+                # El tick lleva la hora del servidor
+                METRICS.observe("tick_to_alert", self.connection.clock.time() - breakout.candle_time, symbol)
+                if self.journal is not None:
+                    self.journal.record(symbol, breakout, self.timeframe_min, now)
+                print(f"🚨 Señal por tick en {symbol}: {breakout.kind} {breakout.level} (bid {tick.bid})")
+                self.on_signal(symbol, SIGNAL_LABELS[breakout.kind])
+
+    def run(self, symbols, stop_event, duration, wake_event=None):
+        """Vigila los ticks durante duration segundos, hasta la parada o hasta wake_event"""
+        deadline = time.monotonic() + duration
+        while (not stop_event.is_set() and time.monotonic() < deadline
+               and not (wake_event is not None and wake_event.is_set())):
+            self.poll(symbols)
+            stop_event.wait(self.poll_interval)
+
+class AlertJournal:
+    """Historial de alertas en SQLite (modo WAL) escrito por lotes.
+
+    Los hilos de análisis solo encolan; un hilo escritor agrupa las alertas
+    que llegan durante interval segundos y las inserta en una transacción.
+    Los índices por (símbolo, hora) y por hora mantienen rápidas las
+    consultas por rango sobre meses de datos, y las páginas se recorren por
+    clave (detected, id), sin OFFSET ni cargar el historial en memoria.
+    """
+    COLUMNS = ("id", "symbol", "kind", "level", "price", "timeframe", "candle_time", "detected")
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS alerts (
+            id INTEGER PRIMARY KEY,
+            symbol TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            level REAL NOT NULL,
+            price REAL,
+            timeframe INTEGER NOT NULL,
+            candle_time REAL NOT NULL,
+            detected REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS alerts_symbol_detected ON alerts (symbol, detected, id);
+        CREATE INDEX IF NOT EXISTS alerts_detected ON alerts (detected, id);
+    """
+
+    def __init__(self, path=JOURNAL_FILE, batch_size=500, interval=1.0):
+        self.path = path
+        self.batch_size = batch_size
+        self.interval = interval
+        self.queue = queue.Queue()
+        self.written = 0
+        with closing(self._connect()) as db:
+            db.executescript(self.SCHEMA)
+        self.thread = threading.Thread(target=self._run, name="historial", daemon=True)
+        self.thread.start()
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=10)
+        # WAL: las consultas del historial no bloquean al escritor
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        return db
+
+    def record(self, symbol, breakout, timeframe, detected=None):
+        """Encola una alerta disparada; no hace E/S en el hilo que llama"""
+        self.queue.put((
+            symbol, breakout.kind, float(breakout.level),
+            None if breakout.price is None else float(breakout.price),
+            int(timeframe), float(breakout.candle_time),
+            time.time() if detected is None else float(detected)
+        ))
+
+    def _run(self):
+        db = self._connect()
+        try:
+            stopping = False
+            while not stopping:
+                item = self.queue.get()
+                if item is None:
+                    break
+                batch = [item]
+                deadline = time.monotonic() + self.interval
+                while len(batch) < self.batch_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    try:
+                        item = self.queue.get(timeout=remaining)
+                    except queue.Empty:
+                        break
+                    if item is None:
+                        stopping = True
+                        break
+                    batch.append(item)
+                self._write(db, batch)
+        finally:
+            db.close()
+
+    def _write(self, db, batch):
+        try:
+            with db:
+                db.executemany(
+                    "INSERT INTO alerts (symbol, kind, level, price, timeframe, candle_time, detected) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)", batch)
+            self.written += len(batch)
+        except sqlite3.Error as e:
+            print(f"⚠️ Error guardando {len(batch)} alerta(s) en el historial: {e}")
+
+    def close(self):
+        """Escribe las alertas pendientes y detiene el hilo escritor"""
+        self.queue.put(None)
+        self.thread.join(timeout=10)
+
+    @staticmethod
+    def _where(symbol=None, kind=None, since=None, until=None):
+        """Cláusula WHERE y parámetros de los filtros (símbolo o lista de símbolos; fechas en datetime o epoch)"""
+        clauses, params = [], []
+        if isinstance(symbol, (list, tuple)):
+            clauses.append(f"symbol IN ({', '.join('?' * len(symbol))})")
+            params.extend(symbol)
+        elif symbol:
+            clauses.append("symbol = ?")
+            params.append(symbol)
+        if kind:
+            clauses.append("kind = ?")
+            params.append(kind)
+        if since is not None:
+            clauses.append("detected >= ?")
+            params.append(to_epoch(since))
+        if until is not None:
+            clauses.append("detected < ?")
+            params.append(to_epoch(until))
+        return clauses, params
+
+    def query(self, symbol=None, kind=None, since=None, until=None, after=None, limit=HISTORY_PAGE_SIZE):
+        """Página de alertas, de la más reciente a la más antigua.
+
+        after es la clave (detected, id) de la última fila de la página
+        anterior; la consulta continúa desde ella recorriendo el índice.
+        """
+        clauses, params = self._where(symbol, kind, since, until)
+        if after is not None:
+            # detected <= ? acota el rango del índice; el resto desempata por id
+            clauses.append("detected <= ? AND (detected < ? OR id < ?)")
+            params.extend((after[0], after[0], after[1]))
+        where = f" WHERE {' AND '.join(clauses)}" if clauses else ""
+        with closing(sqlite3.connect(self.path, timeout=10)) as db:
+            rows = db.execute(
+                f"SELECT {', '.join(self.COLUMNS)} FROM alerts{where} "
+                f"ORDER BY detected DESC, id DESC LIMIT ?", params + [limit]).fetchall()
+        return [dict(zip(self.COLUMNS, row)) for row in rows]
+
+    def counts(self, symbol=None, kind=None, since=None, until=None):
+        """Número de alertas por (símbolo, nivel) en el rango indicado"""
+        clauses, params = self._where(symbol, kind, since, until)
+        where = f" WHERE {' AND '.join(clauses)}" if clauses else ""
+        with closing(sqlite3.connect(self.path, timeout=10)) as db:
+            rows = db.execute(f"SELECT symbol, kind, COUNT(*) FROM alerts{where} GROUP BY symbol, kind",
+                              params).fetchall()
+        return {(symbol_, kind_): count for symbol_, kind_, count in rows}
+
+    def export_csv(self, path, symbol=None, kind=None, since=None, until=None):
+        """Vuelca las alertas filtradas a CSV fila a fila; devuelve cuántas se exportaron"""
+        clauses, params = self._where(symbol, kind, since, until)
+        where = f" WHERE {' AND '.join(clauses)}" if clauses else ""
+        count = 0
+        with closing(sqlite3.connect(self.path, timeout=10)) as db, \
+                open(path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(("symbol", "kind", "level", "price", "timeframe", "candle_time", "detected"))
+            cursor = db.execute(
+                f"SELECT symbol, kind, level, price, timeframe, candle_time, detected FROM alerts{where} "
+                f"ORDER BY detected, id", params)
+            for symbol_, kind_, level, price, timeframe, candle_time, detected in cursor:
+                writer.writerow((
+                    symbol_, kind_, level, price, timeframe,
+                    datetime.fromtimestamp(candle_time, pytz.utc).strftime("%Y-%m-%d %H:%M:%S"),
+                    datetime.fromtimestamp(detected, pytz.utc).strftime("%Y-%m-%d %H:%M:%S")
+                ))
+                count += 1
+        return count
+
+class ConfigStore:
+    """Configuración persistente en JSON legible.
+
+    La configuración publicada es un dict de solo lectura que nunca se
+    modifica en sitio: cada cambio crea una copia nueva y la publica con una
+    única asignación, así el motor lee una instantánea coherente sin locks
+    mientras la interfaz la cambia. Las escrituras se agrupan (debounce) y
+    son atómicas; los cambios hechos a mano en el fichero se recargan en
+    caliente con watch() y se notifican a los suscriptores.
+    """
+    def __init__(self, path=CONFIG_FILE, defaults=None, legacy_path=LEGACY_CONFIG_FILE, delay=1.0):
+        self.path = path
+        self.legacy_path = legacy_path
+        self.delay = delay
+        # Valores por defecto en su forma JSON (tuplas -> listas) para compararlos con los del fichero
+        self.defaults = json.loads(json.dumps(defaults or {}))
+        # Valores guardados y ajustes solo de esta ejecución (p. ej. argumentos de línea de comandos)
+        self.values = {}
+        self.overrides = {}
+        # Claves cambiadas aún no escritas en disco
+        self.pending = set()
+        self.data = MappingProxyType(dict(self.defaults))
+        self.lock = threading.RLock()
+        self.listeners = []
+        self.timer = None
+        self.file_stamp = None
+        self.watcher = None
+        self.load()
+
+    def _stamp(self):
+        """(mtime, tamaño) del fichero para detectar ediciones externas"""
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def _publish(self):
+        """Publica una copia nueva (con el lock tomado) y devuelve las claves cambiadas"""
+        merged = dict(self.defaults)
+        merged.update(self.values)
+        merged.update(self.overrides)
+        previous = self.data
+        self.data = MappingProxyType(merged)
+        return {key for key in merged if key not in previous or previous[key] != merged[key]}
+
+    def _notify(self, changed):
+        if not changed:
+            return
+        for listener in list(self.listeners):
+            try:
+                listener(changed)
+            except Exception as e:
+                print(f"⚠️ Error aplicando la configuración: {e}")
+
+    def load(self):
+        """Lee el fichero JSON o, si aún no existe, migra la configuración pickle anterior"""
+        migrated = False
+        try:
+            if os.path.exists(self.path):
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    values = json.load(f)
+            elif self.legacy_path and os.path.exists(self.legacy_path):
+                with open(self.legacy_path, 'rb') as f:
+                    values = pickle.load(f)
+                migrated = True
+            else:
+                values = {}
+        except Exception as e:
+            print(f"Error cargando configuración: {e}")
+            return
+        with self.lock:
+            self.values = dict(values)
+            self.file_stamp = self._stamp()
+            self._publish()
+            if migrated:
+                print(f"🔁 Configuración migrada de {self.legacy_path} a {self.path}")
+                self.pending.update(self.values)
+                self.flush()
+
+    def subscribe(self, listener):
+        """listener(claves_cambiadas) se llama tras cada cambio publicado"""
+        self.listeners.append(listener)
+
+    def unsubscribe(self, listener):
+        if listener in self.listeners:
+            self.listeners.remove(listener)
+
+    def update(self, changes):
+        """Cambia valores guardados: se publican al instante y se escriben con retardo"""
+        with self.lock:
+            self.values.update(changes)
+            # Un cambio explícito prevalece sobre los ajustes de esta ejecución
+            for key in changes:
+                self.overrides.pop(key, None)
+            changed = self._publish()
+            if changed:
+                self.pending.update(changed)
+                self._schedule_save()
+        self._notify(changed)
+
+    def override(self, changes):
+        """Ajustes solo de esta ejecución: se publican pero nunca se escriben"""
+        with self.lock:
+            self.overrides.update(changes)
+            changed = self._publish()
+        self._notify(changed)
+
+    def _schedule_save(self):
+        """Reprograma la escritura: una ráfaga de cambios produce una sola"""
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer = threading.Timer(self.delay, self.flush)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def flush(self):
+        """Escribe ya los cambios pendientes (fichero temporal + os.replace)"""
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            if not self.pending:
+                return
+            values = dict(self.defaults)
+            values.update(self.values)
+            temporary = f"{self.path}.tmp"
+            try:
+                with open(temporary, 'w', encoding='utf-8') as f:
+                    json.dump(values, f, indent=2, ensure_ascii=False)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(temporary, self.path)
+                self.pending.clear()
+                self.file_stamp = self._stamp()
+            except Exception as e:
+                print(f"Error guardando configuración: {e}")
+
+    def reload(self):
+        """Recarga el fichero si se ha modificado fuera de la aplicación"""
+        stamp = self._stamp()
+        if stamp is None or stamp == self.file_stamp:
+            return False
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                values = json.load(f)
+        except (OSError, ValueError) as e:
+            # Fichero a medio editar: se reintenta cuando vuelva a cambiar
+            print(f"⚠️ Configuración ilegible, se mantiene la actual: {e}")
+            self.file_stamp = stamp
+            return False
+        with self.lock:
+            self.file_stamp = stamp
+            # Los cambios propios aún no escritos se conservan sobre los del fichero
+            values.update({key: self.values[key] for key in self.pending if key in self.values})
+            self.values = values
+            changed = self._publish()
+        if changed:
+            print(f"🔄 Configuración recargada: {', '.join(sorted(changed))}")
+        self._notify(changed)
+        return True
+
+    def watch(self, interval=2.0):
+        """Vigila el fichero en un hilo propio (una sola vez por almacén)"""
+        if self.watcher is not None:
+            return
+        
+        def loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.reload()
+                except Exception as e:
+                    print(f"⚠️ Error recargando la configuración: {e}")
+        
+        self.watcher = threading.Thread(target=loop, name="configuracion", daemon=True)
+        self.watcher.start()
+
+    def close(self):
+        """Escribe los cambios pendientes antes de salir"""
+        self.flush()
+
 class TradingAlarmModel:
     def __init__(self):
         self.monitoring_active = False
         self.monitoring_thread = None
-        self.config = {
+        self.connection = None
+        self.connection_key = None
+        self.executor = None
+        self.executor_workers = 0
+        self.signal_state = SignalStateMachine()
+        # Sonido decodificado una sola vez: (ruta, mtime, tamaño) -> pygame.mixer.Sound
+        self.sound = None
+        self.sound_key = None
+        self.sound_channel = None
+        self.last_sound = 0.0
+        self.store = ConfigStore(defaults={
             'selected_pairs': FOREX_PAIRS.copy(),
             'timeframe': 5,
             'audio_file': None,
             'mt5_server': 'MetaQuotes-Demo',
             'mt5_login': '94099863',  # Guardado como string para la interfaz
-            'mt5_password': ''
-        }
-        self.load_config()
+            'mt5_password': '',
+            'analysis_workers': 4,
+            'candle_close_delay': 2,  # Segundos tras el cierre de vela
+            'detection_mode': 'bars',
+            'tick_poll_interval': 0.25,
+            'multi_timeframe': False,  # Vigila varios timeframes con una sola descarga M1
+            'multi_timeframes': [1, 5, 15, 60],
+            'rearm_points': 100,  # Distancia (en puntos) para rearmar un nivel ya alertado
+            'data_source': 'mt5',  # 'mt5' (terminal en vivo) o 'replay' (datos grabados)
+            'replay_dir': 'replay_data',
+            'replay_speed': 60.0,
+            'bar_store_dir': 'bar_store',  # Vacío para desactivar el almacén local
+            'market_sessions': MARKET_SESSIONS,
+            'sound_min_interval': 3.0,  # Segundos mínimos entre dos reproducciones
+            'notification_sinks': [],  # Textos de create_sink() o dicts {"type": "email", ...}
+            'metrics_port': 0,  # Puerto local de /metrics; 0 lo desactiva
+            'snapshot_interval': 60,  # Segundos entre instantáneas del estado; 0 las desactiva
+            'alert_journal': JOURNAL_FILE  # Historial SQLite de alertas; vacío lo desactiva
+        })
+        self.journal = None
+        if self.config['alert_journal']:
+            try:
+                self.journal = AlertJournal(self.config['alert_journal'])
+            except sqlite3.Error as e:
+                print(f"⚠️ Historial de alertas desactivado: {e}")
+        self.load_sound()
         
-    def load_config(self):
-        try:
-            if os.path.exists(CONFIG_FILE):
-                with open(CONFIG_FILE, 'rb') as f:
-                    self.config = pickle.load(f)
-        except Exception as e:
-            print(f"Error cargando configuración: {e}")
-            
-    def save_config(self):
-        try:
-            with open(CONFIG_FILE, 'wb') as f:
-                pickle.dump(self.config, f)
-        except Exception as e:
-            print(f"Error guardando configuración: {e}")
+    @property
+    def config(self):
+        """Instantánea de solo lectura de la configuración vigente"""
+        return self.store.data
+        
+    def update_config(self, **changes):
+        """Publica los cambios al instante; el fichero se escribe con retardo"""
+        self.store.update(changes)
+        
+    def close(self):
+        if self.journal is not None:
+            self.journal.close()
+        self.store.close()
+        
+    def record_alerts(self, symbol, breakouts, timeframe, detected=None):
+        """Anota en el historial las alertas disparadas"""
+        if self.journal is None:
+            return
+        for breakout in breakouts:
+            self.journal.record(symbol, breakout, timeframe, detected)
             
     def set_audio_file(self, audio_file):
-        self.config['audio_file'] = audio_file
-        self.save_config()
+        self.update_config(audio_file=audio_file)
+        self.load_sound()
         
     def set_timeframe(self, timeframe):
-        self.config['timeframe'] = timeframe
-        self.save_config()
+        self.update_config(timeframe=timeframe)
         
     def set_selected_pairs(self, pairs):
-        self.config['selected_pairs'] = pairs
-        self.save_config()
+        self.update_config(selected_pairs=list(pairs))
+        
+    def set_analysis_workers(self, workers):
+        self.update_config(analysis_workers=max(1, int(workers)))
+        
+    def set_detection_mode(self, mode):
+        self.update_config(detection_mode=mode)
+        
+    def set_multi_timeframe(self, enabled):
+        self.update_config(multi_timeframe=bool(enabled))
+        
+    def cycle_timeframe(self, config=None):
+        """Minutos entre ciclos: el timeframe menor vigilado"""
+        config = config if config is not None else self.config
+        if config['multi_timeframe']:
+            return min(config['multi_timeframes'])
+        return config['timeframe']
         
     def set_mt5_credentials(self, login, password, server):
         """Valida y guarda las credenciales MT5"""
         try:
             # Validar que el login sea numérico
             int(login)
-            self.config['mt5_login'] = login
-            self.config['mt5_password'] = password
-            self.config['mt5_server'] = server
-            self.save_config()
+            self.update_config(mt5_login=login, mt5_password=password, mt5_server=server)
         except ValueError:
             raise ValueError("El login de MT5 debe ser un número")
             
-    def analyze_pair(self, symbol):
-        """Usa la clase TradingSignalController para analizar el par"""
-        try:
-            # Convertir login a entero para la conexión
-            login = int(self.config['mt5_login'])
-            
-            analyzer = TradingSignalController(
-                symbol=symbol,
-                timeframe_min=self.config['timeframe'],
-                server=self.config['mt5_server'],
-                login=login,
-                password=self.config['mt5_password']
+    def create_source(self, config=None):
+        """Fuente de datos configurada: terminal MT5 o reproducción de datos grabados"""
+        config = config if config is not None else self.config
+        if config['data_source'] == 'replay':
+            source = TerminalGateway(ReplayDataSource(config['replay_dir'], config['replay_speed']),
+                                     name="terminal-replay")
+        else:
+            source = mt5_gateway()
+        
+        store_dir = self.bar_store_path(config)
+        if store_dir:
+            source = StoredDataSource(source, BarStore(store_dir))
+        return source
+        
+    def bar_store_path(self, config=None):
+        """Directorio del almacén local de la fuente configurada ('' si está desactivado)"""
+        config = config if config is not None else self.config
+        if not config['bar_store_dir']:
+            return ''
+        # Un almacén por servidor: cada broker tiene sus propias velas
+        store_name = 'replay' if config['data_source'] == 'replay' else config['mt5_server']
+        return os.path.join(config['bar_store_dir'], re.sub(r'[^\w.-]', '_', store_name))
+        
+    def get_connection(self, config=None):
+        """Devuelve la sesión persistente, recreándola si cambian las credenciales o la fuente"""
+        config = config if config is not None else self.config
+        key = (
+            config['mt5_server'],
+            config['mt5_login'],
+            config['mt5_password'],
+            config['data_source'],
+            config['replay_dir'],
+            config['replay_speed'],
+            config['bar_store_dir'],
+            json.dumps(config['market_sessions'], sort_keys=True)
+        )
+        if self.connection is not None and self.connection_key != key:
+            self.close_connection()
+        if self.connection is None:
+            self.connection = MT5ConnectionManager(
+                server=config['mt5_server'],
+                login=config['mt5_login'],
+                password=config['mt5_password'],
+                source=self.create_source(config),
+                sessions=config['market_sessions']
             )
-            return analyzer.analyze_signals()
+            self.connection_key = key
+        return self.connection
+        
+    def close_connection(self):
+        if self.connection is not None:
+            self.connection.shutdown()
+            # La pasarela MT5 es única en el proceso; la de reproducción es de esta conexión
+            gateway = self.connection.source
+            if isinstance(gateway, StoredDataSource):
+                gateway = gateway.source
+            if isinstance(gateway, TerminalGateway) and gateway is not _MT5_GATEWAY:
+                gateway.close()
+            self.connection = None
+            
+    def analyze_pair(self, symbol, config=None):
+        """Usa el analizador reutilizable del par y alerta una sola vez por cruce.
+
+        config es la instantánea de configuración del ciclo (por defecto la vigente).
+        """
+        config = config if config is not None else self.config
+        with METRICS.timer("analyze_symbol", symbol):
+            return self._analyze_pair(symbol, config)
+            
+    def _analyze_pair(self, symbol, config):
+        try:
+            if config['multi_timeframe']:
+                return self.analyze_pair_timeframes(symbol, config)
+            analyzer = self.get_connection(config).get_analyzer(symbol, config['timeframe'])
+            breakouts = analyzer.detect_breakouts()
+            distance = config['rearm_points'] * analyzer.point
+            fired = self.signal_state.process(symbol, analyzer.levels, analyzer.price, breakouts, distance)
+            self.record_alerts(symbol, fired, config['timeframe'], analyzer.source.time())
+            return [SIGNAL_LABELS[breakout.kind] for breakout in fired]
         except Exception as e:
             raise Exception(f"Error analizando {symbol}: {str(e)}")
             
-    def play_sound(self):
-        """Reproduce el archivo de audio configurado"""
-        if not SOUND_AVAILABLE or not self.config['audio_file']:
-            return
+    def analyze_pair_timeframes(self, symbol, config=None):
+        """Analiza todos los timeframes vigilados con una única descarga M1 del par"""
+        config = config if config is not None else self.config
+        analyzer = self.get_connection(config).get_analyzer(symbol, 1)
+        distance = config['rearm_points'] * analyzer.point
+        labels = []
+        for minutes, breakouts in analyzer.detect_timeframe_breakouts(config['multi_timeframes']).items():
+            name = next((k for k, v in TIMEFRAMES.items() if v == minutes), f"{minutes} min")
+            # Cada timeframe lleva su propio estado de alerta
+            fired = self.signal_state.process(f"{symbol} {minutes}", analyzer.levels, analyzer.price,
+                                              breakouts, distance)
+            self.record_alerts(symbol, fired, minutes, analyzer.source.time())
+            labels.extend(f"{SIGNAL_LABELS[breakout.kind]} [{name}]" for breakout in fired)
+        return labels
+            
+    def get_executor(self, config=None):
+        """Devuelve el pool de análisis, recreándolo si cambia su tamaño"""
+        workers = (config if config is not None else self.config)['analysis_workers']
+        if self.executor is not None and self.executor_workers != workers:
+            self.shutdown_executor()
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="analisis")
+            self.executor_workers = workers
+        return self.executor
+        
+    def shutdown_executor(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+            
+    def analyze_pairs(self, symbols, config=None):
+        """Analiza los pares en paralelo y entrega (símbolo, señales, error) según terminan.
+
+        Todos los análisis usan la misma instantánea config, aunque la
+        configuración se recargue a mitad del ciclo.
+        """
+        config = config if config is not None else self.config
+        executor = self.get_executor(config)
+        futures = {executor.submit(self.analyze_pair, symbol, config): symbol for symbol in symbols}
+        try:
+            for future in as_completed(futures):
+                symbol = futures[future]
+                try:
+                    yield symbol, future.result(), None
+                except Exception as e:
+                    yield symbol, [], e
+        finally:
+            # Si el consumidor se detiene, los análisis pendientes se descartan
+            for future in futures:
+                future.cancel()
             
-        if not pygame.mixer.get_init():
-            pygame.mixer.init()
+    def load_sound(self):
+        """Decodifica el audio configurado solo si cambia el archivo (ruta, fecha o tamaño)"""
+        audio_file = self.config['audio_file']
+        if not SOUND_AVAILABLE or not audio_file:
+            self.sound = None
+            self.sound_key = None
+            return None
+        
+        try:
+            stat = os.stat(audio_file)
+            key = (audio_file, stat.st_mtime, stat.st_size)
+            if key == self.sound_key:
+                return self.sound
+            
+            if not pygame.mixer.get_init():
+                pygame.mixer.init()
+            if self.sound_channel is None:
+                # Canal reservado: las alertas no compiten con otros sonidos
+                pygame.mixer.set_reserved(1)
+                self.sound_channel = pygame.mixer.Channel(0)
+            self.sound = pygame.mixer.Sound(audio_file)
+            self.sound_key = key
+        except Exception as e:
+            print(f"Error cargando sonido: {e}")
+            self.sound = None
+            self.sound_key = None
+        return self.sound
             
+    def play_sound(self):
+        """Reproduce el sonido en caché sin bloquear; las alertas seguidas no se acumulan"""
+        sound = self.load_sound()
+        if sound is None:
+            return
+        
+        now = time.monotonic()
+        if self.sound_channel.get_busy() or now - self.last_sound < self.config['sound_min_interval']:
+            return
+        
         try:
-            sound = pygame.mixer.Sound(self.config['audio_file'])
-            sound.play()
+            self.sound_channel.play(sound)
+            self.last_sound = now
         except Exception as e:
             print(f"Error reproduciendo sonido: {e}")
 
+class AlertSink:
+    """Destino de las alertas del motor: recibe un dict por señal.
+
+    Los sumideros con blocking=True hacen E/S y el motor los envuelve en un
+    QueuedSink para que nunca retrasen el análisis.
+    """
+    blocking = True
+
+    def send(self, alert):
+        raise NotImplementedError
+
+    def send_batch(self, alerts):
+        """Envía varias alertas pendientes; los sumideros de mensajería las agrupan.
+
+        Sin envío agrupado cada alerta entregada se quita de alerts, de modo
+        que tras un fallo el reintento sigue desde la primera no entregada.
+        """
+        while alerts:
+            self.send(alerts[0])
+            del alerts[0]
+
+    def close(self):
+        pass
+
+class CallbackSink(AlertSink):
+    """Entrega cada alerta a una función (p. ej. la cola de la interfaz)"""
+    blocking = False
+
+    def __init__(self, callback):
+        self.callback = callback
+
+    def send(self, alert):
+        self.callback(alert)
+
+class QueuedSink(AlertSink):
+    """Entrega asíncrona: cola acotada e hilo propio por sumidero.
+
+    send() nunca bloquea; con la cola llena se descarta la alerta más
+    antigua. El hilo agrupa las alertas pendientes en lotes y reintenta
+    con espera exponencial; agotados los reintentos, el lote se descarta.
+    """
+    blocking = False
+
+    def __init__(self, sink, maxsize=1000, retries=4, backoff=1.0, max_backoff=60.0, batch_size=20):
+        self.sink = sink
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.batch_size = batch_size
+        self.pending = deque(maxlen=maxsize)
+        self.condition = threading.Condition()
+        self.closed = False
+        self.sent = 0
+        self.dropped = 0
+        self.failed = 0
+        self.thread = threading.Thread(target=self._run, name=f"sink-{type(sink).__name__}", daemon=True)
+        self.thread.start()
+
+    def send(self, alert):
+        with self.condition:
+            if len(self.pending) == self.pending.maxlen:
+                self.dropped += 1
+            self.pending.append(alert)
+            self.condition.notify()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.closed:
+                    self.condition.wait()
+                if not self.pending:
+                    return
+                batch = [self.pending.popleft() for _ in range(min(self.batch_size, len(self.pending)))]
+            self._deliver(batch)
+
+    def _deliver(self, batch):
+        delay = self.backoff
+        for attempt in range(self.retries + 1):
+            size = len(batch)
+            try:
+                self.sink.send_batch(batch)
+                self.sent += size
+                return
+            except Exception as e:
+                # Las alertas ya entregadas salieron del lote y no se repiten
+                self.sent += size - len(batch)
+                if attempt == self.retries or self.closed:
+                    break
+                print(f"⚠️ {type(self.sink).__name__}: {e}; reintento en {delay:.1f} s")
+                with self.condition:
+                    # El cierre interrumpe la espera
+                    self.condition.wait_for(lambda: self.closed, timeout=delay)
+                delay = min(delay * 2, self.max_backoff)
+        self.failed += len(batch)
+        print(f"❌ {type(self.sink).__name__}: se descartan {len(batch)} alerta(s)")
+
+    def stats(self):
+        return {"pending": len(self.pending), "sent": self.sent,
+                "dropped": self.dropped, "failed": self.failed}
+
+    def close(self, timeout=5.0):
+        """Intenta vaciar la cola durante timeout segundos y cierra el sumidero"""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join(timeout)
+        self.sink.close()
+
+class JsonlSink(AlertSink):
+    """Una línea JSON por alerta en stdout o, con path, al final de un fichero"""
+    def __init__(self, path=None):
+        self.path = path
+        self.stream = open(path, 'a', encoding='utf-8') if path else sys.stdout
+        self.lock = threading.Lock()
+
+    def send(self, alert):
+        line = json.dumps(alert, ensure_ascii=False)
+        with self.lock:
+            self.stream.write(line + "\n")
+            self.stream.flush()
+
+    def close(self):
+        if self.path:
+            self.stream.close()
+
+class SocketSink(AlertSink):
+    """Envía cada alerta como línea JSON a un socket local (host:puerto TCP o ruta Unix)"""
+    def __init__(self, address, timeout=5.0):
+        self.address = tuple(address) if isinstance(address, list) else address
+        self.timeout = timeout
+        self.sock = None
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        if isinstance(self.address, tuple):
+            sock = socket.create_connection(self.address, timeout=self.timeout)
+        else:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            sock.connect(self.address)
+        return sock
+
+    def send(self, alert):
+        data = (json.dumps(alert, ensure_ascii=False) + "\n").encode('utf-8')
+        with self.lock:
+            try:
+                if self.sock is None:
+                    self.sock = self._connect()
+                self.sock.sendall(data)
+            except OSError:
+                # Se reconecta en el próximo envío
+                self.close()
+                raise
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            finally:
+                self.sock = None
+
+class WebhookSink(AlertSink):
+    """POST de cada alerta en JSON a una URL, reutilizando la conexión HTTP (keep-alive)"""
+    def __init__(self, url, timeout=10.0, headers=None):
+        self.url = url
+        self.timeout = timeout
+        self.headers = {'Content-Type': 'application/json', **(headers or {})}
+        parts = urllib.parse.urlsplit(url)
+        self.scheme = parts.scheme
+        self.netloc = parts.netloc
+        self.path = (parts.path or "/") + (f"?{parts.query}" if parts.query else "")
+        self.connection = None
+
+    def post(self, payload):
+        """Envía payload como JSON; una conexión reutilizada que el servidor cerró se reabre al momento"""
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        for attempt in range(2):
+            reused = self.connection is not None
+            if not reused:
+                factory = http.client.HTTPSConnection if self.scheme == "https" else http.client.HTTPConnection
+                self.connection = factory(self.netloc, timeout=self.timeout)
+            try:
+                self.connection.request("POST", self.path, body, self.headers)
+                response = self.connection.getresponse()
+                data = response.read()
+            except (OSError, http.client.HTTPException):
+                self.close()
+                if reused and attempt == 0:
+                    continue
+                raise
+            if response.status >= 400:
+                raise Exception(f"HTTP {response.status} en {self.netloc}")
+            return data
+
+    def send(self, alert):
+        self.post(alert)
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+class TelegramSink(WebhookSink):
+    """Mensajes de Telegram (Bot API); las alertas pendientes se agrupan en un solo mensaje"""
+    def __init__(self, token, chat_id, api_url="https://api.telegram.org", timeout=10.0):
+        super().__init__(f"{api_url.rstrip('/')}/bot{token}/sendMessage", timeout)
+        self.chat_id = chat_id
+
+    def send(self, alert):
+        self.send_batch([alert])
+
+    def send_batch(self, alerts):
+        text = "\n".join(f"🚨 {alert['symbol']}: {alert['signal']}" for alert in alerts)
+        self.post({"chat_id": self.chat_id, "text": text})
+
+class EmailSink(AlertSink):
+    """Correo SMTP con la sesión reutilizada; las alertas pendientes van en un solo mensaje"""
+    def __init__(self, host, sender, recipients, port=587, username=None, password=None,
+                 starttls=True, timeout=20.0):
+        self.host = host
+        self.port = port
+        self.sender = sender
+        self.recipients = [recipients] if isinstance(recipients, str) else list(recipients)
+        self.username = username
+        self.password = password
+        self.starttls = starttls
+        self.timeout = timeout
+        self.smtp = None
+
+    def _session(self):
+        if self.smtp is not None:
+            try:
+                if self.smtp.noop()[0] == 250:
+                    return self.smtp
+            except smtplib.SMTPException:
+                pass
+            except OSError:
+                pass
+            self.close()
+        smtp = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        if self.starttls:
+            smtp.starttls()
+        if self.username:
+            smtp.login(self.username, self.password)
+        self.smtp = smtp
+        return smtp
+
+    def send(self, alert):
+        self.send_batch([alert])
+
+    def send_batch(self, alerts):
+        message = EmailMessage()
+        message['Subject'] = f"Alarma de Trading: {len(alerts)} señal(es)"
+        message['From'] = self.sender
+        message['To'] = ", ".join(self.recipients)
+        message.set_content("\n".join(
+            f"{alert['time']}  {alert['symbol']}: {alert['signal']}" for alert in alerts
+        ))
+        try:
+            self._session().send_message(message)
+        except (smtplib.SMTPException, OSError):
+            self.close()
+            raise
+
+    def close(self):
+        if self.smtp is not None:
+            try:
+                self.smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self.smtp = None
+
+SINK_TYPES = {
+    "jsonl": JsonlSink,
+    "socket": SocketSink,
+    "webhook": WebhookSink,
+    "telegram": TelegramSink,
+    "email": EmailSink
+}
+
+def create_sink(spec):
+    """Crea un sumidero a partir de un texto o de un dict {"type": ..., opciones}.
+
+    Textos: stdout | jsonl:RUTA | socket:HOST:PUERTO | socket:RUTA |
+    webhook:URL | telegram:TOKEN:CHAT_ID
+    """
+    if isinstance(spec, dict):
+        options = dict(spec)
+        kind = options.pop("type", None)
+        if kind not in SINK_TYPES:
+            raise ValueError(f"Sumidero de alertas no válido: {kind}")
+        return SINK_TYPES[kind](**options)
+    
+    kind, _, target = spec.partition(":")
+    if kind == "stdout":
+        return JsonlSink()
+    if kind == "jsonl" and target:
+        return JsonlSink(target)
+    if kind == "socket" and target:
+        host, _, port = target.rpartition(":")
+        if host and port.isdigit():
+            return SocketSink((host, int(port)))
+        return SocketSink(target)
+    if kind == "webhook" and target:
+        return WebhookSink(target)
+    if kind == "telegram" and target.count(":") >= 1:
+        token, _, chat_id = target.rpartition(":")
+        return TelegramSink(token, chat_id)
+    raise ValueError(f"Sumidero de alertas no válido: {spec}")
+
+class StateSnapshot:
+    """Instantánea del estado del motor para arrancar en caliente.
+
+    Guarda en JSON los niveles en caché con su validez, el estado de alerta
+    de cada nivel y los agregadores de velas (con la última vela procesada
+    de cada símbolo). Al arrancar se restaura: el primer ciclo solo descarga
+    las velas que faltan y las alertas ya enviadas no se repiten.
+    """
+    VERSION = 1
+
+    def __init__(self, path=SNAPSHOT_FILE, interval=60):
+        self.path = path
+        self.interval = interval
+        self.last_write = 0.0
+
+    @staticmethod
+    def identity(model):
+        """Una instantánea solo vale para el mismo servidor y fuente de datos"""
+        return {"server": model.config['mt5_server'], "source": model.config['data_source']}
+
+    def capture(self, model, connection, cycle=0):
+        return {
+            "version": self.VERSION,
+            "identity": self.identity(model),
+            "source_time": connection.source.time(),
+            "cycle": cycle,
+            "levels": connection.level_cache.export(),
+            "signals": model.signal_state.export(),
+            "aggregators": connection.export_aggregators()
+        }
+
+    def write(self, data):
+        """Escritura atómica: fichero temporal en el mismo directorio + os.replace"""
+        temporary = f"{self.path}.tmp"
+        with open(temporary, 'w', encoding='utf-8') as f:
+            json.dump(data, f, separators=(',', ':'), default=float)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, self.path)
+
+    def save(self, model, connection, cycle=0, force=False):
+        """Guarda la instantánea si ha pasado el intervalo (o siempre con force)"""
+        if not self.interval or connection is None:
+            return False
+        now = time.monotonic()
+        if not force and now - self.last_write < self.interval:
+            return False
+        try:
+            self.write(self.capture(model, connection, cycle))
+            self.last_write = now
+            return True
+        except Exception as e:
+            print(f"⚠️ Error guardando el estado del motor: {e}")
+            return False
+
+    def load(self):
+        """Lee la instantánea; None si no existe, está dañada o es de otra versión"""
+        if not os.path.exists(self.path):
+            return None
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"⚠️ Estado guardado ilegible, se ignora: {e}")
+            return None
+        if data.get("version") != self.VERSION:
+            return None
+        return data
+
+    def restore(self, model, connection):
+        """Aplica la instantánea al modelo y a la sesión. Devuelve el último ciclo guardado"""
+        if not self.interval:
+            return 0
+        data = self.load()
+        if data is None:
+            return 0
+        if data['identity'] != self.identity(model):
+            print("ℹ️ El estado guardado es de otro servidor o fuente de datos, se ignora")
+            return 0
+        if data['source_time'] > connection.source.time():
+            # Reloj de la fuente anterior a la instantánea (p. ej. una reproducción reiniciada)
+            print("ℹ️ El estado guardado es posterior al reloj de la fuente, se ignora")
+            return 0
+        connection.level_cache.restore(data['levels'], connection.source.now())
+        model.signal_state.restore(data['signals'])
+        connection.restore_aggregators(data['aggregators'])
+        print(f"♻️ Estado restaurado: {len(data['levels'])} niveles, {len(data['signals'])} "
+              f"estados de alerta, {len(data['aggregators'])} agregadores")
+        return data['cycle']
+
+class MonitorEngine:
+    """Motor de monitoreo sin interfaz.
+
+    Programa los ciclos al cierre de vela (o vigila ticks), analiza los pares
+    con el modelo y entrega cada alerta a los sumideros configurados. La
+    interfaz Tk es solo un cliente más que se suscribe con un CallbackSink.
+    """
+    def __init__(self, model, sinks=None, on_error=None):
+        self.model = model
+        self.sinks = []
+        self.on_error = on_error if on_error is not None else self._print_error
+        self.thread = None
+        self.active = False
+        self.stop_event = threading.Event()
+        self.metrics_server = None
+        self.snapshot = StateSnapshot(SNAPSHOT_FILE, model.config['snapshot_interval'])
+        # Se activa cuando cambia una clave que el bucle aplica en caliente
+        self.wake = threading.Event()
+        model.store.subscribe(self._on_config_change)
+        for sink in sinks or []:
+            self.add_sink(sink)
+        # Notificaciones externas de la configuración (Telegram, webhook, correo...)
+        for spec in model.config['notification_sinks']:
+            try:
+                self.add_sink(create_sink(spec))
+            except Exception as e:
+                print(f"⚠️ Sumidero ignorado ({e})")
+
+    # Claves que el bucle aplica en caliente, sin detener el monitoreo
+    LIVE_KEYS = {"selected_pairs", "timeframe", "multi_timeframe", "multi_timeframes", "detection_mode",
+                 "candle_close_delay", "tick_poll_interval", "rearm_points"}
+
+    @staticmethod
+    def _print_error(message):
+        print(f"❌ {message}")
+
+    def _on_config_change(self, changed):
+        if "snapshot_interval" in changed:
+            self.snapshot.interval = self.model.config['snapshot_interval']
+        live = changed & self.LIVE_KEYS
+        if live and self.active:
+            print(f"🔄 Aplicando sin reiniciar: {', '.join(sorted(live))}")
+            self.wake.set()
+
+    def add_sink(self, sink):
+        """Los sumideros con E/S se envuelven en una cola con hilo propio"""
+        self.sinks.append(QueuedSink(sink) if sink.blocking else sink)
+
+    def start(self):
+        """Inicia el monitoreo en un hilo separado"""
+        if self.active:
+            return
+        self.active = True
+        # Evento nuevo por ejecución para no reactivar un hilo que aún se está deteniendo
+        self.stop_event = threading.Event()
+        self.wake.clear()
+        self.thread = threading.Thread(target=self.run, args=(self.stop_event,), daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Detiene el monitoreo de inmediato"""
+        self.active = False
+        self.stop_event.set()
+
+    def emit(self, symbol, signal, batch=None):
+        """Entrega la alerta a todos los sumideros; un sumidero caído no afecta al resto"""
+        alert = {
+            "time": datetime.now(pytz.utc).isoformat(),
+            "symbol": symbol,
+            "signal": signal,
+            "batch": batch
+        }
+        for sink in self.sinks:
+            try:
+                sink.send(alert)
+            except Exception as e:
+                print(f"⚠️ Error enviando alerta a {type(sink).__name__}: {e}")
+
+    def start_metrics(self):
+        """Publica /metrics si hay un puerto configurado"""
+        port = self.model.config['metrics_port']
+        if port and self.metrics_server is None:
+            try:
+                self.metrics_server = MetricsServer(METRICS, port)
+            except OSError as e:
+                print(f"⚠️ No se pudo abrir el puerto de métricas {port}: {e}")
+
+    def close(self):
+        self.model.store.unsubscribe(self._on_config_change)
+        if self.metrics_server is not None:
+            self.metrics_server.close()
+            self.metrics_server = None
+        for sink in self.sinks:
+            try:
+                sink.close()
+            except Exception as e:
+                print(f"⚠️ Error cerrando {type(sink).__name__}: {e}")
+
+    def run(self, stop_event):
+        """Ejecuta el monitoreo continuo alineado con el cierre de cada vela"""
+        scheduler = CandleScheduler(self.model.cycle_timeframe(), self.model.config['candle_close_delay'])
+        watcher = None
+        cycle = 0
+        # Solo los ciclos despertados por el programador miden la latencia cierre -> alerta
+        scheduled = False
+        restored = False
+        self.start_metrics()
+        self.model.store.watch()
+        try:
+            while not stop_event.is_set():
+                try:
+                    # Instantánea de la configuración: el ciclo entero usa los mismos valores
+                    config = self.model.config
+                    # Sesión persistente: solo se reconecta si la conexión ha fallado
+                    connection = self.model.get_connection(config)
+                    if connection.source.speed <= 0:
+                        # Con el reloj detenido las esperas hasta el próximo cierre no terminarían
+                        raise Exception(f"replay_speed debe ser mayor que 0 para monitorear (actual: {config['replay_speed']})")
+                    scheduler.use_clock(connection.clock)
+                    scheduler.use_calendar(connection.calendar)
+                    connection.ensure_connected()
+                    if not restored:
+                        # Arranque en caliente: niveles, alertas y velas ya procesadas
+                        self.snapshot.interval = config['snapshot_interval']
+                        cycle = self.snapshot.restore(self.model, connection)
+                        restored = True
+                    
+                    symbols = config['selected_pairs']
+                    # Todos los símbolos vigilados se resuelven y activan de una vez
+                    connection.symbol_index.select(symbols)
+                    
+                    if config['detection_mode'] == 'ticks':
+                        # Modo streaming: se vigilan los ticks hasta el próximo ciclo
+                        timeframe = config['timeframe']
+                        if (watcher is None or watcher.connection is not connection
+                                or watcher.timeframe_min != timeframe
+                                or watcher.poll_interval != config['tick_poll_interval']
+                                or watcher.rearm_points != config['rearm_points']):
+                            watcher = TickBreakoutWatcher(
+                                connection,
+                                timeframe,
+                                self.emit,
+                                config['tick_poll_interval'],
+                                self.model.signal_state,
+                                config['rearm_points'],
+                                self.model.journal
+                            )
+                        watcher.run(symbols, stop_event, timeframe * 60 / connection.source.speed, self.wake)
+                        self.wake.clear()
+                        self.snapshot.save(self.model, connection, cycle)
+                        continue
+                    
+                    if symbols:
+                        # Actualiza el desfase del reloj del servidor (programador y analizadores)
+                        connection.server_time(symbols[0])
+                    
+                    # Analizar los pares seleccionados en paralelo; cada resultado
+                    # se notifica en cuanto termina su símbolo
+                    cycle += 1
+                    period = self.model.cycle_timeframe(config) * 60
+                    bar_close = scheduler.server_now() // period * period
+                    started = time.perf_counter()
+                    for symbol, signals, error in self.model.analyze_pairs(symbols, config):
+                        if stop_event.is_set():
+                            break
+                            
+                        if error is not None:
+                            self.on_error(str(error))
+                            continue
+                        if signals and scheduled:
+                            METRICS.observe("bar_close_to_alert", scheduler.server_now() - bar_close, symbol)
+                        for signal in signals:
+                            self.emit(symbol, signal, cycle)
+                    METRICS.observe("cycle", time.perf_counter() - started)
+                    self.snapshot.save(self.model, connection, cycle)
+                    
+                    # Esperar al próximo cierre de vela (sin deriva acumulada)
+                    scheduler.configure(self.model.cycle_timeframe(), self.model.config['candle_close_delay'])
+                    if not scheduler.wait_next(stop_event, self.wake):
+                        break
+                    # Un ciclo adelantado por un cambio de configuración no mide latencia de cierre
+                    scheduled = not self.wake.is_set()
+                    self.wake.clear()
+                        
+                except Exception as e:
+                    self.on_error(str(e))
+                    stop_event.wait(5)  # Esperar antes de reintentar
+        finally:
+            self.model.shutdown_executor()
+            if restored:
+                self.snapshot.save(self.model, self.model.connection, cycle, force=True)
+            self.model.close_connection()
+
+class AlertDispatcher:
+    """Cola de alertas vaciada en el hilo de Tk a ritmo acotado.
+
+    Los hilos de análisis solo encolan; cada interval_ms el hilo de la
+    interfaz recoge hasta max_batch señales, las añade al panel único de
+    alertas y reproduce el sonido una sola vez por ciclo de análisis.
+    """
+    def __init__(self, root, show, play_sound, interval_ms=250, max_batch=50):
+        self.root = root
+        self.show = show
+        self.play_sound = play_sound
+        self.interval_ms = interval_ms
+        self.max_batch = max_batch
+        self.pending = queue.Queue()
+        self.sounded_batch = None
+        self.job = None
+
+    def start(self):
+        if self.job is None:
+            self.job = self.root.after(self.interval_ms, self._drain)
+
+    def stop(self):
+        if self.job is not None:
+            self.root.after_cancel(self.job)
+            self.job = None
+
+    def submit(self, symbol, signal, batch=None):
+        """Encola una señal (seguro desde cualquier hilo); batch identifica el ciclo"""
+        self.pending.put((symbol, signal, batch, time.time()))
+
+    def _drain(self):
+        items = []
+        try:
+            while len(items) < self.max_batch:
+                items.append(self.pending.get_nowait())
+        except queue.Empty:
+            pass
+        
+        if items:
+            self.show([
+                f"{datetime.fromtimestamp(received).strftime('%H:%M:%S')}  {symbol}: {signal}"
+                for symbol, signal, batch, received in items
+            ])
+            # Un ciclo repartido en varios vaciados suena una sola vez;
+            # las señales sin ciclo (ticks) suenan una vez por vaciado
+            batches = {batch for _, _, batch, _ in items}
+            newest = max((batch for batch in batches if batch is not None), default=None)
+            if None in batches or (newest is not None and newest != self.sounded_batch):
+                self.play_sound()
+            if newest is not None:
+                self.sounded_batch = newest
+        self.job = self.root.after(self.interval_ms, self._drain)
+
+class AlertWindowManager:
+    """Ciclo de vida de las ventanas de alerta.
+
+    Limita las ventanas abiertas (se cierra la más antigua al superar el
+    máximo) y liga cada temporizador after a su ventana para cancelarlo al
+    cerrarla, de modo que no quedan callbacks huérfanos tras días de uso.
+    """
+    def __init__(self, root, max_windows=3):
+        self.root = root
+        self.max_windows = max_windows
+        self.windows = []
+        # ventana -> id del after pendiente
+        self.timers = {}
+
+    def open(self, title, geometry):
+        while len(self.windows) >= self.max_windows:
+            self.close(self.windows[0])
+        window = tk.Toplevel(self.root)
+        window.title(title)
+        window.geometry(geometry)
+        # Cerrar con la X también cancela los temporizadores
+        window.protocol("WM_DELETE_WINDOW", lambda: self.close(window))
+        self.windows.append(window)
+        return window
+
+    def schedule(self, window, delay_ms, callback):
+        """after ligado a la ventana; sustituye al temporizador anterior de la misma"""
+        self.cancel(window)
+        
+        def run():
+            self.timers.pop(window, None)
+            callback()
+        
+        self.timers[window] = window.after(delay_ms, run)
+
+    def cancel(self, window):
+        job = self.timers.pop(window, None)
+        if job is not None:
+            try:
+                window.after_cancel(job)
+            except tk.TclError:
+                pass
+
+    def close(self, window):
+        self.cancel(window)
+        if window in self.windows:
+            self.windows.remove(window)
+        try:
+            window.destroy()
+        except tk.TclError:
+            pass
+
+    def stats(self):
+        """Callbacks after pendientes en el intérprete y ventanas Toplevel vivas"""
+        return {
+            "after": len(self.root.tk.splitlist(self.root.tk.call('after', 'info'))),
+            "toplevels": sum(isinstance(widget, tk.Toplevel) for widget in self.root.winfo_children()),
+            "alert_windows": len(self.windows),
+            "alert_timers": len(self.timers)
+        }
+
 class TradingAlarmView:
     def __init__(self, root, controller):
         self.root = root
         self.controller = controller
+        # Panel único de alertas, creado con la primera señal
+        self.alert_panel = None
+        self.alert_list = None
+        self.alert_status = None
+        self.alert_windows = AlertWindowManager(root)
+        self.stats_windows = AlertWindowManager(root, max_windows=1)
+        self.stats_tree = None
+        self.history_windows = AlertWindowManager(root, max_windows=1)
+        self.history_tree = None
+        # Clave (detected, id) con la que empieza cada página visitada del historial
+        self.history_keys = [None]
+        self.history_page = 0
+        # Claves cambiadas fuera de la interfaz (recarga del fichero, otro hilo);
+        # los controles se actualizan en el hilo de Tk
+        self.config_changes = queue.Queue()
         self.setup_window()
         self.setup_ui()
+        self.update_resources()
+        self.controller.model.store.subscribe(self.config_changes.put)
+        self.root.after(500, self.sync_config)
         
     def setup_window(self):
         self.root.title("Alarma de Trading Profesional")
-        self.root.geometry("600x500")
+        self.root.geometry("600x560")
         self.root.resizable(False, False)
         
         try:
@@ -435,6 +3638,7 @@ class TradingAlarmView:
         self.setup_main_frame()
         self.setup_pairs_selection()
         self.setup_timeframe_selection()
+        self.setup_detection_mode()
         self.setup_audio_selection()
         self.setup_mt5_credentials()
         self.setup_controls()
@@ -495,6 +3699,46 @@ class TradingAlarmView:
         self.timeframe_combo.set(current_tf)
         self.timeframe_combo.bind("<<ComboboxSelected>>", self.update_timeframe)
         
+        # Tamaño del pool de análisis en paralelo
+        ttk.Label(timeframe_frame, text="Hilos:").pack(side=tk.LEFT, padx=(10, 0))
+        self.workers_var = tk.IntVar(value=self.controller.model.config['analysis_workers'])
+        ttk.Spinbox(
+            timeframe_frame,
+            from_=1,
+            to=32,
+            width=4,
+            textvariable=self.workers_var,
+            state="readonly",
+            command=self.update_analysis_workers
+        ).pack(side=tk.LEFT, padx=5)
+        
+    def setup_detection_mode(self):
+        mode_frame = ttk.Frame(self.main_frame)
+        mode_frame.pack(fill=tk.X, pady=(0, 10))
+        
+        ttk.Label(mode_frame, text="Modo de detección:").pack(side=tk.LEFT)
+        
+        self.mode_combo = ttk.Combobox(
+            mode_frame,
+            values=list(DETECTION_MODES.keys()),
+            state="readonly"
+        )
+        self.mode_combo.pack(side=tk.LEFT, padx=5)
+        
+        current_mode = next((k for k, v in DETECTION_MODES.items()
+                            if v == self.controller.model.config['detection_mode']), "Velas")
+        self.mode_combo.set(current_mode)
+        self.mode_combo.bind("<<ComboboxSelected>>", self.update_detection_mode)
+        
+        # Vigilancia simultánea de M1, M5, M15 y H1 a partir de velas M1
+        self.multi_tf_var = tk.BooleanVar(value=self.controller.model.config['multi_timeframe'])
+        ttk.Checkbutton(
+            mode_frame,
+            text="Multi-timeframe",
+            variable=self.multi_tf_var,
+            command=self.update_multi_timeframe
+        ).pack(side=tk.LEFT, padx=(10, 0))
+        
     def setup_audio_selection(self):
         audio_frame = ttk.Frame(self.main_frame)
         audio_frame.pack(fill=tk.X, pady=(0, 10))
@@ -569,6 +3813,18 @@ class TradingAlarmView:
         self.stop_button.pack(side=tk.LEFT, padx=5)
         self.stop_button.config(state='disabled')
         
+        ttk.Button(
+            controls_frame,
+            text="Estadísticas",
+            command=self.show_stats
+        ).pack(side=tk.LEFT, padx=5)
+        
+        ttk.Button(
+            controls_frame,
+            text="Historial",
+            command=self.show_history
+        ).pack(side=tk.LEFT, padx=5)
+        
         self.status_label = ttk.Label(
             controls_frame, 
             text="Configura los parámetros y haz clic en Iniciar",
@@ -576,14 +3832,57 @@ class TradingAlarmView:
         )
         self.status_label.pack(side=tk.LEFT, padx=10, expand=True, fill=tk.X)
         
+        # Instrumentación de recursos de la interfaz
+        self.resources_label = ttk.Label(
+            self.main_frame,
+            font=('Segoe UI', 8)
+        )
+        self.resources_label.pack(fill=tk.X, pady=(5, 0))
+        
+    def sync_config(self):
+        """Refleja en los controles la configuración recargada, para que un clic no la pise"""
+        changed = set()
+        while True:
+            try:
+                changed |= self.config_changes.get_nowait()
+            except queue.Empty:
+                break
+        config = self.controller.model.config
+        if "selected_pairs" in changed:
+            for pair, var in self.pair_vars.items():
+                var.set(pair in config['selected_pairs'])
+        if "timeframe" in changed:
+            self.timeframe_combo.set(next((k for k, v in TIMEFRAMES.items()
+                                           if v == config['timeframe']), "5 minutos"))
+        if "detection_mode" in changed:
+            self.mode_combo.set(next((k for k, v in DETECTION_MODES.items()
+                                      if v == config['detection_mode']), "Velas"))
+        if "analysis_workers" in changed:
+            self.workers_var.set(config['analysis_workers'])
+        if "multi_timeframe" in changed:
+            self.multi_tf_var.set(config['multi_timeframe'])
+        self.root.after(500, self.sync_config)
+        
     def update_selected_pairs(self):
+        # Los pares añadidos a mano en el fichero que no tienen casilla se conservan
         selected = [pair for pair, var in self.pair_vars.items() if var.get()]
+        selected += [pair for pair in self.controller.model.config['selected_pairs'] if pair not in self.pair_vars]
         self.controller.set_selected_pairs(selected)
         
     def update_timeframe(self, event=None):
         selected = self.timeframe_combo.get()
         self.controller.set_timeframe(TIMEFRAMES[selected])
         
+    def update_analysis_workers(self):
+        self.controller.set_analysis_workers(self.workers_var.get())
+        
+    def update_detection_mode(self, event=None):
+        selected = self.mode_combo.get()
+        self.controller.set_detection_mode(DETECTION_MODES[selected])
+        
+    def update_multi_timeframe(self):
+        self.controller.set_multi_timeframe(self.multi_tf_var.get())
+        
     def select_audio_file(self):
         filetypes = (
             ('Archivos de audio', '*.wav *.mp3 *.ogg'),
@@ -647,11 +3946,23 @@ class TradingAlarmView:
         
         self.controller.stop_monitoring()
         
-    def show_alarm(self, message):
-        """Muestra una ventana de alarma con el mensaje"""
-        alarm_window = tk.Toplevel(self.root)
-        alarm_window.title("¡Alarma de Trading!")
-        alarm_window.geometry("400x150")
+    def show_alerts(self, messages):
+        """Añade las señales al panel de alertas, creándolo si no está abierto"""
+        if self.alert_panel not in self.alert_windows.windows:
+            self.create_alert_panel()
+        
+        for message in messages:
+            self.alert_list.insert(0, message)
+        # Solo se conservan las alertas más recientes
+        self.alert_list.delete(200, tk.END)
+        self.alert_status.configure(text=f"{len(messages)} señal(es) nuevas · {self.alert_list.size()} en total")
+        self.alert_panel.deiconify()
+        self.alert_panel.lift()
+        # Cada lote nuevo reinicia un parpadeo de duración limitada
+        self.flash_window(self.alert_panel)
+        
+    def create_alert_panel(self):
+        alarm_window = self.alert_windows.open("¡Alarma de Trading!", "420x280")
         alarm_window.resizable(False, False)
         alarm_window.attributes('-topmost', True)
         alarm_window.configure(bg='#d70000')
@@ -662,37 +3973,180 @@ class TradingAlarmView:
             font=('Arial', 16, 'bold'), 
             fg='white',
             bg='#d70000'
-        ).pack(pady=10)
+        ).pack(pady=(10, 0))
         
-        tk.Label(
-            alarm_window, 
-            text=message, 
-            font=('Arial', 12),
+        self.alert_status = tk.Label(
+            alarm_window,
+            font=('Arial', 10),
             fg='white',
             bg='#d70000'
-        ).pack(pady=5)
+        )
+        self.alert_status.pack()
+        
+        self.alert_list = tk.Listbox(
+            alarm_window,
+            font=('Arial', 11),
+            height=8,
+            fg='white',
+            bg='#a00000',
+            relief=tk.FLAT
+        )
+        self.alert_list.pack(fill=tk.BOTH, expand=True, padx=10, pady=5)
         
         tk.Button(
             alarm_window, 
             text="Aceptar", 
-            command=alarm_window.destroy,
+            command=lambda: self.alert_windows.close(alarm_window),
             bg='#0078d7',
             fg='white',
             relief=tk.FLAT,
             activebackground='#005a9e'
-        ).pack(pady=10)
+        ).pack(pady=(0, 10))
         
-        # Reproducir sonido
-        self.controller.play_sound()
+        self.alert_panel = alarm_window
         
-        # Hacer parpadear la ventana
-        self.flash_window(alarm_window)
-        
-    def flash_window(self, window):
+    def flash_window(self, window, remaining=20):
+        """Parpadeo de duración limitada; el temporizador muere con la ventana"""
+        if remaining <= 0:
+            window.configure(bg='#d70000')
+            return
         current_bg = window.cget('bg')
         new_bg = '#000000' if current_bg == '#d70000' else '#d70000'
         window.configure(bg=new_bg)
-        window.after(500, lambda: self.flash_window(window))
+        self.alert_windows.schedule(window, 500, lambda: self.flash_window(window, remaining - 1))
+        
+    def show_stats(self):
+        """Panel de tiempos por métrica y símbolo (histogramas móviles, en ms)"""
+        if self.stats_windows.windows:
+            self.stats_windows.windows[0].lift()
+            return
+        window = self.stats_windows.open("Estadísticas de rendimiento", "640x360")
+        columns = ("metric", "symbol", "count", "p50", "p90", "p99", "max")
+        headings = ("Métrica", "Símbolo", "N", "p50 ms", "p90 ms", "p99 ms", "máx ms")
+        self.stats_tree = ttk.Treeview(window, columns=columns, show="headings")
+        for column, heading in zip(columns, headings):
+            self.stats_tree.heading(column, text=heading)
+            self.stats_tree.column(column, width=140 if column == "metric" else 70, anchor=tk.E)
+        self.stats_tree.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+        self.refresh_stats(window)
+        
+    def refresh_stats(self, window):
+        self.stats_tree.delete(*self.stats_tree.get_children())
+        for row in METRICS.snapshot():
+            self.stats_tree.insert("", tk.END, values=(
+                row['name'], row['symbol'], row['count'],
+                f"{row['p50'] * 1000:.2f}", f"{row['p90'] * 1000:.2f}",
+                f"{row['p99'] * 1000:.2f}", f"{row['max'] * 1000:.2f}"
+            ))
+        self.stats_windows.schedule(window, 2000, lambda: self.refresh_stats(window))
+        
+    def show_history(self):
+        """Historial de alertas paginado; solo se carga en memoria la página visible"""
+        if self.controller.model.journal is None:
+            messagebox.showinfo("Historial", "El historial de alertas está desactivado (alert_journal)")
+            return
+        if self.history_windows.windows:
+            self.history_windows.windows[0].lift()
+            return
+        window = self.history_windows.open("Historial de alertas", "760x420")
+        
+        filters_frame = ttk.Frame(window)
+        filters_frame.pack(fill=tk.X, padx=5, pady=5)
+        self.history_symbol = ttk.Combobox(filters_frame, values=("Todos", *FOREX_PAIRS), state="readonly", width=10)
+        self.history_kind = ttk.Combobox(filters_frame, values=("Todos", *LEVEL_KINDS), state="readonly", width=8)
+        self.history_period = ttk.Combobox(filters_frame, values=list(HISTORY_PERIODS.keys()), state="readonly", width=10)
+        for label, combo, value in (("Par:", self.history_symbol, "Todos"),
+                                    ("Nivel:", self.history_kind, "Todos"),
+                                    ("Periodo:", self.history_period, "7 días")):
+            ttk.Label(filters_frame, text=label).pack(side=tk.LEFT, padx=(5, 0))
+            combo.set(value)
+            combo.bind("<<ComboboxSelected>>", lambda event: self.load_history_page(0))
+            combo.pack(side=tk.LEFT, padx=5)
+        
+        columns = ("detected", "symbol", "kind", "level", "price", "timeframe", "candle")
+        headings = ("Detectada (UTC)", "Par", "Nivel", "Precio nivel", "Precio", "TF", "Vela (UTC)")
+        self.history_tree = ttk.Treeview(window, columns=columns, show="headings")
+        for column, heading in zip(columns, headings):
+            self.history_tree.heading(column, text=heading)
+            self.history_tree.column(column, width=140 if column in ("detected", "candle") else 80, anchor=tk.E)
+        self.history_tree.pack(fill=tk.BOTH, expand=True, padx=5)
+        # Totales por nivel de todo el rango filtrado, no solo de la página visible
+        self.history_counts = ttk.Label(window)
+        self.history_counts.pack(fill=tk.X, padx=10, pady=(5, 0))
+        
+        nav_frame = ttk.Frame(window)
+        nav_frame.pack(fill=tk.X, padx=5, pady=5)
+        self.history_prev = ttk.Button(nav_frame, text="◀ Anterior",
+                                       command=lambda: self.load_history_page(self.history_page - 1))
+        self.history_prev.pack(side=tk.LEFT)
+        self.history_next = ttk.Button(nav_frame, text="Siguiente ▶",
+                                       command=lambda: self.load_history_page(self.history_page + 1))
+        self.history_next.pack(side=tk.LEFT, padx=5)
+        self.history_label = ttk.Label(nav_frame)
+        self.history_label.pack(side=tk.LEFT, padx=10)
+        ttk.Button(nav_frame, text="Exportar CSV", command=self.export_history).pack(side=tk.RIGHT)
+        
+        self.load_history_page(0)
+        
+    def history_filters(self):
+        symbol = self.history_symbol.get()
+        kind = self.history_kind.get()
+        days = HISTORY_PERIODS[self.history_period.get()]
+        return {
+            "symbol": None if symbol == "Todos" else symbol,
+            "kind": None if kind == "Todos" else kind,
+            "since": None if days is None else time.time() - days * 86400
+        }
+        
+    def load_history_page(self, page):
+        """Muestra la página indicada; cada una continúa tras la última fila de la anterior"""
+        filters = self.history_filters()
+        if page == 0:
+            self.history_keys = [None]
+            counts = {}
+            for (symbol, kind), count in self.controller.model.journal.counts(**filters).items():
+                counts[kind] = counts.get(kind, 0) + count
+            self.history_counts.config(text=f"Total: {sum(counts.values())} alertas · " + " · ".join(
+                f"{kind} {counts.get(kind, 0)}" for kind in LEVEL_KINDS))
+        rows = self.controller.model.journal.query(after=self.history_keys[page], **filters)
+        self.history_page = page
+        if len(self.history_keys) == page + 1 and len(rows) == HISTORY_PAGE_SIZE:
+            self.history_keys.append((rows[-1]['detected'], rows[-1]['id']))
+        
+        self.history_tree.delete(*self.history_tree.get_children())
+        for row in rows:
+            self.history_tree.insert("", tk.END, values=(
+                datetime.fromtimestamp(row['detected'], pytz.utc).strftime("%Y-%m-%d %H:%M:%S"),
+                row['symbol'], row['kind'], row['level'],
+                "" if row['price'] is None else row['price'], row['timeframe'],
+                datetime.fromtimestamp(row['candle_time'], pytz.utc).strftime("%Y-%m-%d %H:%M:%S")
+            ))
+        self.history_prev.config(state='normal' if page > 0 else 'disabled')
+        self.history_next.config(state='normal' if len(self.history_keys) > page + 1 else 'disabled')
+        self.history_label.config(text=f"Página {page + 1} · {len(rows)} alertas")
+        
+    def export_history(self):
+        filename = filedialog.asksaveasfilename(
+            title='Exportar historial de alertas',
+            defaultextension='.csv',
+            filetypes=(('CSV', '*.csv'), ('Todos los archivos', '*.*'))
+        )
+        if not filename:
+            return
+        try:
+            count = self.controller.model.journal.export_csv(filename, **self.history_filters())
+            messagebox.showinfo("Historial", f"{count} alertas exportadas a {filename}")
+        except Exception as e:
+            self.show_error(f"No se pudo exportar el historial: {e}")
+        
+    def update_resources(self):
+        """Lectura periódica de temporizadores y ventanas vivas (debe mantenerse plana)"""
+        stats = self.alert_windows.stats()
+        self.resources_label.config(
+            text=f"after: {stats['after']} · Toplevel: {stats['toplevels']} · "
+                 f"alertas: {stats['alert_windows']}/{self.alert_windows.max_windows}"
+        )
+        self.root.after(5000, self.update_resources)
         
     def show_error(self, message):
         messagebox.showerror("Error", message)
@@ -701,61 +4155,26 @@ class TradingAlarmController:
     def __init__(self, root):
         self.model = TradingAlarmModel()
         self.view = TradingAlarmView(root, self)
-        self.monitoring_thread = None
-        self.monitoring_active = False
+        self.alerts = AlertDispatcher(root, self.view.show_alerts, self.play_sound)
+        self.alerts.start()
+        # La interfaz es un cliente del mismo motor que el modo --headless
+        self.engine = MonitorEngine(
+            self.model,
+            [CallbackSink(lambda alert: self.alerts.submit(alert['symbol'], alert['signal'], alert['batch']))],
+            on_error=lambda message: root.after(0, lambda: self.view.show_error(message))
+        )
+        
+    @property
+    def monitoring_active(self):
+        return self.engine.active
         
     def start_monitoring(self):
         """Inicia el monitoreo en un hilo separado"""
-        if self.monitoring_active:
-            return
-            
-        self.monitoring_active = True
-        self.monitoring_thread = threading.Thread(target=self.run_monitoring, daemon=True)
-        self.monitoring_thread.start()
+        self.engine.start()
         
     def stop_monitoring(self):
-        """Detiene el monitoreo"""
-        self.monitoring_active = False
-        
-    def run_monitoring(self):
-        """Ejecuta el monitoreo continuo"""
-        while self.monitoring_active:
-            try:
-                # Convertir login a entero para la conexión
-                login = int(self.model.config['mt5_login'])
-                
-                if not mt5.initialize(
-                    server=self.model.config['mt5_server'],
-                    login=login,
-                    password=self.model.config['mt5_password']
-                ):
-                    error = mt5.last_error()
-                    raise Exception(f"Error de conexión MT5: {error}")
-                
-                # Analizar cada par seleccionado
-                for symbol in self.model.config['selected_pairs']:
-                    if not self.monitoring_active:
-                        break
-                        
-                    try:
-                        signals = self.model.analyze_pair(symbol)
-                        for signal in signals:
-                            self.view.root.after(0, lambda msg=f"{symbol}: {signal}": self.view.show_alarm(msg))
-                    except Exception as e:
-                        self.view.root.after(0, lambda msg=str(e): self.view.show_error(msg))
-                
-                # Esperar hasta el próximo intervalo
-                sleep_time = self.model.config['timeframe'] * 60
-                for _ in range(sleep_time):
-                    if not self.monitoring_active:
-                        break
-                    time.sleep(1)
-                    
-            except Exception as e:
-                self.view.root.after(0, lambda msg=str(e): self.view.show_error(msg))
-                time.sleep(5)  # Esperar antes de reintentar
-            finally:
-                mt5.shutdown()
+        """Detiene el monitoreo de inmediato"""
+        self.engine.stop()
     
     def set_audio_file(self, audio_file):
         self.model.set_audio_file(audio_file)
@@ -766,25 +4185,199 @@ class TradingAlarmController:
     def set_selected_pairs(self, pairs):
         self.model.set_selected_pairs(pairs)
         
+    def set_analysis_workers(self, workers):
+        self.model.set_analysis_workers(workers)
+        
+    def set_detection_mode(self, mode):
+        self.model.set_detection_mode(mode)
+        
+    def set_multi_timeframe(self, enabled):
+        self.model.set_multi_timeframe(enabled)
+        
     def set_mt5_credentials(self, login, password, server):
         self.model.set_mt5_credentials(login, password, server)
         
     def play_sound(self):
         self.model.play_sound()
 
-def main():
-    # Verificar dependencias
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Alarma de rupturas PDH/PDL/PSH/PSL para MetaTrader 5")
+    parser.add_argument("--headless", action="store_true",
+                        help="ejecuta el monitor sin interfaz gráfica")
+    parser.add_argument("--sink", action="append", default=[],
+                        help="destino de alertas: stdout | jsonl:RUTA | socket:HOST:PUERTO | "
+                             "socket:RUTA | webhook:URL (repetible; por defecto stdout)")
+    parser.add_argument("--pairs", help="pares separados por comas (por defecto los de la configuración)")
+    parser.add_argument("--timeframe", type=int, choices=sorted(set(TIMEFRAMES.values())),
+                        help="timeframe en minutos")
+    parser.add_argument("--source", choices=["mt5", "replay"], help="fuente de datos")
+    parser.add_argument("--replay-dir", help="directorio de datos grabados para --source replay")
+    parser.add_argument("--duration", type=float, help="segundos de ejecución (por defecto sin límite)")
+    parser.add_argument("--metrics-port", type=int, help="puerto local para /metrics y /metrics.json")
+    parser.add_argument("--export-history", metavar="RUTA",
+                        help="exporta el historial de alertas a CSV (filtrado por --pairs) y termina")
+    parser.add_argument("--history-counts", action="store_true",
+                        help="muestra el número de alertas por par y nivel (filtrado por --pairs) y termina")
+    parser.add_argument("--days", type=float,
+                        help="con --export-history o --history-counts, solo los últimos N días; "
+                             "con --backtest, días de histórico (30)")
+    parser.add_argument("--backtest", metavar="RUTA",
+                        help="backtest de --pairs sobre el histórico (M1 o --timeframe), informe CSV en RUTA")
+    parser.add_argument("--offline", action="store_true",
+                        help="con --backtest, usa solo el almacén local de velas, sin terminal")
+    parser.add_argument("--server-zone", type=float,
+                        help="con --backtest, huso del servidor en horas respecto a UTC "
+                             "(por defecto se estima con los ticks; 0 con --offline)")
+    return parser.parse_args(argv)
+
+def cli_overrides(args):
+    """Ajustes de los argumentos: solo afectan a esta ejecución, no se guardan en la configuración"""
+    overrides = {}
+    if args.pairs:
+        overrides['selected_pairs'] = [pair.strip().upper() for pair in args.pairs.split(",") if pair.strip()]
+    if args.timeframe:
+        overrides['timeframe'] = args.timeframe
+    if args.source:
+        overrides['data_source'] = args.source
+    if args.replay_dir:
+        overrides['replay_dir'] = args.replay_dir
+    if args.metrics_port is not None:
+        overrides['metrics_port'] = args.metrics_port
+    return overrides
+
+def run_backtest(args):
+    """Backtest de los pares sobre el histórico de la fuente configurada y exporta el informe"""
+    model = TradingAlarmModel()
+    model.store.override(cli_overrides(args))
+    pairs = model.config['selected_pairs']
+    timeframe = MINUTE_TIMEFRAMES[args.timeframe or 1]
+    backtester = BreakoutBacktester(model.config['market_sessions'])
+    if args.server_zone is not None:
+        backtester.zone = int(round(args.server_zone * 3600))
+    try:
+        if args.offline:
+            store_dir = model.bar_store_path()
+            if not store_dir:
+                raise Exception("--offline requiere un almacén local (bar_store_dir)")
+            reports = backtester.run_store(BarStore(store_dir), pairs, timeframe)
+        else:
+            connection = model.get_connection()
+            connection.ensure_connected()
+            # Las velas van en hora del servidor: el huso sale del último tick
+            connection.server_time(pairs[0])
+            if args.server_zone is None:
+                backtester.zone = connection.clock.zone()
+            now = connection.clock.now()
+            start = now - timedelta(days=args.days or 30)
+            history = {}
+            for symbol in pairs:
+                name = connection.symbol_index.resolve(symbol) or symbol
+                rates = connection.source.copy_rates_range(name, timeframe, start, now)
+                history[symbol] = rates if rates is not None else np.zeros(0, dtype=RATES_DTYPE)
+                print(f"📥 {symbol} {TIMEFRAME_NAMES[timeframe]}: {len(history[symbol])} velas", file=sys.stderr)
+            reports = backtester.run_many(history, TIMEFRAME_SECONDS[timeframe])
+        for symbol, counts in backtester.summary(reports).items():
+            print(f"📊 {symbol}: " + ", ".join(f"{kind} {count}" for kind, count in counts.items()), file=sys.stderr)
+        BreakoutBacktester.to_csv(reports, args.backtest)
+        print(f"💾 {sum(len(report) for report in reports.values())} señales -> {args.backtest}", file=sys.stderr)
+    finally:
+        model.close_connection()
+        model.close()
+
+def run_headless(args):
+    """Monitor en primer plano sin Tk: las alertas van a los sumideros indicados"""
+    import signal as process_signals
+    
+    model = TradingAlarmModel()
+    model.store.override(cli_overrides(args))
+    
+    engine = MonitorEngine(model, [create_sink(spec) for spec in args.sink or ["stdout"]])
+    # stdout queda solo para las alertas JSONL; el diagnóstico va a stderr
+    sys.stdout = sys.stderr
+    stop_event = engine.stop_event
+    process_signals.signal(process_signals.SIGTERM, lambda signum, frame: stop_event.set())
+    if args.duration:
+        timer = threading.Timer(args.duration, stop_event.set)
+        timer.daemon = True
+        timer.start()
+    
+    print(f"🚀 Monitor sin interfaz: {', '.join(model.config['selected_pairs'])}", file=sys.stderr)
+    try:
+        engine.active = True
+        engine.run(stop_event)
+    except KeyboardInterrupt:
+        stop_event.set()
+    finally:
+        engine.active = False
+        engine.close()
+        model.close()
+
+def history_filters(args):
+    """Filtros del historial según --pairs y --days"""
+    pairs = [pair.strip().upper() for pair in args.pairs.split(",") if pair.strip()] if args.pairs else None
+    since = time.time() - args.days * 86400 if args.days else None
+    return {"symbol": pairs, "since": since}
+
+def export_history(args):
+    """Exporta el historial de alertas sin arrancar el monitor"""
+    model = TradingAlarmModel()
     try:
-        import MetaTrader5 as mt5
-    except ImportError:
+        if model.journal is None:
+            print("El historial de alertas está desactivado (alert_journal)", file=sys.stderr)
+            sys.exit(1)
+        count = model.journal.export_csv(args.export_history, **history_filters(args))
+        print(f"💾 {count} alertas exportadas a {args.export_history}", file=sys.stderr)
+    finally:
+        model.close()
+
+def history_counts(args):
+    """Imprime el número de alertas por par y nivel sin arrancar el monitor"""
+    model = TradingAlarmModel()
+    try:
+        if model.journal is None:
+            print("El historial de alertas está desactivado (alert_journal)", file=sys.stderr)
+            sys.exit(1)
+        counts = model.journal.counts(**history_filters(args))
+        for (symbol, kind), count in sorted(counts.items()):
+            print(f"{symbol}\t{kind}\t{count}")
+        print(f"📊 {sum(counts.values())} alertas", file=sys.stderr)
+    finally:
+        model.close()
+
+def main(argv=None):
+    args = parse_args(argv)
+    
+    if args.export_history:
+        export_history(args)
+        return
+    if args.history_counts:
+        history_counts(args)
+        return
+    
+    # Verificar dependencias
+    global mt5, MT5_AVAILABLE
+    if not MT5_AVAILABLE and args.source != "replay":
         print("Advertencia: MetaTrader5 no está instalado. Intentando instalar...")
         try:
             import subprocess
             subprocess.check_call([sys.executable, "-m", "pip", "install", "MetaTrader5"])
             import MetaTrader5 as mt5
+            MT5_AVAILABLE = True
         except:
-            print("No se pudo instalar MetaTrader5. La aplicación no funcionará correctamente.")
-            sys.exit(1)
+            # Sin terminal solo queda disponible la reproducción de datos grabados
+            print("No se pudo instalar MetaTrader5. Solo se podrán reproducir datos grabados.")
+    
+    if args.backtest:
+        run_backtest(args)
+        return
+    
+    if args.headless:
+        run_headless(args)
+        return
+    
+    if not GUI_AVAILABLE:
+        print("Error: tkinter/PIL no están disponibles. Usa --headless para ejecutar sin interfaz.")
+        sys.exit(1)
     
     root = tk.Tk()
     
@@ -797,6 +4390,14 @@ def main():
     
     controller = TradingAlarmController(root)
     root.mainloop()
+    # El hilo de monitoreo termina su ciclo (y guarda la instantánea) antes de
+    # cerrar los sumideros; los cambios de configuración pendientes se escriben al final
+    engine = controller.engine
+    engine.stop()
+    if engine.thread is not None:
+        engine.thread.join(timeout=10)
+    engine.close()
+    controller.model.close()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,166 @@
+"""Micro-benchmarks del camino crítico de análisis.
+
+Uso:
+    python benchmark.py
+"""
+import time
+import timeit
+
+import numpy as np
+
+from alarma import (FOREX_PAIRS, LEVEL_KINDS, RATES_DTYPE, BarArray, BatchLevelEvaluator,
+                    BreakoutBacktester)
+
+
+def make_rates(count, timeframe_seconds=60, start=1_700_000_000):
+    """Genera velas sintéticas con la misma estructura que copy_rates_*"""
+    rng = np.random.default_rng(42)
+    rates = np.zeros(count, dtype=RATES_DTYPE)
+    rates['time'] = start + np.arange(count) * timeframe_seconds
+    close = 1.1 + np.cumsum(rng.normal(0, 0.0002, count))
+    rates['open'] = np.concatenate(([close[0]], close[:-1]))
+    rates['close'] = close
+    spread = np.abs(rng.normal(0, 0.0003, count))
+    rates['high'] = np.maximum(rates['open'], rates['close']) + spread
+    rates['low'] = np.minimum(rates['open'], rates['close']) - spread
+    return rates
+
+
+def breakout_checks(candles, previous_day, previous_session):
+    """Las cuatro condiciones de ruptura de analyze_signals"""
+    pen, last = candles['penultimate'], candles['last']
+    signals = []
+    for level, is_high in ((previous_day['high'], True), (previous_day['low'], False),
+                           (previous_session['high'], True), (previous_session['low'], False)):
+        if is_high:
+            hit = ((pen['high'] >= level and pen['low'] < level) or
+                   (last['high'] >= level and last['low'] < level))
+        else:
+            hit = ((pen['high'] > level and pen['low'] <= level) or
+                   (last['high'] > level and last['low'] <= level))
+        signals.append(hit)
+    return signals
+
+
+def analysis_with_pandas(day_rates, session_rates, candle_rates):
+    """Camino anterior: DataFrame + to_datetime + iloc por cada consulta"""
+    import pandas as pd
+
+    df = pd.DataFrame(day_rates)
+    df['time'] = pd.to_datetime(df['time'], unit='s')
+    previous_day = {
+        "high": df['high'].iloc[0], "low": df['low'].iloc[0],
+        "open": df['open'].iloc[0], "close": df['close'].iloc[0]
+    }
+
+    df = pd.DataFrame(session_rates)
+    df['time'] = pd.to_datetime(df['time'], unit='s')
+    previous_session = {
+        "high": df['high'].max(), "low": df['low'].min(),
+        "open": df['open'].iloc[0], "close": df['close'].iloc[-1]
+    }
+
+    df = pd.DataFrame(candle_rates)
+    df['time'] = pd.to_datetime(df['time'], unit='s')
+    candles = {"penultimate": df.iloc[-2], "last": df.iloc[-1]}
+
+    return breakout_checks(candles, previous_day, previous_session)
+
+
+def analysis_with_bar_array(day_rates, session_rates, candle_rates):
+    """Camino actual: acceso directo al array estructurado"""
+    day = BarArray(day_rates).candle(0)
+    previous_day = {"high": day['high'], "low": day['low'],
+                    "open": day['open'], "close": day['close']}
+
+    bars = BarArray(session_rates)
+    previous_session = {"high": bars.high(), "low": bars.low(),
+                        "open": bars.open(), "close": bars.close()}
+
+    bars = BarArray(candle_rates)
+    candles = {"penultimate": bars.candle(-2), "last": bars.candle(-1)}
+
+    return breakout_checks(candles, previous_day, previous_session)
+
+
+def bench_bar_access(number=2000):
+    """Tiempo de análisis por símbolo: pandas frente a BarArray"""
+    day_rates = make_rates(1, 86400)
+    session_rates = make_rates(300, 60)  # Sesión de Londres en M1
+    candle_rates = make_rates(3, 300)
+
+    print("\n⏱️ Análisis por símbolo (día + sesión de 300 velas + 3 velas actuales)")
+    try:
+        # Ambos caminos deben producir exactamente las mismas señales
+        assert (analysis_with_pandas(day_rates, session_rates, candle_rates) ==
+                analysis_with_bar_array(day_rates, session_rates, candle_rates))
+        legacy = min(timeit.repeat(
+            lambda: analysis_with_pandas(day_rates, session_rates, candle_rates),
+            number=number, repeat=5)) / number
+    except ImportError:
+        legacy = None
+        print("• pandas no está instalado, se omite la referencia")
+    current = min(timeit.repeat(
+        lambda: analysis_with_bar_array(day_rates, session_rates, candle_rates),
+        number=number, repeat=5)) / number
+
+    if legacy is not None:
+        print(f"• pandas:   {legacy * 1e6:9.1f} µs")
+    print(f"• BarArray: {current * 1e6:9.1f} µs")
+    if legacy is not None:
+        print(f"• Mejora:   x{legacy / current:.1f}")
+
+
+def bench_batch_evaluator(symbols=1000, number=2000):
+    """Evaluación de las cuatro rupturas para toda la lista de símbolos"""
+    rng = np.random.default_rng(7)
+    names = [f"SYM{i:04d}" for i in range(symbols)]
+    evaluator = BatchLevelEvaluator(names)
+    evaluator.highs[:] = 1.1 + rng.normal(0, 0.001, (2, symbols))
+    evaluator.lows[:] = evaluator.highs - np.abs(rng.normal(0, 0.001, (2, symbols)))
+    evaluator.levels[:] = 1.1 + rng.normal(0, 0.002, (len(LEVEL_KINDS), symbols))
+
+    # Referencia escalar: las condiciones de analyze_signals símbolo a símbolo
+    def scalar():
+        result = np.zeros(symbols, dtype=np.uint8)
+        for row in range(symbols):
+            pen = {"high": evaluator.highs[0, row], "low": evaluator.lows[0, row]}
+            last = {"high": evaluator.highs[1, row], "low": evaluator.lows[1, row]}
+            day = {"high": evaluator.levels[0, row], "low": evaluator.levels[1, row]}
+            session = {"high": evaluator.levels[2, row], "low": evaluator.levels[3, row]}
+            hits = breakout_checks({"penultimate": pen, "last": last}, day, session)
+            result[row] = sum(1 << i for i, hit in enumerate(hits) if hit)
+        return result
+
+    assert np.array_equal(scalar(), evaluator.evaluate())
+
+    print(f"\n⏱️ Evaluación de rupturas para {symbols} símbolos")
+    loop = min(timeit.repeat(scalar, number=max(1, number // 100), repeat=3)) / max(1, number // 100)
+    batch = min(timeit.repeat(evaluator.evaluate, number=number, repeat=5)) / number
+    print(f"• Escalar:          {loop * 1e6:9.1f} µs")
+    print(f"• Por lotes (NumPy): {batch * 1e6:8.1f} µs")
+    print(f"• Mejora:   x{loop / batch:.1f}")
+
+
+def bench_backtest(years=2):
+    """Backtest de todos los pares sobre varios años de velas M1"""
+    count = years * 365 * 24 * 60
+    backtester = BreakoutBacktester()
+    print(f"\n⏱️ Backtest vectorizado: {years} años de M1 para {len(FOREX_PAIRS)} pares")
+    total = 0.0
+    signals = 0
+    for symbol in FOREX_PAIRS:
+        rates = make_rates(count, 60)
+        started = time.perf_counter()
+        report = backtester.run(rates, 60)
+        total += time.perf_counter() - started
+        signals += len(report)
+    print(f"• Velas:   {count * len(FOREX_PAIRS):,}")
+    print(f"• Señales: {signals:,}")
+    print(f"• Tiempo:  {total:.2f} s")
+
+
+if __name__ == "__main__":
+    bench_bar_access()
+    bench_batch_evaluator()
+    bench_backtest()
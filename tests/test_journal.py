@@ -0,0 +1,24 @@
+"""Historial de alertas (AlertJournal) y sus consultas desde la línea de comandos"""
+import time
+
+import alarma
+
+
+def record(journal, symbol, kind, detected):
+    journal.record(symbol, alarma.Breakout(symbol, kind, 1.1, 1.1001, detected - 60), 5, detected)
+
+
+def test_history_counts(tmp_path, monkeypatch, capsys):
+    """--history-counts agrega por par y nivel con los mismos filtros que la exportación"""
+    monkeypatch.chdir(tmp_path)
+    now = time.time()
+    journal = alarma.AlertJournal(alarma.JOURNAL_FILE)
+    for symbol, kind, age_days in (("EURUSD", "PDH", 0), ("EURUSD", "PDH", 1), ("EURUSD", "PSL", 1),
+                                   ("GBPUSD", "PDL", 0), ("EURUSD", "PDH", 10)):
+        record(journal, symbol, kind, now - age_days * 86400)
+    journal.close()
+    assert journal.counts(since=now - 2 * 86400) == {
+        ("EURUSD", "PDH"): 2, ("EURUSD", "PSL"): 1, ("GBPUSD", "PDL"): 1}
+
+    alarma.main(["--history-counts", "--pairs", "eurusd", "--days", "2"])
+    assert capsys.readouterr().out.splitlines() == ["EURUSD\tPDH\t2", "EURUSD\tPSL\t1"]
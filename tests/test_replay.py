@@ -0,0 +1,428 @@
+"""Reproducción de datos grabados a través de la conexión, los analizadores y el motor.
+
+Los datos se generan en tmp_path con el formato de ReplayDataSource; salvo en
+la prueba del motor, el reloj simulado va a velocidad 0 y las pruebas lo
+avanzan moviendo source.start.
+"""
+import json
+import threading
+from datetime import datetime
+
+import numpy as np
+import pytest
+import pytz
+
+import alarma
+
+# 2024-03-04 00:00 UTC (lunes)
+T0 = 1709510400
+DAY = 86400
+M5 = 300
+
+
+def make_bars(start, count, period, base=1.1000, step=0.0001):
+    """Velas en zigzag: el precio sube 12 velas y baja otras 12"""
+    bars = np.zeros(count, dtype=alarma.RATES_DTYPE)
+    offsets = np.abs((np.arange(count) % 24) - 12) * step
+    bars['time'] = start + np.arange(count) * period
+    bars['open'] = base + offsets
+    bars['close'] = base + offsets + step / 2
+    bars['high'] = bars['close'] + step
+    bars['low'] = bars['open'] - step
+    bars['tick_volume'] = 10
+    bars['spread'] = 1
+    return bars
+
+
+def trending_bars(start, days=4):
+    """Zigzag con tendencia: cada ventana tiene sus propios extremos"""
+    bars = make_bars(start, days * DAY // M5, M5)
+    bars['high'] += np.arange(len(bars)) * 1e-6
+    bars['low'] += np.arange(len(bars)) * 1e-6
+    return bars
+
+
+def daily_bars(bars):
+    """Velas D1 agregadas a partir de velas intradía"""
+    days = bars['time'] // DAY
+    result = []
+    for day in np.unique(days):
+        chunk = bars[days == day]
+        result.append((day * DAY, chunk['open'][0], chunk['high'].max(), chunk['low'].min(),
+                       chunk['close'][-1], int(chunk['tick_volume'].sum()), 1, 0))
+    return np.array(result, dtype=alarma.RATES_DTYPE)
+
+
+def write_replay(directory, symbol="EURUSD", days=4, bars=None, ticks=None):
+    """Graba velas M1, M5 y D1 (y ticks) de un símbolo; devuelve las velas M5.
+
+    Sin ticks grabados la cotización de ReplayDataSource sale de las velas M1.
+    """
+    if bars is None:
+        bars = make_bars(T0, days * DAY // M5, M5)
+    np.save(directory / f"{symbol}_M1.npy", make_bars(T0, days * DAY // 60, 60))
+    np.save(directory / f"{symbol}_M5.npy", bars)
+    if ticks is not None:
+        np.save(directory / f"{symbol}_ticks.npy", ticks)
+    np.save(directory / f"{symbol}_D1.npy", daily_bars(bars))
+    (directory / "symbols.json").write_text(json.dumps({symbol: {"digits": 5}}), encoding="utf-8")
+    return bars
+
+
+class OffsetSource:
+    """Broker en UTC+2: las velas y los ticks van dos horas por delante del reloj local"""
+    def __init__(self, source, offset=7200):
+        self.source = source
+        self.offset = offset
+        self.range_calls = []
+
+    def __getattr__(self, name):
+        return getattr(self.source, name)
+
+    def time(self):
+        return self.source.time() - self.offset
+
+    def now(self):
+        return datetime.fromtimestamp(self.time(), pytz.utc)
+
+    def copy_rates_range(self, symbol, timeframe, date_from, date_to):
+        self.range_calls.append((date_from, date_to))
+        return self.source.copy_rates_range(symbol, timeframe, date_from, date_to)
+
+
+def replay_connection(tmp_path, server_start, offset=0, sessions=None, **recorded):
+    """Conexión sobre datos grabados; devuelve (conexión, reproducción, fuente, velas M5)"""
+    bars = write_replay(tmp_path, **recorded)
+    replay = alarma.ReplayDataSource(str(tmp_path), speed=0, start=server_start)
+    source = OffsetSource(replay, offset)
+    connection = alarma.MT5ConnectionManager(source=source, sessions=sessions)
+    connection.connect()
+    return connection, replay, source, bars
+
+
+def window(bars, start, end):
+    return bars[(bars['time'] >= start) & (bars['time'] < end)]
+
+
+def with_breakout(bars, start, end, above):
+    """Copia de las velas con las de [start, end) cruzando el nivel above"""
+    bars = bars.copy()
+    inside = (bars['time'] >= start) & (bars['time'] < end)
+    bars['high'][inside] = above + 0.0005
+    bars['low'][inside] = above - 0.0002
+    return bars
+
+
+def make_ticks(start, bids):
+    """Un tick por segundo desde start con los bids indicados"""
+    ticks = np.zeros(len(bids), dtype=alarma.TICKS_DTYPE)
+    ticks['time'] = start + np.arange(len(bids))
+    ticks['time_msc'] = ticks['time'] * 1000
+    ticks['bid'] = bids
+    ticks['ask'] = ticks['bid'] + 0.00001
+    return ticks
+
+
+def test_levels_from_replay(tmp_path):
+    """PDH/PDL del día anterior y PSH/PSL de Tokio (00:00-08:00) sin consultas extra"""
+    connection, replay, source, bars = replay_connection(tmp_path, T0 + 2 * DAY + 10 * 3600 + 2)
+    analyzer = connection.get_analyzer("EURUSD", 5)
+
+    analyzer._get_current_candles()
+    levels = analyzer.get_levels()
+    day = window(bars, T0 + DAY, T0 + 2 * DAY)
+    session = window(bars, T0 + 2 * DAY, T0 + 2 * DAY + 8 * 3600)
+    assert levels == {
+        "PDH": day['high'].max(), "PDL": day['low'].min(),
+        "PSH": session['high'].max(), "PSL": session['low'].min()
+    }
+    # Los niveles salen del agregador sembrado: una única descarga
+    assert len(source.range_calls) == 1
+
+
+def test_aggregator_follows_server_clock(tmp_path):
+    """Con el servidor en UTC+2 el agregador no se queda atrás ni repite descargas"""
+    connection, replay, source, bars = replay_connection(tmp_path, T0 + 2 * DAY + 10 * 3600 + 2, 7200)
+    analyzer = connection.get_analyzer("EURUSD", 5)
+
+    analyzer._get_current_candles()
+    assert len(source.range_calls) == 1
+    assert analyzer.aggregator.last_time == T0 + 2 * DAY + 10 * 3600 - M5
+
+    for cycle in range(1, 4):
+        replay.start += M5
+        analyzer._get_current_candles()
+        assert analyzer.aggregator.last_time == T0 + 2 * DAY + 10 * 3600 + (cycle - 1) * M5
+    # Solo la siembra inicial consulta el rango
+    assert len(source.range_calls) == 1
+
+
+def test_day_levels_use_server_day(tmp_path):
+    """A las 00:30 del servidor (22:30 locales) el día anterior ya es el del servidor"""
+    connection, replay, source, bars = replay_connection(tmp_path, T0 + 2 * DAY + 1800, 7200)
+    analyzer = connection.get_analyzer("EURUSD", 5)
+
+    day = analyzer._get_previous_day_data()
+    previous = bars[(bars['time'] >= T0 + DAY) & (bars['time'] < T0 + 2 * DAY)]
+    assert day['date'] == "2024-03-05"
+    assert day['high'] == previous['high'].max()
+    assert day['low'] == previous['low'].min()
+
+
+@pytest.mark.parametrize("first_day, query, session", [
+    # Nueva York en invierno (13:00-22:00 UTC): 15:00-24:00 en el servidor UTC+2
+    ("2024-03-04", "2024-03-06 22:30", ("2024-03-06 15:00:00", "2024-03-07 00:00:00")),
+    # Nueva York ya en horario de verano (12:00-21:00 UTC): 14:00-23:00 en el servidor
+    ("2024-03-11", "2024-03-13 21:30", ("2024-03-13 14:00:00", "2024-03-13 23:00:00")),
+])
+def test_local_sessions_on_offset_server(tmp_path, first_day, query, session):
+    """Con un broker en UTC+2 las sesiones en hora local se sitúan en hora del servidor"""
+    start = int(datetime.strptime(first_day, "%Y-%m-%d").replace(tzinfo=pytz.utc).timestamp())
+    bars = trending_bars(start)
+    utc = int(datetime.strptime(query, "%Y-%m-%d %H:%M").replace(tzinfo=pytz.utc).timestamp())
+    connection, replay, source, bars = replay_connection(
+        tmp_path, utc + 7200, 7200, sessions=alarma.MARKET_SESSIONS_LOCAL, bars=bars)
+    analyzer = connection.get_analyzer("EURUSD", 5)
+
+    analyzer._get_current_candles()
+    data = analyzer._get_previous_session_data()
+    assert data['name'] == "New York"
+    assert (data['start'], data['end']) == session
+    expected = window(bars, *(int(datetime.strptime(value, "%Y-%m-%d %H:%M:%S")
+                                  .replace(tzinfo=pytz.utc).timestamp()) for value in session))
+    assert (data['high'], data['low']) == (expected['high'].max(), expected['low'].min())
+
+
+def test_aggregated_sessions_on_offset_server(tmp_path):
+    """El agregador corta las sesiones UTC en hora del servidor y las sirve sin consultas"""
+    bars = trending_bars(T0)
+    # 08:05 UTC: Tokio (00:00-08:00 UTC) es la sesión anterior, 02:00-10:00 en el servidor
+    connection, replay, source, bars = replay_connection(
+        tmp_path, T0 + 2 * DAY + 10 * 3600 + 5 * 60 + 2, 7200, bars=bars)
+    analyzer = connection.get_analyzer("EURUSD", 5)
+
+    analyzer._get_current_candles()
+    levels = analyzer.get_levels()
+    tokyo = window(bars, T0 + 2 * DAY + 2 * 3600, T0 + 2 * DAY + 10 * 3600)
+    assert (levels['PSH'], levels['PSL']) == (tokyo['high'].max(), tokyo['low'].min())
+    assert len(source.range_calls) == 1
+
+    # El backtest aplica el mismo huso a las velas del histórico
+    backtester = alarma.BreakoutBacktester(zone=7200)
+    levels = backtester.levels(bars)
+    column = np.searchsorted(bars['time'], T0 + 2 * DAY + 10 * 3600 + 5 * 60)
+    assert (levels[2, column], levels[3, column]) == (tokyo['high'].max(), tokyo['low'].min())
+
+
+def test_aggregator_rollover_session_and_day(tmp_path):
+    """Al cerrar Londres y al cambiar de día los niveles nuevos salen del agregador"""
+    connection, replay, source, bars = replay_connection(tmp_path, T0 + 2 * DAY + 12 * 3600 + 57 * 60)
+    analyzer = connection.get_analyzer("EURUSD", 5)
+    analyzer._get_current_candles()
+    tokyo = window(bars, T0 + 2 * DAY, T0 + 2 * DAY + 8 * 3600)
+    assert analyzer.get_levels()['PSH'] == tokyo['high'].max()
+
+    # 13:00: cierra Londres (08:00-13:00)
+    replay.start = T0 + 2 * DAY + 13 * 3600 + 5 * 60 + 2
+    analyzer._get_current_candles()
+    london = window(bars, T0 + 2 * DAY + 8 * 3600, T0 + 2 * DAY + 13 * 3600)
+    levels = analyzer.get_levels()
+    assert (levels['PSH'], levels['PSL']) == (london['high'].max(), london['low'].min())
+
+    # Ciclo a ciclo hasta pasar la medianoche: el día 2 pasa a ser el anterior
+    while replay.start < T0 + 3 * DAY + 5 * 60:
+        replay.start += M5
+        analyzer._get_current_candles()
+    day = window(bars, T0 + 2 * DAY, T0 + 3 * DAY)
+    levels = analyzer.get_levels()
+    assert (levels['PDH'], levels['PDL']) == (day['high'].max(), day['low'].min())
+    assert len(source.range_calls) == 1
+
+
+def test_one_fire_per_crossing_ticks(tmp_path):
+    """Un tick que sigue por encima del nivel no repite la alerta; tras alejarse sí"""
+    bars = make_bars(T0, 4 * DAY // M5, M5)
+    pdh = window(bars, T0 + DAY, T0 + 2 * DAY)['high'].max()
+    start = T0 + 2 * DAY + 10 * 3600
+    bids = [pdh - 0.0005, pdh + 0.0001, pdh + 0.0002, pdh + 0.0003,
+            # Retroceso menor que la distancia de rearme (100 puntos) y nuevo cruce
+            pdh - 0.0002, pdh + 0.0001,
+            # Se aleja más de 100 puntos: el nivel se rearma y el cruce vuelve a alertar
+            pdh - 0.0015, pdh + 0.0001, pdh + 0.0002]
+    connection, replay, source, bars = replay_connection(
+        tmp_path, start, bars=bars, ticks=make_ticks(start, bids))
+    fired = []
+    watcher = alarma.TickBreakoutWatcher(connection, 5, lambda symbol, signal: fired.append(signal),
+                                         rearm_points=100)
+    for second in range(len(bids)):
+        replay.start = start + second
+        watcher.poll(["EURUSD"])
+    assert fired.count(alarma.SIGNAL_LABELS["PDH"]) == 2
+
+
+def test_crossing_between_polls(tmp_path):
+    """Un cruce que vuelve por debajo del nivel antes del siguiente sondeo alerta una vez"""
+    bars = make_bars(T0, 4 * DAY // M5, M5)
+    pdh = window(bars, T0 + DAY, T0 + 2 * DAY)['high'].max()
+    start = T0 + 2 * DAY + 10 * 3600
+    bids = [pdh - 0.0005, pdh - 0.0001, pdh + 0.0003, pdh - 0.0001, pdh - 0.0002, pdh - 0.0003]
+    connection, replay, source, bars = replay_connection(
+        tmp_path, start, bars=bars, ticks=make_ticks(start, bids))
+    fired = []
+    watcher = alarma.TickBreakoutWatcher(connection, 5, lambda symbol, signal: fired.append(signal))
+    # Sondeos en los segundos 0, 4 y 5: los extremos de los ticks intermedios no se pierden
+    for second in (0, 4, 5):
+        replay.start = start + second
+        watcher.poll(["EURUSD"])
+    assert fired.count(alarma.SIGNAL_LABELS["PDH"]) == 1
+
+
+def test_one_fire_per_crossing_candles(tmp_path, monkeypatch):
+    """Con velas, la misma ruptura en ciclos sucesivos alerta una sola vez"""
+    monkeypatch.chdir(tmp_path)
+    bars = make_bars(T0, 4 * DAY // M5, M5)
+    pdh = window(bars, T0 + DAY, T0 + 2 * DAY)['high'].max()
+    start = T0 + 2 * DAY + 10 * 3600
+    bars = with_breakout(bars, start, start + 3 * M5, pdh)
+    (tmp_path / "replay").mkdir()
+    write_replay(tmp_path / "replay", bars=bars)
+
+    model = alarma.TradingAlarmModel()
+    model.store.override({"data_source": "replay", "replay_dir": str(tmp_path / "replay"),
+                          "replay_speed": 0, "timeframe": 5, "multi_timeframe": False,
+                          "alert_journal": False})
+    try:
+        replay = model.get_connection().source.source
+        replay.start = start + M5 + 2
+        assert alarma.SIGNAL_LABELS["PDH"] in model.analyze_pair("EURUSD")
+        assert model.analyze_pair("EURUSD") == []
+        # Siguiente vela, aún por encima y sin alejarse del nivel
+        replay.start += M5
+        assert alarma.SIGNAL_LABELS["PDH"] not in model.analyze_pair("EURUSD")
+    finally:
+        model.close_connection()
+        model.close()
+
+
+def test_analyze_pairs_uses_cycle_snapshot(tmp_path, monkeypatch):
+    """Una recarga a mitad de ciclo no cambia los valores con los que se analiza"""
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "replay").mkdir()
+    write_replay(tmp_path / "replay")
+    model = alarma.TradingAlarmModel()
+    model.store.override({"data_source": "replay", "replay_dir": str(tmp_path / "replay"),
+                          "replay_speed": 1, "timeframe": 5, "multi_timeframe": False,
+                          "alert_journal": False})
+    try:
+        config = model.config
+        model.store.override({"timeframe": 1})
+        results = list(model.analyze_pairs(["EURUSD"], config))
+        assert [error for _, _, error in results] == [None]
+        assert set(model.connection.analyzers) == {("EURUSD", 5)}
+    finally:
+        model.close_connection()
+        model.close()
+
+
+def test_replay_gateway_stops_with_its_connection(tmp_path, monkeypatch):
+    """Cada conexión de reproducción detiene su pasarela al cerrarse"""
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "replay").mkdir()
+    write_replay(tmp_path / "replay")
+    model = alarma.TradingAlarmModel()
+    model.store.override({"data_source": "replay", "replay_dir": str(tmp_path / "replay"),
+                          "replay_speed": 1, "bar_store_dir": "", "alert_journal": False})
+    try:
+        gateway = model.get_connection().source
+        # Cambia la clave de la conexión: se crea otra fuente y la anterior se cierra
+        model.store.override({"replay_speed": 2})
+        replacement = model.get_connection().source
+        assert replacement is not gateway
+        assert not gateway.thread.is_alive()
+        with pytest.raises(Exception):
+            gateway.symbol_info("EURUSD")
+    finally:
+        model.close_connection()
+        model.close()
+    assert not replacement.thread.is_alive()
+
+
+def test_monitor_engine_replay(tmp_path, monkeypatch):
+    """El motor recorre la reproducción acelerada y entrega las alertas a los sumideros"""
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "replay").mkdir()
+    write_replay(tmp_path / "replay")
+
+    model = alarma.TradingAlarmModel()
+    model.store.override({"data_source": "replay", "replay_dir": str(tmp_path / "replay"),
+                          "replay_speed": 3000, "timeframe": 1, "multi_timeframe": False,
+                          "selected_pairs": ["EURUSD"], "detection_mode": "bars",
+                          "alert_journal": False, "notification_sinks": []})
+    alerts = []
+    errors = []
+    engine = alarma.MonitorEngine(model, sinks=[alarma.CallbackSink(alerts.append)], on_error=errors.append)
+    stop_event = threading.Event()
+    timer = threading.Timer(2.0, stop_event.set)
+    timer.start()
+    try:
+        engine.active = True
+        engine.run(stop_event)
+    finally:
+        timer.cancel()
+        engine.close()
+        model.close()
+    assert errors == []
+    assert alerts, "la reproducción cruza niveles y debe generar alertas"
+    assert all(alert['symbol'] == "EURUSD" for alert in alerts)
+    # Una alerta por (señal, ciclo): el estado no repite un cruce ya alertado
+    keys = [(alert['signal'], alert['batch']) for alert in alerts]
+    assert len(keys) == len(set(keys))
+    assert (tmp_path / alarma.SNAPSHOT_FILE).exists()
+
+
+def test_monitor_engine_rejects_stopped_clock(tmp_path, monkeypatch):
+    """replay_speed 0 detiene el reloj: el motor lo rechaza en lugar de esperar para siempre"""
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "replay").mkdir()
+    write_replay(tmp_path / "replay")
+
+    model = alarma.TradingAlarmModel()
+    model.store.override({"data_source": "replay", "replay_dir": str(tmp_path / "replay"),
+                          "replay_speed": 0, "selected_pairs": ["EURUSD"],
+                          "alert_journal": False, "notification_sinks": []})
+    errors = []
+    stop_event = threading.Event()
+    engine = alarma.MonitorEngine(model, sinks=[],
+                                  on_error=lambda error: (errors.append(error), stop_event.set()))
+    try:
+        engine.active = True
+        engine.run(stop_event)
+    finally:
+        engine.close()
+        model.close()
+    assert len(errors) == 1 and "replay_speed" in errors[0]
+
+
+@pytest.mark.parametrize("day, london, new_york", [
+    # Horario de invierno en ambas plazas
+    ("2024-03-08", 8, 13),
+    # Nueva York ya en horario de verano (10 de marzo), Londres aún no (31 de marzo)
+    ("2024-03-11", 8, 12),
+    # Ambas en horario de verano
+    ("2024-04-02", 7, 12),
+    # Londres vuelve al horario de invierno (27 de octubre), Nueva York aún no (3 de noviembre)
+    ("2024-10-28", 8, 12),
+])
+def test_calendar_dst(day, london, new_york):
+    """Las sesiones en hora local abren a la hora UTC que corresponde a cada fecha"""
+    calendar = alarma.SessionCalendar(alarma.MARKET_SESSIONS_LOCAL)
+    midnight = int(datetime.strptime(day, "%Y-%m-%d").replace(tzinfo=pytz.utc).timestamp())
+    for name, hour in (("London", london), ("New York", new_york)):
+        opened = midnight + hour * 3600
+        current = calendar.current(opened)
+        assert current[0] == name and current[1] == opened
+        # Un minuto antes aún no ha abierto
+        assert calendar.current(opened - 60)[0] != name
+        assert calendar.session_starts([opened])[0] == opened
+    # Londres dura 9 horas locales: a su cierre pasa a ser la sesión anterior
+    assert calendar.previous(midnight + (london + 9) * 3600)[0] == "London"
@@ -0,0 +1,164 @@
+"""Sumideros HTTP contra un servidor local que hace de endpoint del webhook"""
+import json
+import socket
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+import alarma
+
+
+class StandIn:
+    """Endpoint HTTP/1.1 local: registra cada petición y responde con statuses en orden.
+
+    Con gate sin activar, las respuestas esperan hasta que se active.
+    """
+    def __init__(self, statuses=()):
+        self.statuses = list(statuses)
+        self.requests = []
+        self.connections = 0
+        self.gate = threading.Event()
+        self.gate.set()
+        self.lock = threading.Lock()
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                super().setup()
+                with stand_in.lock:
+                    stand_in.connections += 1
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                with stand_in.lock:
+                    stand_in.requests.append((time.monotonic(), self.client_address, body))
+                    status = stand_in.statuses.pop(0) if stand_in.statuses else 200
+                stand_in.gate.wait(10)
+                self.send_response(status)
+                self.send_header("Content-Length", "2")
+                self.end_headers()
+                self.wfile.write(b"{}")
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/hook"
+
+    def bodies(self):
+        with self.lock:
+            return [body for _, _, body in self.requests]
+
+    def close(self):
+        self.gate.set()
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def stand_in():
+    server = StandIn()
+    yield server
+    server.close()
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def test_webhook_reuses_connection(stand_in):
+    """Varias alertas viajan por una única conexión keep-alive"""
+    sink = alarma.WebhookSink(stand_in.url, timeout=2)
+    try:
+        for index in range(5):
+            sink.send({"symbol": "EURUSD", "signal": "PDH", "batch": index})
+    finally:
+        sink.close()
+    assert [body['batch'] for body in stand_in.bodies()] == list(range(5))
+    assert stand_in.connections == 1
+    assert len({address for _, address, _ in stand_in.requests}) == 1
+
+
+def test_queued_sink_retries_with_backoff(stand_in):
+    """HTTP 500 se reintenta con espera exponencial hasta que el endpoint responde 200"""
+    stand_in.statuses = [500, 500]
+    sink = alarma.QueuedSink(alarma.WebhookSink(stand_in.url, timeout=2), backoff=0.1)
+    try:
+        sink.send({"symbol": "EURUSD", "signal": "PDH", "batch": 1})
+        assert wait_for(lambda: sink.stats()['sent'] == 1)
+    finally:
+        sink.close()
+    times = [moment for moment, _, _ in stand_in.requests]
+    assert len(times) == 3
+    assert times[1] - times[0] >= 0.1
+    assert times[2] - times[1] >= 0.2
+    assert sink.stats() == {"pending": 0, "sent": 1, "dropped": 0, "failed": 0}
+
+
+def test_queued_sink_retry_skips_delivered_alerts(stand_in):
+    """Tras un fallo a mitad de lote solo se reenvían las alertas no entregadas"""
+    stand_in.statuses = [200, 200, 500]
+    sink = alarma.QueuedSink(alarma.WebhookSink(stand_in.url, timeout=2), backoff=0.05)
+    try:
+        # Con la condición tomada el hilo no puede empezar: las cuatro forman un lote
+        with sink.condition:
+            for index in range(4):
+                sink.send({"batch": index})
+        assert wait_for(lambda: sink.stats()['sent'] == 4)
+    finally:
+        sink.close()
+    # La alerta 2 se rechaza con HTTP 500 y se reintenta; 0 y 1 no se repiten
+    assert [body['batch'] for body in stand_in.bodies()] == [0, 1, 2, 2, 3]
+    assert sink.stats()['failed'] == 0
+
+
+def test_queued_sink_drops_oldest_when_full(stand_in):
+    """Con la cola llena se descartan las alertas más antiguas, no las nuevas"""
+    stand_in.gate.clear()
+    sink = alarma.QueuedSink(alarma.WebhookSink(stand_in.url, timeout=5), maxsize=3, batch_size=1)
+    try:
+        sink.send({"batch": 0})
+        # El hilo del sumidero queda esperando la respuesta de la primera alerta
+        assert wait_for(lambda: len(stand_in.requests) == 1)
+        for index in range(1, 6):
+            sink.send({"batch": index})
+        assert sink.stats()['dropped'] == 2
+        stand_in.gate.set()
+        assert wait_for(lambda: sink.stats()['sent'] == 4)
+    finally:
+        sink.close()
+    assert [body['batch'] for body in stand_in.bodies()] == [0, 3, 4, 5]
+
+
+def test_emit_does_not_block_on_dead_endpoint(tmp_path, monkeypatch):
+    """Un endpoint que acepta la conexión y nunca responde no retrasa emit()"""
+    monkeypatch.chdir(tmp_path)
+    dead = socket.socket()
+    dead.bind(("127.0.0.1", 0))
+    dead.listen(16)
+    model = alarma.TradingAlarmModel()
+    model.store.override({"notification_sinks": [], "alert_journal": False})
+    url = f"http://127.0.0.1:{dead.getsockname()[1]}/hook"
+    engine = alarma.MonitorEngine(model, sinks=[alarma.WebhookSink(url, timeout=1)])
+    try:
+        started = time.perf_counter()
+        for index in range(20):
+            engine.emit("EURUSD", "RUPTURA PDH (Previous Day High)", index)
+        assert time.perf_counter() - started < 0.5
+        assert isinstance(engine.sinks[0], alarma.QueuedSink)
+    finally:
+        engine.close()
+        model.close()
+        dead.close()
@@ -0,0 +1,71 @@
+"""Almacén local de velas (BarStore) y fuente que lo antepone al terminal (StoredDataSource)"""
+from datetime import datetime
+
+import numpy as np
+import pytz
+
+import alarma
+from test_replay import DAY, M5, T0, OffsetSource, make_bars, window, write_replay
+
+
+def utc(epoch):
+    return datetime.fromtimestamp(epoch, pytz.utc)
+
+
+def stored_source(tmp_path, server_start):
+    """(fuente con almacén, reproducción, fuente que cuenta las consultas, velas M5)"""
+    (tmp_path / "replay").mkdir()
+    bars = write_replay(tmp_path / "replay")
+    replay = alarma.ReplayDataSource(str(tmp_path / "replay"), speed=0, start=server_start)
+    terminal = OffsetSource(replay, 0)
+    store = alarma.BarStore(str(tmp_path / "store"))
+    return alarma.StoredDataSource(terminal, store), replay, terminal, bars
+
+
+def test_bar_store_append_and_read(tmp_path):
+    store = alarma.BarStore(str(tmp_path))
+    bars = make_bars(T0, 10, M5)
+    assert store.first_time("EURUSD", alarma.TIMEFRAME_M5) is None
+    store.append("EURUSD", alarma.TIMEFRAME_M5, bars[:6])
+    store.append("EURUSD", alarma.TIMEFRAME_M5, bars[6:])
+
+    # Otra instancia lee lo mismo desde disco
+    store = alarma.BarStore(str(tmp_path))
+    assert store.count("EURUSD", alarma.TIMEFRAME_M5) == 10
+    assert (store.first_time("EURUSD", alarma.TIMEFRAME_M5),
+            store.last_time("EURUSD", alarma.TIMEFRAME_M5)) == (T0, T0 + 9 * M5)
+    assert np.array_equal(store.read("EURUSD", alarma.TIMEFRAME_M5, T0 + 2 * M5, T0 + 4 * M5), bars[2:5])
+
+
+def test_stored_source_fetches_only_the_tail(tmp_path):
+    """La primera consulta va al terminal; la repetición solo pide la vela en formación"""
+    now = T0 + 2 * DAY + 10 * 3600 + 2
+    source, replay, terminal, bars = stored_source(tmp_path, now)
+    expected = window(bars, now - DAY, now + 1)
+
+    rates = source.copy_rates_range("EURUSD", alarma.TIMEFRAME_M5, utc(now - DAY), utc(now))
+    assert np.array_equal(rates, expected)
+    # La vela en formación no se almacena
+    assert source.store.last_time("EURUSD", alarma.TIMEFRAME_M5) == int(expected['time'][-2])
+
+    rates = source.copy_rates_range("EURUSD", alarma.TIMEFRAME_M5, utc(now - DAY), utc(now))
+    assert np.array_equal(rates, expected)
+    assert len(terminal.range_calls) == 2
+    assert terminal.range_calls[-1][0] == utc(int(expected['time'][-1]))
+
+
+def test_stored_source_trims_to_requested_window(tmp_path):
+    """Tras un hueco se guarda todo el hueco, pero solo se devuelve el rango pedido"""
+    tokyo_end = T0 + 2 * DAY + 8 * 3600
+    source, replay, terminal, bars = stored_source(tmp_path, tokyo_end + 2)
+    source.copy_rates_range("EURUSD", alarma.TIMEFRAME_M5, utc(T0 + 2 * DAY), utc(tokyo_end))
+    assert source.store.last_time("EURUSD", alarma.TIMEFRAME_M5) == tokyo_end - M5
+
+    # Nueva York (13:00-21:00), consultado ya con el día siguiente en curso
+    replay.start = T0 + 3 * DAY + 3600
+    new_york = (T0 + 2 * DAY + 13 * 3600, T0 + 2 * DAY + 21 * 3600 - 1)
+    rates = source.copy_rates_range("EURUSD", alarma.TIMEFRAME_M5, utc(new_york[0]), utc(new_york[1]))
+    assert np.array_equal(rates, window(bars, *new_york))
+    # Londres queda almacenado; la última vela recibida se reserva por si estaba en formación
+    assert len(terminal.range_calls) == 2
+    assert source.store.last_time("EURUSD", alarma.TIMEFRAME_M5) == new_york[1] + 1 - 2 * M5